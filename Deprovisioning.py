@@ -1,627 +1,477 @@
 # -*- coding: utf-8 -*-
 # App: Deprovisioning Consip – robusta ai file EN/IT
 # Autore: adattato per funzionare con intestazioni colonne in Italiano/English
+# La logica (senza Streamlit) è in deprovisioning_core.py; qui solo l'interfaccia.
 
-import re
-import csv
 import io
+import os
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
-from typing import List, Set, Tuple, Optional
+from pathlib import Path
+from typing import List, Optional
 
 import streamlit as st
 import pandas as pd
 
-# ==============
-# Costanti CSV
-# ==============
+from deprovisioning_core import (
+    CAND_DL_GROUP,
+    CAND_DL_GROUP_ADDR,
+    CAND_DL_MEMBER,
+    CAND_SM_GROUP_NAME,
+    CAND_SM_MAILBOX_ADDR,
+    CAND_SM_MEMBER,
+    ETICHETTE_SORGENTI,
+    HEADER_MODIFICA,
+    RISULTATI_MAX_BYTES,
+    RISULTATI_MAX_ENTRIES,
+    SORGENTI,
+    TIPI_EXPORT,
+    Avanzamento,
+    ExportCache,
+    LavoroAnnullato,
+    RisultatoUtente,
+    SnapshotStore,
+    Strumentazione,
+    _fase,
+    _find_col,
+    _find_col_preferred,
+    carica_snapshot,
+    elabora_utente,
+    gruppi_non_trovati,
+    itera_batch,
+    leggi_elenco_sam,
+    motore,
+    motori_disponibili,
+    nome_batch,
+    nome_csv_utente,
+    nome_report_gruppi,
+    nome_report_non_risolti,
+    nome_report_ricognizione,
+    parse_elenco_gruppi,
+    parse_elenco_sam,
+    preflight_export,
+    report_membri_gruppi,
+    ricognizione_accessi,
+    scrivi_csv_consolidato,
+    scrivi_zip,
+    usa_motore,
+)
+
+# account del batch mostrati a video; tutti gli altri sono solo nel file scaricabile
+ANTEPRIMA_BATCH = 50
+FORMATI_BATCH = ["ZIP (CSV utente, CSV PC e istruzioni per account)", "CSV Utenti consolidato"]
+MODALITA = ["Singolo utente", "Batch (elenco utenti)", "Membri gruppi (elenco gruppi)",
+            "Accessi residui (elenco attivi HR)"]
 
-# Header CSV per lo Step 1 (Utente)
-HEADER_MODIFICA = [
-    "sAMAccountName", "Creation", "OU", "Name", "DisplayName", "cn", "GivenName", "Surname",
-    "employeeNumber", "employeeID", "department", "Description", "passwordNeverExpired",
-    "ExpireDate", "userprincipalname", "mail", "mobile", "RimozioneGruppo", "InserimentoGruppo",
-    "disable", "moveToOU", "telephoneNumber", "company"
-]
 
-# Header CSV per Device
-HEADER_DEVICE = [
-    "Computer", "OU", "add_mail", "remove_mail",
-    "add_mobile", "remove_mobile",
-    "add_userprincipalname", "remove_userprincipalname",
-    "disable", "moveToOU"
-]
-
-# =========================
-# Utility per colonne EN/IT
-# =========================
-
-_SPACES_UNDERS = re.compile(r"[\s_]+")
-
-
-def _norm_key(s: str) -> str:
-    """Normalizza una chiave colonna (minuscolo, senza spazi/underscore)."""
-    return _SPACES_UNDERS.sub("", str(s).strip().lower())
-
-
-def _find_col(df: pd.DataFrame, candidates: List[str]) -> Optional[str]:
-    """
-    Ritorna il nome della prima colonna di df che corrisponde ad almeno
-    uno dei 'candidates' (case/space/underscore insensitive).
-    Tenta prima match esatto normalizzato, poi 'contains'.
-    """
-    if df is None or df.empty:
-        return None
-    norm_map = {_norm_key(c): c for c in df.columns}
-    # tentativo 1: match esatto normalizzato
-    for cand in candidates:
-        key = _norm_key(cand)
-        if key in norm_map:
-            return norm_map[key]
-    # tentativo 2: contains
-    for cand in candidates:
-        ckey = _norm_key(cand)
-        for col in df.columns:
-            if ckey in _norm_key(col):
-                return col
-    return None
-
-
-def _find_col_preferred(df: pd.DataFrame, preferred: List[str], fallback: List[str]) -> Optional[str]:
-    """Cerca prima nelle 'preferred' (in ordine), se non trova usa una delle fallback."""
-    if df is None or df.empty:
-        return None
-    for cand in preferred:
-        col = _find_col(df, [cand])
-        if col:
-            return col
-    return _find_col(df, fallback)
-
-
-def _get_any(df: pd.DataFrame, candidates: List[str]) -> pd.Series:
-    """Ritorna la Series della prima colonna trovata tra i candidates; se non c'è, solleva KeyError."""
-    col = _find_col(df, candidates)
-    if not col:
-        raise KeyError(f"Columns not found: {candidates}")
-    return df[col]
-
-
-def _require_any(df: pd.DataFrame, required_map: dict, context: str) -> Tuple[bool, List[str]]:
-    """
-    Verifica che per ogni chiave di required_map almeno una delle colonne candidate esista.
-    Ritorna (ok, missing_list).
-    """
-    missing = []
-    for logical_name, cand_list in required_map.items():
-        if _find_col(df, cand_list) is None:
-            missing.append(logical_name)
-    return (len(missing) == 0, missing)
-
-
-def _clean_series_to_list(series: pd.Series) -> List[str]:
-    """
-    Converte in lista di stringhe uniche/ordinate, rimuovendo vuoti.
-    """
-    if series is None or series.empty:
-        return []
-    vals = [str(x).strip() for x in series.dropna().astype(str).tolist()]
-    vals = [v for v in vals if v != ""]
-    # unici e ordinati (case-insensitive)
-    return sorted(list(set(vals)), key=lambda x: x.lower())
-
-
-def _read_excel_or_empty(uploaded_file) -> pd.DataFrame:
-    """Legge un Excel con engine openpyxl; se non presente o errore, ritorna DF vuoto."""
-    if not uploaded_file:
-        return pd.DataFrame()
-    try:
-        return pd.read_excel(uploaded_file, engine="openpyxl")
-    except Exception:
-        try:
-            return pd.read_excel(uploaded_file)
-        except Exception:
-            return pd.DataFrame()
-
-
-# =========================
-# Candidati colonne EN/IT
-# =========================
-
-# Membri / gruppi (export AD – "Estr_MembriGruppi")
-CAND_MG_MEMBER = [
-    "Member", "Membro",
-    "MemberSamAccountName", "MembroSamAccountName",
-    "SamAccountName", "sAMAccountName",
-    "MemberUserPrincipalName", "UserPrincipalNameMembro",
-    "userPrincipalName", "UPN",
-]
-CAND_MG_GROUP = [
-    "Group", "Gruppo",
-    "GroupName", "NomeGruppo",
-    "DisplayName", "NomeVisualizzato",
-    "cn", "CN", "Name", "Nome"
-]
-
-# Distribution List (DL) file
-# — nome DL preferito = Primary SMTP address (come richiesto)
-CAND_DL_GROUP_ADDR = [
-    "Distribution Group Primary SMTP address",   # preferito
-    "PrimarySmtpAddress", "SMTP", "Email",
-    "GroupName", "DisplayName", "Group", "Gruppo", "NomeGruppo",
-    "Nome", "NomeVisualizzato"
-]
-# — colonna membro con priorità su "Member Alias" (come richiesto)
-CAND_DL_MEMBER = [
-    "Member Alias", "Alias Membro", "MemberAlias",  # richiesto
-    "MemberUserPrincipalName", "UserPrincipalNameMembro",
-    "Member", "Membro",
-    "userPrincipalName", "UPN",
-    "MemberEmail", "EmailMembro", "Email", "E-mail"
-]
-# fallback "generico" per nomi gruppo (riuso funzioni esistenti)
-CAND_DL_GROUP = [
-    "Distribution Group", "Gruppo di distribuzione",
-    "Group", "Gruppo",
-    "GroupName", "NomeGruppo",
-    "DisplayName", "Nome", "NomeVisualizzato"
-]
-
-# Shared Mailbox / SM file
-# — membership via colonna member (incluso "Member")
-CAND_SM_MEMBER = [
-    "MemberUserPrincipalName", "UserPrincipalNameMembro",
-    "Member", "Membro",
-    "userPrincipalName", "UPN",
-    "MemberEmail", "EmailMembro", "Member Mail", "Email"
-]
-# — identificatore casella preferito = EmailAddress (come richiesto)
-CAND_SM_MAILBOX_ADDR = [
-    "EmailAddress",  # preferito
-    "PrimarySmtpAddress", "SMTP", "Email",
-    "DisplayName", "Mailbox", "SharedMailbox",
-    "Cassetta postale", "Casella condivisa"
-]
-# (già presente) gruppo/nome SM fallback generico
-CAND_SM_GROUP_NAME = [
-    "Group", "Gruppo",
-    "DisplayName", "Nome", "NomeVisualizzato",
-    "Mailbox", "SharedMailbox", "Cassetta postale", "Casella condivisa",
-    "PrimarySmtpAddress", "SMTP", "Email"
-]
-
-# Entra (gruppi utente)
-CAND_ENTRA_MEMBER_UPN = [
-    "MemberUserPrincipalName", "UserPrincipalNameMembro",
-    "userPrincipalName", "UPN",
-    "Email", "E-mail"
-]
-CAND_ENTRA_GROUP_NAME = [
-    "GroupName", "NomeGruppo",
-    "DisplayName", "Nome", "NomeVisualizzato",
-    "Group", "Gruppo"
-]
-
-# Device export
-CAND_DEV_ENABLED = ["Enabled", "Abilitato"]
-CAND_DEV_DESC = ["Description", "Descrizione"]
-CAND_DEV_NAME = ["Name", "Nome", "Computer", "NomeComputer"]
-CAND_DEV_MAIL = ["Mail", "Email", "E-mail", "Posta"]
-CAND_DEV_MOBILE = ["Mobile", "Cellulare", "Telefono", "Phone"]
-CAND_DEV_UPN = ["userPrincipalName", "UPN", "NomePrincipaleUtente"]
-
-
-# ====================================================
-# Funzione per comporre la stringa di rimozione gruppi
-# ====================================================
-
-def estrai_rimozione_gruppi(sam_lower: str, mg_df: pd.DataFrame) -> str:
-    """
-    Ritorna stringa gruppi AD (da "Estr_MembriGruppi") da rimuovere, separata da ';',
-    con esclusioni note (Domain Users/Utenti del dominio).
-    Supporta intestazioni EN/IT.
-    """
-    if mg_df is None or mg_df.empty:
-        return ""
-
-    required = {
-        "member": CAND_MG_MEMBER,
-        "group": CAND_MG_GROUP
-    }
-    ok, missing = _require_any(mg_df, required, "Estr_MembriGruppi")
-    if not ok:
-        # Se mancano colonne, non blocchiamo l'esecuzione: ritorniamo stringa vuota
-        st.warning(f"Nel file 'Estr_MembriGruppi' non ho trovato i campi: {', '.join(missing)}")
-        return ""
-
-    member_col = _get_any(mg_df, CAND_MG_MEMBER)
-    group_col = _get_any(mg_df, CAND_MG_GROUP)
-
-    # Confronta sia sAMAccountName sia UPN (per tolleranza)
-    user_email = f"{sam_lower}@consip.it"
-    member_vals = member_col.astype(str).str.strip().str.lower()
-    mask = (member_vals == sam_lower) | (member_vals == user_email)
-
-    groups_series = group_col[mask].dropna().astype(str)
-
-    # Escludi gruppi generici/di default
-    EXCLUDE = {"domain users", "utenti del dominio"}
-    filtered = [g for g in groups_series if g.strip() and g.strip().lower() not in EXCLUDE]
-
-    filtered = sorted(set(filtered), key=lambda x: x.lower())
-    if not filtered:
-        return ""
-
-    joined = ";".join(filtered)
-    # Se ci sono spazi, racchiudi l'intera stringa nelle virgolette per sicurezza
-    return f"\"{joined}\"" if any(" " in g for g in filtered) else joined
-
-
-# ======================================================
-# Helper: estrai nomi gruppi "generici" da un DataFrame
-# ======================================================
+# ===============
+# Streamlit UI
+# ===============
 
-def extract_group_names_from_df(df: pd.DataFrame) -> Set[str]:
+@st.cache_resource
+def _export_cache() -> ExportCache:
+    """Cache export condivisa tra rerun e sessioni (sopravvive al re-run dello script)."""
+    return ExportCache()
+
+
+@st.cache_resource
+def _cache_risultati() -> ExportCache:
+    """Risultati per account e impronta degli export, condivisi tra rerun e sessioni."""
+    return ExportCache(RISULTATI_MAX_ENTRIES, RISULTATI_MAX_BYTES)
+
+
+@st.cache_resource
+def _pool_lavori() -> ThreadPoolExecutor:
+    """Thread dei lavori in background (caricamento ed elaborazione), condivisi tra sessioni."""
+    return ThreadPoolExecutor(max_workers=max(2, min(4, os.cpu_count() or 1)))
+
+
+@st.cache_resource
+def _snapshot_store() -> Optional[SnapshotStore]:
+    """Archivio export su disco, se configurato con DEPROVISIONING_STORE (condiviso tra sessioni)."""
+    path = os.environ.get("DEPROVISIONING_STORE")
+    return SnapshotStore(path) if path else None
+
+
+def _mostra_snapshot_registrato(store: Optional[SnapshotStore]) -> None:
+    """Export correnti dell'archivio, usati per i file non caricati."""
+    if store is None:
+        return
+    correnti = sorted((v for v in store.versioni_registrate() if v["corrente"]),
+                      key=lambda v: SORGENTI.index(v["source"]))
+    if not correnti:
+        st.caption("Archivio snapshot vuoto: i file caricati verranno registrati.")
+        return
+    righe = [f"{ETICHETTE_SORGENTI[v['source']]}: {v['nome'] or '—'} ({v['righe']} righe, {v['registrato']})"
+             for v in correnti]
+    st.caption("Snapshot registrato (usato per i file non caricati): " + "; ".join(righe))
+
+
+def _mostra_preflight(files: dict) -> None:
+    """Colonne mancanti o ambigue dei file caricati, dalle sole intestazioni (prima del caricamento completo)."""
+    schemi, errori = preflight_export(files, _export_cache())
+    for source, errore in errori.items():
+        st.error(f"Intestazione del file {ETICHETTE_SORGENTI[source]} non leggibile: {errore}")
+    for schema in schemi.values():
+        for avviso in schema.avvisi():
+            st.warning(avviso)
+
+
+def _colonne_file(df: pd.DataFrame):
+    """Colonne del file per la diagnostica (tutte, anche quelle non lette dal loader)."""
+    if df.empty:
+        return "—"
+    return df.attrs.get("colonne_originali", df.columns.tolist())
+
+
+def _mostra_avvisi(risultato: RisultatoUtente) -> None:
+    for avviso in risultato.avvisi:
+        st.warning(avviso)
+
+
+def _mostra_strumentazione(strumentazione: Optional[Strumentazione], nome_motore: Optional[str] = None) -> None:
+    """Tempi e memoria per fase, con download del log in JSON/CSV."""
+    if strumentazione is None:
+        return
+    st.subheader("Diagnostica prestazioni")
+    if nome_motore:
+        st.caption(f"Motore operazioni su testo: {nome_motore}")
+    st.dataframe(pd.DataFrame(strumentazione.records(), columns=Strumentazione.COLONNE),
+                 use_container_width=True)
+    today = datetime.now().strftime("%Y%m%d_%H%M%S")
+    st.download_button(label="📥 Scarica log prestazioni (JSON)", data=strumentazione.to_json(),
+                       file_name=f"Deprovisioning_profilo_{today}.json", mime="application/json")
+    st.download_button(label="📥 Scarica log prestazioni (CSV)", data=strumentazione.to_csv(),
+                       file_name=f"Deprovisioning_profilo_{today}.csv", mime="text/csv")
+
+
+def _mostra_gruppi_annidati(risultato: RisultatoUtente) -> None:
+    """Gruppi AD diretti ed ereditati (solo in modalità gruppi annidati)."""
+    if risultato.gruppi_ad_diretti is None:
+        return
+    st.markdown("**Gruppi AD diretti:** " + (", ".join(risultato.gruppi_ad_diretti) or "—"))
+    st.markdown("**Gruppi AD ereditati (gruppi annidati):** " + (", ".join(risultato.gruppi_ad_ereditati) or "—"))
+
+
+def _esegui_batch(sams: List[str], snapshot, con_device: bool, formato: str,
+                  strumentazione: Optional[Strumentazione] = None,
+                  avanzamento: Optional[Avanzamento] = None, allegati=()) -> dict:
     """
-    Prova a estrarre nomi di gruppi da dataframe generici (DL/SM/MG).
-    Cerca prima colonne 'GROUP/GROUPNAME/DISPLAYNAME', altrimenti 'NAME/NOME'.
+    Elabora tutti gli account del batch sugli stessi file, già caricati una volta,
+    scrivendo ogni risultato nel file da scaricare (ZIP o CSV consolidato) appena
+    prodotto: in memoria restano solo i primi ANTEPRIMA_BATCH account.
+    Gli 'allegati' (nome, contenuto) vanno nello ZIP.
     """
-    if df is None or df.empty:
-        return set()
-
-    # 1) tenta group name esplicito
-    group_col_name = _find_col(df, CAND_DL_GROUP + CAND_MG_GROUP + CAND_SM_GROUP_NAME)
-    if group_col_name:
-        series = df[group_col_name]
-    else:
-        # 2) fallback su 'name' / 'nome'
-        fallback = _find_col(df, ["Name", "Nome", "DisplayName", "NomeVisualizzato"])
-        if not fallback:
-            return set()
-        series = df[fallback]
-
-    result = set([str(x).strip() for x in series.dropna().astype(str).tolist() if str(x).strip() != ""])
-    return result
-
-
-# =======================================================
-# Helper: estrai gruppi Entra per user_email/UPN (EN/IT)
-# =======================================================
-
-def extract_entra_groups_for_user(entra_df: pd.DataFrame, user_email_or_upn: str) -> Set[str]:
+    anteprima: List[RisultatoUtente] = []
+    senza_device: List[str] = []
+    n = 0
+
+    def risultati():
+        nonlocal n
+        for r in itera_batch(sams, snapshot, strumentazione, avanzamento):
+            n += 1
+            if len(anteprima) < ANTEPRIMA_BATCH:
+                anteprima.append(r)
+            if con_device and not r.device_csv:
+                senza_device.append(r.sam)
+            yield r
+
+    zip_ = formato == FORMATI_BATCH[0]
+    with tempfile.TemporaryFile() as out:
+        with _fase(strumentazione, "batch (totale)", righe=len(sams)):
+            if zip_:
+                scrivi_zip(risultati(), out, allegati=allegati)
+            else:
+                stream = io.TextIOWrapper(out, encoding="utf-8", newline="")
+                scrivi_csv_consolidato(risultati(), stream)
+                stream.detach()
+        out.seek(0)
+        dati = out.read()
+    return {"anteprima": anteprima, "senza_device": senza_device, "n": n, "zip": zip_, "dati": dati}
+
+
+def _elabora(files: dict, sam: str, sams: List[str], gruppi: List[str], attivi: List[str], batch: bool,
+             formato: Optional[str],
+             annidati: bool, profilo: bool, cache: ExportCache, risultati: ExportCache, store: Optional[SnapshotStore],
+             avanzamento: Avanzamento, nome_motore: str = "pandas") -> dict:
     """
-    Cerca i gruppi Entra a cui l'utente (UPN/email) appartiene.
-    Supporta intestazioni EN/IT: MemberUserPrincipalName/UserPrincipalNameMembro + GroupName/NomeGruppo/DisplayName
+    Lavoro in background (nessuna chiamata Streamlit): carica gli export ed
+    elabora l'account, il batch, il report membri dei gruppi o la ricognizione degli accessi residui
+    (account non in 'attivi'). Ritorna l'esito da mostrare, che resta nel
+    session_state: download e interazioni successive non ricalcolano nulla.
     """
-    if entra_df is None or entra_df.empty:
-        return set()
-
-    required = {
-        "member_upn": CAND_ENTRA_MEMBER_UPN,
-        "group_name": CAND_ENTRA_GROUP_NAME
-    }
-    ok, missing = _require_any(entra_df, required, "Entra")
-    if not ok:
-        st.warning(f"Nel file 'Entra' mancano i campi: {', '.join(missing)}")
-        return set()
-
-    member_col = _get_any(entra_df, CAND_ENTRA_MEMBER_UPN).astype(str).str.strip().str.lower()
-    group_series = _get_any(entra_df, CAND_ENTRA_GROUP_NAME)
-
-    target = user_email_or_upn.strip().lower()
-    mask = member_col == target
-    if not mask.any():
-        return set()
-
-    groups = _clean_series_to_list(group_series[mask])
-    return set(groups)
-
-
-# =========================================================
-# Funzione testuale di deprovisioning (Step 2) – EN/IT safe
-# =========================================================
-
-def genera_deprovisioning(
-    sam: str,
-    dl_df: pd.DataFrame,
-    sm_df: pd.DataFrame,
-    mg_df: pd.DataFrame,
-    entra_df: pd.DataFrame
-) -> List[str]:
-    sam_lower = sam.lower().strip()
-    user_email = f"{sam_lower}@consip.it"
-
-    clean = sam_lower.replace(".ext", "")
-    parts = clean.split('.', 1)
-    if sam_lower.endswith(".ext") and len(parts) == 2:
-        nome, cognome = parts
-        title = f"[Consip – SR] Casella di posta - Deprovisioning - {cognome.capitalize()} {nome.capitalize()} (esterno)"
-    elif len(parts) == 2:
-        nome, cognome = parts
-        title = f"[Consip – SR] Casella di posta - Deprovisioning - {cognome.capitalize()} {nome.capitalize()}"
-    else:
-        title = f"[Consip – SR] Casella di posta - Deprovisioning - {clean}"
-
-    st.subheader(title)
-    lines = [f"Ciao,\nper {user_email} :"]
-    warnings: List[str] = []
-    step = 1
-
-    fixed = [
-        "Disabilitare invio ad utente (Message Delivery Restrictions)",
-        "Impostare Hide dalla Rubrica",
-        "Disabilitare accesso Mailbox (Mailbox features – Disable Protocolli/OWA)",
-        f"Estrarre il PST (O365 eDiscovery) da archiviare in \\nasconsip2....\\backuppst\\03 - backup email cancellate\\{user_email} (in z7 con psw condivisa)",
-        "Rimuovere i Ruoli assegnati",
-        "Rimuovere le applicazioni dall’utenza Azure"
-    ]
-    for desc in fixed:
-        lines.append(f"{step}. {desc}")
-        step += 1
-
-    # --- DL (Distribution Lists): rimozione abilitazione
-    dl_list: List[str] = []
-    if dl_df is not None and not dl_df.empty:
-        col_group = _find_col_preferred(dl_df, CAND_DL_GROUP_ADDR, CAND_DL_GROUP)  # nome DL = Primary SMTP address
-        col_member = _find_col(dl_df, CAND_DL_MEMBER)  # membership via "Member Alias" o equivalenti
-        if col_group and col_member:
-            mvals = dl_df[col_member].astype(str).str.strip().str.lower()
-            candidates = {user_email, sam_lower}
-            mask = mvals.isin(candidates)
-            if not mask.any():
-                # gestisce membri multipli in cella (separati da ; , o spazi)
-                pattern = rf"(?:^|[;,\s])({re.escape(user_email)}|{re.escape(sam_lower)})(?:$|[;,\s])"
-                mask = dl_df[col_member].astype(str).str.lower().str.contains(pattern, na=False)
-            if mask.any():
-                dl_list = _clean_series_to_list(dl_df.loc[mask, col_group])
+    strumentazione = Strumentazione() if profilo else None
+    # motore del solo lavoro: le sessioni condividono il processo e il pool di thread.
+    # File letti con thread: niente fork del server né copie dei DataFrame tra processi
+    # (i processi restano su richiesta con DEPROVISIONING_PROCESSI=1, come il contrario di --thread)
+    with usa_motore(nome_motore):
+        snapshot = carica_snapshot(files, cache, processi=os.environ.get("DEPROVISIONING_PROCESSI") == "1",
+                                   strumentazione=strumentazione, store=store, annidati=annidati,
+                                   avanzamento=avanzamento, risultati=risultati)
+        dl_df, sm_df = snapshot.dfs["dl"], snapshot.dfs["sm"]
+        esito = {
+            "batch": batch,
+            "errori": snapshot.errori,
+            "colonne": {nome: _colonne_file(snapshot.dfs[s]) for s, nome in
+                        [("dl", "DL"), ("sm", "SM"), ("mg", "MG"), ("entra", "Entra"), ("device", "Device")]},
+            # Log rapido delle colonne effettivamente trovate (diagnostica)
+            "colonne_trovate": {
+                "DL_group_col": _find_col_preferred(dl_df, CAND_DL_GROUP_ADDR, CAND_DL_GROUP) if not dl_df.empty else None,
+                "DL_member_col": _find_col(dl_df, CAND_DL_MEMBER) if not dl_df.empty else None,
+                "SM_member_col": _find_col(sm_df, CAND_SM_MEMBER) if not sm_df.empty else None,
+                "SM_mailbox_col": _find_col_preferred(sm_df, CAND_SM_MAILBOX_ADDR, CAND_SM_GROUP_NAME) if not sm_df.empty else None,
+            },
+            # export Device caricato ora o preso dall'archivio
+            "con_device": snapshot.digests.get("device") is not None,
+            "strumentazione": strumentazione,
+            "motore": nome_motore,
+        }
+        if gruppi:
+            avanzamento.inizia("membri gruppi")
+            esito["report"] = report_membri_gruppi(gruppi, snapshot)
+            esito["gruppi_non_trovati"] = gruppi_non_trovati(gruppi, esito["report"])
+        elif attivi:
+            avanzamento.inizia("ricognizione accessi residui")
+            residui, non_risolti, esito["attivi_non_trovati"] = ricognizione_accessi(attivi, snapshot, strumentazione)
+            esito["residui"], esito["non_risolti"] = residui, non_risolti
+            # la colonna PC del report dice già chi ha PC: nessun elenco "senza CSV Device"
+            report = [(nome_report_ricognizione(), residui.to_csv(index=False))]
+            if len(non_risolti):
+                report.append((nome_report_non_risolti(), non_risolti.to_csv(index=False)))
+            esito.update(_esegui_batch(residui["Account"].tolist(), snapshot, False, formato, strumentazione,
+                                       avanzamento, allegati=report))
+        elif batch:
+            esito.update(_esegui_batch(sams, snapshot, esito["con_device"], formato, strumentazione, avanzamento))
         else:
-            warnings.append("Nel file DL non ho trovato colonne per 'Member Alias/Member' o 'Distribution Group Primary SMTP address'.")
-    if dl_list:
-        lines.append(f"{step}. Rimozione abilitazione dalle DL")
-        for dl in dl_list:
-            lines.append(f"   - {dl}")
-        step += 1
+            avanzamento.inizia("elaborazione account", 1)
+            esito["risultato"] = elabora_utente(sam, snapshot, strumentazione)
+            avanzamento.passo(sam)
+    return esito
+
+
+@st.fragment(run_every=0.5)
+def _mostra_lavoro() -> None:
+    """Avanzamento del lavoro in corso, aggiornato da solo; a lavoro finito rilancia la pagina con l'esito."""
+    lavoro = st.session_state.get("lavoro")
+    if lavoro is None:
+        return
+    future, avanzamento = lavoro
+    if future.done():
+        del st.session_state["lavoro"]
+        try:
+            st.session_state["esito"] = future.result()
+        except LavoroAnnullato:
+            st.session_state["messaggio"] = ("warning", "Elaborazione annullata.")
+        except Exception as exc:
+            st.session_state["messaggio"] = ("error", f"Errore durante l'elaborazione: {type(exc).__name__}: {exc}")
+        st.rerun()
+    fase, fatti, totale, ultimo = avanzamento.stato()
+    testo = (fase or "Avvio") + (f": {fatti}/{totale}" if totale else "...") + (f" – {ultimo}" if ultimo else "")
+    st.progress(avanzamento.frazione() or 0.0, text=testo)
+    if st.button("Annulla", disabled=avanzamento.annullato):
+        avanzamento.annulla()
+
+
+def _mostra_batch(esito: dict) -> None:
+    for r in esito["anteprima"]:
+        with st.expander(f"{r.sam}"):
+            _mostra_avvisi(r)
+            _mostra_gruppi_annidati(r)
+            st.subheader(r.titolo)
+            st.text("\n".join(r.istruzioni))
+
+    anteprima, n = esito["anteprima"], esito["n"]
+    titolo = f"Anteprima CSV Utenti ({n})"
+    if n > len(anteprima):
+        titolo += f" – primi {len(anteprima)}, gli altri sono nel file scaricato"
+    st.subheader(titolo)
+    st.dataframe(pd.DataFrame([r.riga for r in anteprima], columns=HEADER_MODIFICA), use_container_width=True)
+    if esito["zip"]:
+        st.download_button(label="📥 Scarica tutto (ZIP)", data=esito["dati"], on_click="ignore",
+                           file_name=Path(nome_batch()).with_suffix(".zip").name, mime="application/zip")
     else:
-        warnings.append("⚠️ Non sono state trovate DL per l'utente indicato")
-
-    # --- Disabilita account Azure
-    lines.append(f"{step}. Disabilitare l’account di Azure")
-    step += 1
-
-    # --- SM (Shared Mailboxes): rimozione abilitazioni
-    sm_list: List[str] = []
-    if sm_df is not None and not sm_df.empty:
-        col_member = _find_col(sm_df, CAND_SM_MEMBER)  # membership via colonna "member"
-        col_mailbox_addr = _find_col_preferred(sm_df, CAND_SM_MAILBOX_ADDR, CAND_SM_GROUP_NAME)  # nome SM = EmailAddress
-        if col_member and col_mailbox_addr:
-            mvals = sm_df[col_member].astype(str).str.strip().str.lower()
-            candidates = {user_email, sam_lower}
-            mask_any = mvals.isin(candidates)
-            if not mask_any.any():
-                # gestione membri multipli in cella (separati da ; , o spazi)
-                pattern = rf"(?:^|[;,\s])({re.escape(user_email)}|{re.escape(sam_lower)})(?:$|[;,\s])"
-                mask_any = sm_df[col_member].astype(str).str.lower().str.contains(pattern, na=False)
-            if mask_any.any():
-                sm_list = _clean_series_to_list(sm_df.loc[mask_any, col_mailbox_addr])
+        st.download_button(label="📥 Scarica CSV Utenti", data=esito["dati"], on_click="ignore",
+                           file_name=nome_batch(), mime="text/csv")
+
+    if esito["senza_device"]:
+        st.warning("Nessun dato valido per generare il CSV Device per: " + ", ".join(esito["senza_device"]))
+
+
+def _mostra_utente(esito: dict) -> None:
+    risultato: RisultatoUtente = esito["risultato"]
+    _mostra_avvisi(risultato)
+
+    # CSV Utente (Step 1)
+    st.subheader("Anteprima CSV Utente")
+    st.dataframe(pd.DataFrame([risultato.riga], columns=HEADER_MODIFICA), use_container_width=True)
+    st.download_button(label="📥 Scarica CSV Utente", data=risultato.csv_utente(), on_click="ignore",
+                       file_name=risultato.csv_name, mime="text/csv")
+    _mostra_gruppi_annidati(risultato)
+
+    # CSV Device (se presente)
+    if esito["con_device"]:
+        if risultato.device_csv:
+            st.subheader("Anteprima CSV PC")
+            preview_device_df = pd.read_csv(io.StringIO(risultato.device_csv), sep=",", header=None)
+            st.dataframe(preview_device_df, use_container_width=True)
+            st.download_button(label="📥 Scarica CSV PC", data=risultato.device_csv, on_click="ignore",
+                               file_name=risultato.device_file, mime="text/csv")
         else:
-            warnings.append("Nel file SM non ho trovato colonne per 'Member' o 'EmailAddress/SMTP'.")
-    if sm_list:
-        lines.append(f"{step}. Rimozione abilitazione da SM")
-        for sm in sm_list:
-            lines.append(f"   - {sm}")
-        step += 1
+            st.warning("Nessun dato valido per generare il CSV Device.")
+
+    # Testo Deprovisioning (Step 2)
+    st.subheader(risultato.titolo)
+    st.subheader("Istruzioni Deprovisioning")
+    st.text("\n".join(risultato.istruzioni))
+
+
+def _mostra_report_gruppi(esito: dict) -> None:
+    report: pd.DataFrame = esito["report"]
+    if esito["gruppi_non_trovati"]:
+        st.warning("Gruppi non trovati negli export caricati: " + ", ".join(esito["gruppi_non_trovati"]))
+    st.subheader(f"Membri dei gruppi ({len(report)} righe)")
+    st.write(f"**Esterni (.ext):** {int((report['Esterno'] == 'sì').sum())} – "
+             f"**Disabilitati:** {int((report['Disabilitato'] == 'sì').sum())}")
+    st.dataframe(report, use_container_width=True)
+    st.download_button(label="📥 Scarica membri gruppi (CSV)", data=report.to_csv(index=False), on_click="ignore",
+                       file_name=nome_report_gruppi(), mime="text/csv")
+
+
+def _mostra_residui(esito: dict) -> None:
+    residui: pd.DataFrame = esito["residui"]
+    non_trovati = esito["attivi_non_trovati"]
+    if non_trovati:
+        st.warning(f"Account attivi non trovati in nessun export: {len(non_trovati)} "
+                   f"(es. {', '.join(non_trovati[:10])})")
+    st.subheader(f"Account con accessi residui ({len(residui)})")
+    st.write(f"**Esterni (.ext):** {int((residui['Esterno'] == 'sì').sum())} – "
+             f"**Disabilitati:** {int((residui['Disabilitato'] == 'sì').sum())}")
+    st.dataframe(residui, use_container_width=True)
+    st.download_button(label="📥 Scarica report accessi residui (CSV)", data=residui.to_csv(index=False),
+                       on_click="ignore", file_name=nome_report_ricognizione(), mime="text/csv")
+    non_risolti: pd.DataFrame = esito["non_risolti"]
+    if len(non_risolti):
+        st.subheader(f"Identificativi non ricondotti a un account ({len(non_risolti)})")
+        st.caption("Membri non presenti nell'elenco attivi che non sono account del tenant: indirizzi esterni, "
+                   "gruppi annidati, computer. Da verificare a mano.")
+        st.dataframe(non_risolti, use_container_width=True)
+        st.download_button(label="📥 Scarica identificativi non risolti (CSV)", data=non_risolti.to_csv(index=False),
+                           on_click="ignore", file_name=nome_report_non_risolti(), mime="text/csv")
+
+
+def _mostra_esito(esito: dict) -> None:
+    for source, errore in esito["errori"].items():
+        st.error(f"Errore nella lettura del file {ETICHETTE_SORGENTI[source]}: {errore}")
+    for nome, colonne in esito["colonne"].items():
+        st.write(f"Colonne {nome} file:", colonne)
+    st.write(esito["colonne_trovate"])
+
+    if "report" in esito:
+        _mostra_report_gruppi(esito)
+    elif esito["batch"]:
+        if "residui" in esito:
+            _mostra_residui(esito)
+        _mostra_batch(esito)
     else:
-        warnings.append("⚠️ Non sono state trovate SM profilate all'utente indicato")
-
-    # --- Azure (Entra) gruppi da rimuovere dopo scrematura DL/MG/SM
-    entra_groups = extract_entra_groups_for_user(entra_df, user_email)
-    dl_groups_all = extract_group_names_from_df(dl_df)
-    mg_groups_all: Set[str] = set()
-    if mg_df is not None and not mg_df.empty:
-        mg_group_col = _find_col(mg_df, CAND_MG_GROUP)
-        if mg_group_col:
-            mg_groups_all = set([str(x).strip() for x in mg_df[mg_group_col].dropna().astype(str).tolist()])
-    sm_groups_all = extract_group_names_from_df(sm_df)
-    other_groups_union = set(dl_groups_all) | set(mg_groups_all) | set(sm_groups_all)
-
-    def normalize_set(s):
-        return {str(x).strip() for x in s if str(x).strip() != ""}
-
-    entra_norm = normalize_set(entra_groups)
-    other_norm = normalize_set(other_groups_union)
-    other_lower = {g.lower() for g in other_norm}
-    subset = {g for g in entra_norm if g.lower() not in other_lower}
-
-    # Esclusioni specifiche note
-    exclude_specific = {"o365 copilot plus", "o365 teams premium"}
-    subset = {g for g in subset if g.lower() not in exclude_specific}
-
-    if subset:
-        lines.append(f"{step}. Rimozione gruppi Azure:")
-        for g in sorted(subset, key=lambda x: x.lower()):
-            lines.append(f"   - {g}")
-        step += 1
-    else:
-        warnings.append("⚠️ Nessun gruppo Azure (file Entra) da rimuovere dopo lo scremamento con DL/MG/SM")
-
-    final_rest = [
-        "Cancellare la foto da Azure (se applicabile)",
-        "Rimozione Wi-Fi"
-    ]
-    for desc in final_rest:
-        lines.append(f"{step}. {desc}")
-        step += 1
-
-    if warnings:
-        lines.append("\n⚠️ Avvisi:")
-        lines.extend(warnings)
-
-    return lines
-
-
-# ==========================================
-# Funzione per generare CSV Device – EN/IT
-# ==========================================
-
-def genera_device_csv(sam: str, device_df: pd.DataFrame) -> Tuple[Optional[str], Optional[str]]:
-    """
-    Ritorna (contenuto_csv, nome_file) oppure (None, None) se non applicabile.
-    Supporta colonne EN/IT tipiche degli export Device.
-    """
-    if device_df is None or device_df.empty:
-        return None, None
-
-    col_enabled = _find_col(device_df, CAND_DEV_ENABLED)
-    if not col_enabled or col_enabled not in device_df.columns:
-        return None, None
-
-    # Filtra solo enabled == True/vero
-    enabled_series = device_df[col_enabled]
-    # Gestione valori tipo "True"/"Yes"/"Sì"
-    enabled_mask = enabled_series.astype(str).str.strip().str.lower().isin(["true", "1", "yes", "si", "sì"])
-    # se la colonna è nativa booleana, preserva
-    if enabled_series.dtype == bool:
-        enabled_mask = enabled_series == True
-
-    device_df = device_df[enabled_mask]
-    if device_df.empty:
-        return None, None
-
-    col_desc = _find_col(device_df, CAND_DEV_DESC)
-    col_name = _find_col(device_df, CAND_DEV_NAME)
-    col_mail = _find_col(device_df, CAND_DEV_MAIL)
-    col_mobile = _find_col(device_df, CAND_DEV_MOBILE)
-    col_upn = _find_col(device_df, CAND_DEV_UPN)
-
-    if not col_desc or not col_name:
-        return None, None
-
-    # cerca riga del device collegata all'utente (in Description)
-    sam_clean = sam.strip()
-    desc_vals = device_df[col_desc].astype(str)
-    mask = desc_vals.str.contains(fr"\s-\s{re.escape(sam_clean)}\s-\s", case=False, na=False)
-    if not mask.any():
-        return None, None
-
-    row_data = device_df.loc[mask].iloc[0]
-    computer_name = str(row_data[col_name]).strip()
-
-    def _has_val(colname: Optional[str]) -> str:
-        if not colname or colname not in row_data.index:
-            return ""
-        return "SI" if str(row_data.get(colname, "")).strip() else ""
-
-    remove_mail = _has_val(col_mail)
-    remove_mobile = _has_val(col_mobile)
-    remove_upn = _has_val(col_upn)
-
-    if not any([remove_mail, remove_mobile, remove_upn]):
-        return None, None
-
-    # Nome file: AAAAMMGG_Computer_riferimenti_remove[Cognome].csv
-    today = datetime.now().strftime("%Y%m%d")
-    clean = sam.replace(".ext", "")
-    parts = clean.split('.')
-    cognome = parts[1].capitalize() if len(parts) >= 2 else clean.capitalize()
-    file_name = f"{today}_Computer_riferimenti_remove[{cognome}].csv"
-
-    buf = io.StringIO()
-    writer = csv.writer(buf, quoting=csv.QUOTE_NONE, escapechar='\\')
-    writer.writerow(HEADER_DEVICE)
-    writer.writerow([computer_name, "", "", remove_mail, "", remove_mobile, "", remove_upn, "", ""])
-    # Riga EOF
-    writer.writerow(["EOF-riga lasciata appositamente scritta così per verificare che nessun PC sia andato nella OU/dismessi/computer"])
-    buf.seek(0)
-    return buf.getvalue(), file_name
+        _mostra_utente(esito)
+    _mostra_strumentazione(esito["strumentazione"], esito.get("motore"))
 
 
-# ===============
-# Streamlit UI
-# ===============
-
 def main():
     st.set_page_config(page_title="Deprovisioning Consip", layout="centered")
     st.title("Deprovisioning Utente")
 
-    sam = st.text_input("Nome utente (sAMAccountName)", "").strip().lower()
-    st.markdown("---")
-
-    if sam:
-        clean = sam.replace(".ext", "")
-        parts = clean.split('.')
-        if len(parts) == 2:
-            nome, cognome = parts
-            csv_name = f"Deprovisioning_{cognome.capitalize()}_{nome[0].upper()}.csv"
-        else:
-            csv_name = f"Deprovisioning_{clean}.csv"
+    modalita = st.radio("Modalità", MODALITA, horizontal=True)
+    batch = modalita == MODALITA[1]
+
+    sam = ""
+    sams: List[str] = []
+    gruppi: List[str] = []
+    attivi: List[str] = []
+    if modalita == MODALITA[3]:
+        batch = True
+        testo = st.text_area("Account attivi (estratto HR): sAMAccountName o UPN, uno per riga", "")
+        elenco_file = st.file_uploader("...oppure carica l'estratto HR (TXT/CSV)", type=["txt", "csv"])
+        attivi = parse_elenco_sam(testo)
+        for s in leggi_elenco_sam(elenco_file):
+            if s not in attivi:
+                attivi.append(s)
+        st.markdown("---")
+        st.write(f"**Account attivi in elenco:** {len(attivi)} – tutti gli altri account presenti negli export "
+                 f"saranno proposti per il deprovisioning")
+    elif modalita == MODALITA[2]:
+        testo = st.text_area("Gruppi: DL, caselle condivise, gruppi MG/Entra (uno per riga, oppure separati da ;)", "")
+        gruppi = parse_elenco_gruppi(testo)
+        st.markdown("---")
+        st.write(f"**Gruppi nel report:** {len(gruppi)}")
+    elif batch:
+        testo = st.text_area("Elenco sAMAccountName (uno per riga, oppure separati da ; o ,)", "")
+        elenco_file = st.file_uploader("...oppure carica elenco (TXT/CSV)", type=["txt", "csv"])
+        sams = parse_elenco_sam(testo)
+        for s in leggi_elenco_sam(elenco_file):
+            if s not in sams:
+                sams.append(s)
+        st.markdown("---")
+        st.write(f"**Utenti nel batch:** {len(sams)}")
     else:
-        csv_name = "Deprovisioning_.csv"
-    st.write(f"**File CSV generato:** {csv_name}")
-
-    dl_file = st.file_uploader("Carica file DL (Excel)", type="xlsx")
-    sm_file = st.file_uploader("Carica file SM (Excel)", type="xlsx")
-    mg_file = st.file_uploader("Carica file Estr_MembriGruppi (Excel)", type="xlsx")
-    entra_file = st.file_uploader("Carica file Entra (Excel)", type="xlsx")
-    device_file = st.file_uploader("Carica file Estr_Device (Excel)", type="xlsx")
-
-    if st.button("Genera Template e CSV per Deprovisioning"):
-        if not sam:
+        sam = st.text_input("Nome utente (sAMAccountName)", "").strip().lower()
+        st.markdown("---")
+        csv_name = nome_csv_utente(sam)
+        st.write(f"**File CSV generato:** {csv_name}")
+
+    dl_file = st.file_uploader("Carica file DL (Excel/CSV)", type=TIPI_EXPORT)
+    sm_file = st.file_uploader("Carica file SM (Excel/CSV)", type=TIPI_EXPORT)
+    mg_file = st.file_uploader("Carica file Estr_MembriGruppi (Excel/CSV)", type=TIPI_EXPORT)
+    entra_file = st.file_uploader("Carica file Entra (Excel/CSV)", type=TIPI_EXPORT)
+    device_file = st.file_uploader("Carica file Estr_Device (Excel/CSV)", type=TIPI_EXPORT)
+    files = {"dl": dl_file, "sm": sm_file, "mg": mg_file, "entra": entra_file, "device": device_file}
+    _mostra_preflight(files)
+    store = _snapshot_store()
+    _mostra_snapshot_registrato(store)
+
+    annidati = st.checkbox("Includi gruppi AD ereditati (gruppi annidati in Estr_MembriGruppi)", value=False)
+    profilo = st.checkbox("Mostra diagnostica prestazioni (tempi e memoria per fase)", value=False)
+    motori = motori_disponibili()
+    nome_motore = motore().nome
+    if profilo and len(motori) > 1:
+        # stessi risultati con ogni motore: la scelta serve a confrontare i tempi
+        nome_motore = st.selectbox("Motore operazioni su testo (indici)", motori,
+                                   index=motori.index(nome_motore) if nome_motore in motori else 0)
+    formato = st.radio("Output batch", FORMATI_BATCH, horizontal=True) if batch else None
+
+    in_corso = "lavoro" in st.session_state
+    if st.button("Genera Template e CSV per Deprovisioning", disabled=in_corso):
+        if modalita == MODALITA[2] and not gruppi:
+            st.error("Inserisci almeno un gruppo")
+            return
+        if modalita == MODALITA[3] and not attivi:
+            st.error("Inserisci l'elenco degli account attivi")
+            return
+        if modalita == MODALITA[1] and not sams:
+            st.error("Inserisci almeno uno sAMAccountName")
+            return
+        if modalita == MODALITA[0] and not sam:
             st.error("Inserisci lo sAMAccountName")
             return
 
-        dl_df = _read_excel_or_empty(dl_file)
-        sm_df = _read_excel_or_empty(sm_file)
-        mg_df = _read_excel_or_empty(mg_file)
-        entra_df = _read_excel_or_empty(entra_file)
-        device_df = _read_excel_or_empty(device_file)
-
-        st.write("Colonne DL file:", dl_df.columns.tolist() if not dl_df.empty else "—")
-        st.write("Colonne SM file:", sm_df.columns.tolist() if not sm_df.empty else "—")
-        st.write("Colonne MG file:", mg_df.columns.tolist() if not mg_df.empty else "—")
-        st.write("Colonne Entra file:", entra_df.columns.tolist() if not entra_df.empty else "—")
-        st.write("Colonne Device file:", device_df.columns.tolist() if not device_df.empty else "—")
-
-        # Log rapido delle colonne effettivamente trovate (diagnostica)
-        st.write({
-            "DL_group_col": _find_col_preferred(dl_df, CAND_DL_GROUP_ADDR, CAND_DL_GROUP) if not dl_df.empty else None,
-            "DL_member_col": _find_col(dl_df, CAND_DL_MEMBER) if not dl_df.empty else None,
-            "SM_member_col": _find_col(sm_df, CAND_SM_MEMBER) if not sm_df.empty else None,
-            "SM_mailbox_col": _find_col_preferred(sm_df, CAND_SM_MAILBOX_ADDR, CAND_SM_GROUP_NAME) if not sm_df.empty else None,
-        })
-
-        # CSV Utente (Step 1)
-        rimozione = estrai_rimozione_gruppi(sam, mg_df)
-        row_map = {h: "" for h in HEADER_MODIFICA}
-        row_map["sAMAccountName"] = sam
-        row_map["RimozioneGruppo"] = rimozione
-        row_map["disable"] = "SI"
-        row_map["moveToOU"] = "SI"
-        row = [row_map.get(h, "") for h in HEADER_MODIFICA]
-
-        buf = io.StringIO()
-        writer = csv.writer(buf, quoting=csv.QUOTE_NONE, escapechar='\\')
-        writer.writerow(HEADER_MODIFICA)
-        writer.writerow(row)
-        buf.seek(0)
-
-        preview_df = pd.read_csv(io.StringIO(buf.getvalue()), sep=",")
-        st.subheader("Anteprima CSV Utente")
-        st.dataframe(preview_df, use_container_width=True)
-        st.download_button(label="📥 Scarica CSV Utente", data=buf.getvalue(), file_name=csv_name, mime="text/csv")
-
-        # CSV Device (se presente)
-        if device_file:
-            device_csv, device_filename = genera_device_csv(sam, device_df)
-            if device_csv:
-                st.subheader("Anteprima CSV PC")
-                preview_device_df = pd.read_csv(io.StringIO(device_csv), sep=",", header=None)
-                st.dataframe(preview_device_df, use_container_width=True)
-                st.download_button(label="📥 Scarica CSV PC", data=device_csv, file_name=device_filename, mime="text/csv")
-            else:
-                st.warning("Nessun dato valido per generare il CSV Device.")
-
-        # Testo Deprovisioning (Step 2)
-        steps = genera_deprovisioning(sam, dl_df, sm_df, mg_df, entra_df)
-        st.subheader("Istruzioni Deprovisioning")
-        st.text("\n".join(steps))
+        # il caricamento e l'elaborazione girano in background: la pagina resta
+        # utilizzabile, mostra l'avanzamento e permette di annullare
+        avanzamento = Avanzamento()
+        future = _pool_lavori().submit(_elabora, files, sam, sams, gruppi, attivi, batch, formato, annidati, profilo,
+                                       _export_cache(), _cache_risultati(), store, avanzamento, nome_motore)
+        st.session_state["lavoro"] = (future, avanzamento)
+        st.session_state.pop("esito", None)
+        st.session_state.pop("messaggio", None)
+
+    _mostra_lavoro()
+    messaggio = st.session_state.get("messaggio")
+    if messaggio is not None:
+        livello, testo = messaggio
+        getattr(st, livello)(testo)
+    esito = st.session_state.get("esito")
+    if esito is not None:
+        _mostra_esito(esito)
 
 
 if __name__ == "__main__":
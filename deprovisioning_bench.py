@@ -0,0 +1,329 @@
+# -*- coding: utf-8 -*-
+# Deprovisioning Consip – generatore di export sintetici e benchmark
+#
+# Genera export MG/DL/SM/Entra/Device realistici (intestazioni EN o IT, celle
+# DL/SM con più membri, account .ext, "Domain Users"), li scrive su disco e misura:
+# caricamento, costruzione indici, latenza per utente, throughput batch, ricognizione
+# degli accessi residui (metà degli account attivi) e memoria.
+#
+# Esempi:
+#   python deprovisioning_bench.py --righe 10000 100000 --formato csv
+#   python deprovisioning_bench.py --righe 1000000 --formato csv --lingua it --json bench.json
+#   python deprovisioning_bench.py --righe 20000 --formato xlsx --memoria
+#   python deprovisioning_bench.py --righe 1000000 --motore pandas arrow   (stessi export, confronto motori)
+
+import argparse
+import hashlib
+import json
+import resource
+import statistics
+import sys
+import tempfile
+import time
+import tracemalloc
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+import pandas as pd
+
+from deprovisioning_core import (
+    MOTORI,
+    SORGENTI,
+    ExportCache,
+    _read_export_or_empty,
+    apri_export,
+    carica_snapshot,
+    elabora_batch,
+    elabora_utente,
+    estrai_rimozione_gruppi,
+    genera_deprovisioning,
+    genera_device_csv,
+    imposta_motore,
+    indici_snapshot,
+    ricognizione_accessi,
+)
+
+# Intestazioni per lingua: (membro, gruppo) o colonne device
+INTESTAZIONI = {
+    "en": {
+        "mg": ("Member", "Group"),
+        "dl": ("Member Alias", "Distribution Group Primary SMTP address"),
+        "sm": ("Member", "EmailAddress"),
+        "entra": ("MemberUserPrincipalName", "GroupName"),
+        "device": ("Name", "Enabled", "Description", "Mail", "Mobile", "userPrincipalName"),
+    },
+    "it": {
+        "mg": ("Membro", "Gruppo"),
+        "dl": ("Alias Membro", "Gruppo di distribuzione"),
+        "sm": ("UserPrincipalNameMembro", "Cassetta postale"),
+        "entra": ("UserPrincipalNameMembro", "NomeGruppo"),
+        "device": ("Nome", "Abilitato", "Descrizione", "Posta", "Cellulare", "NomePrincipaleUtente"),
+    },
+}
+
+
+# ==========================
+# Generatore export sintetici
+# ==========================
+
+def _account(n: int, rng: np.random.Generator) -> np.ndarray:
+    """n sAMAccountName nome.cognome, circa il 10% esterni (.ext)."""
+    ids = np.arange(n)
+    base = np.char.add(np.char.add("nome", ids.astype(str)), np.char.add(".cognome", ids.astype(str)))
+    ext = rng.random(n) < 0.10
+    return np.where(ext, np.char.add(base, ".ext"), base)
+
+
+def _membri(accounts: np.ndarray, n: int, rng: np.random.Generator, quota_upn: float = 0.5) -> np.ndarray:
+    """n riferimenti a membri: sAM oppure UPN @consip.it."""
+    scelti = accounts[rng.integers(0, len(accounts), n)]
+    upn = rng.random(n) < quota_upn
+    return np.where(upn, np.char.add(scelti, "@consip.it"), scelti)
+
+
+def _celle_multiple(accounts: np.ndarray, n: int, rng: np.random.Generator, quota: float) -> np.ndarray:
+    """Celle membro: una quota contiene 2-4 membri separati da ';' ',' o spazio."""
+    celle = _membri(accounts, n, rng).astype(object)
+    multi = np.flatnonzero(rng.random(n) < quota)
+    seps = np.array([";", "; ", ",", " "])
+    for i in multi:
+        k = int(rng.integers(2, 5))
+        celle[i] = seps[rng.integers(0, len(seps))].join(_membri(accounts, k, rng))
+    return celle
+
+
+def genera_export(
+    righe: int,
+    lingua: str = "en",
+    colonne_extra: int = 0,
+    quota_multi: float = 0.3,
+    seed: int = 0
+) -> Tuple[Dict[str, pd.DataFrame], List[str]]:
+    """
+    Export sintetici con 'righe' membership nel file MG (gli altri file in proporzione).
+    Ritorna (dfs per sorgente, elenco account esistenti).
+    """
+    rng = np.random.default_rng(seed)
+    h = INTESTAZIONI[lingua]
+    n_utenti = max(50, righe // 20)
+    accounts = _account(n_utenti, rng)
+
+    gruppi_ad = np.array([f"GRP_AD_{i:05d}" for i in range(max(20, righe // 200))] + ["Domain Users"])
+    gruppi_entra = np.concatenate([
+        gruppi_ad[: len(gruppi_ad) // 2],
+        np.array([f"AZ Gruppo {i}" for i in range(max(10, righe // 400))] + ["O365 Copilot Plus"]),
+    ])
+    dl_addr = np.array([f"dl{i}@consip.it" for i in range(max(10, righe // 500))])
+    sm_addr = np.array([f"sm{i}@consip.it" for i in range(max(10, righe // 500))])
+
+    n_dl = max(10, righe // 2)
+    n_sm = max(10, righe // 4)
+    n_dev = max(10, n_utenti)
+    dfs = {
+        "mg": pd.DataFrame({h["mg"][0]: _membri(accounts, righe, rng),
+                            h["mg"][1]: gruppi_ad[rng.integers(0, len(gruppi_ad), righe)]}),
+        "dl": pd.DataFrame({h["dl"][0]: _celle_multiple(accounts, n_dl, rng, quota_multi),
+                            h["dl"][1]: dl_addr[rng.integers(0, len(dl_addr), n_dl)]}),
+        "sm": pd.DataFrame({h["sm"][0]: _celle_multiple(accounts, n_sm, rng, quota_multi),
+                            h["sm"][1]: sm_addr[rng.integers(0, len(sm_addr), n_sm)]}),
+        "entra": pd.DataFrame({h["entra"][0]: _membri(accounts, righe, rng, quota_upn=1.0),
+                               h["entra"][1]: gruppi_entra[rng.integers(0, len(gruppi_entra), righe)]}),
+    }
+    proprietari = accounts[rng.integers(0, len(accounts), n_dev)]
+    nome, abilitato, desc, mail, mobile, upn = h["device"]
+    dfs["device"] = pd.DataFrame({
+        nome: [f"PC{i:06d}" for i in range(n_dev)],
+        abilitato: rng.random(n_dev) < 0.85,
+        desc: np.char.add(np.char.add("Notebook - ", proprietari), " - sede Roma"),
+        mail: np.where(rng.random(n_dev) < 0.6, np.char.add(proprietari, "@consip.it"), ""),
+        mobile: np.where(rng.random(n_dev) < 0.3, "+39 333 0000000", ""),
+        upn: np.where(rng.random(n_dev) < 0.5, np.char.add(proprietari, "@consip.it"), ""),
+    })
+    for source, df in dfs.items():
+        for i in range(colonne_extra):
+            df[f"Attributo{i}"] = rng.integers(0, 1_000_000, len(df))
+    return dfs, [str(a) for a in accounts]
+
+
+def scrivi_export(dfs: Dict[str, pd.DataFrame], cartella: Path, formato: str) -> Dict[str, Path]:
+    """Scrive gli export come xlsx, csv o csv.gz; ritorna i percorsi per sorgente."""
+    cartella.mkdir(parents=True, exist_ok=True)
+    paths: Dict[str, Path] = {}
+    for source, df in dfs.items():
+        if formato == "xlsx":
+            path = cartella / f"{source}.xlsx"
+            df.to_excel(path, index=False)
+        elif formato == "csv.gz":
+            path = cartella / f"{source}.csv.gz"
+            df.to_csv(path, index=False, compression="gzip")
+        else:
+            path = cartella / f"{source}.csv"
+            df.to_csv(path, index=False)
+        paths[source] = path
+    return paths
+
+
+# ===========
+# Misurazioni
+# ===========
+
+@contextmanager
+def _misura(risultati: Dict[str, float], nome: str, memoria: bool):
+    """Tempo (s) e, con memoria=True, picco tracemalloc (MB) del blocco."""
+    if memoria:
+        tracemalloc.start()
+    t0 = time.perf_counter()
+    try:
+        yield
+    finally:
+        risultati[f"{nome}_s"] = round(time.perf_counter() - t0, 4)
+        if memoria:
+            risultati[f"{nome}_picco_mb"] = round(tracemalloc.get_traced_memory()[1] / 1024 ** 2, 1)
+            tracemalloc.stop()
+
+
+def _latenze_ms(funzione, sams: List[str]) -> Dict[str, float]:
+    tempi = []
+    for sam in sams:
+        t0 = time.perf_counter()
+        funzione(sam)
+        tempi.append((time.perf_counter() - t0) * 1000)
+    tempi.sort()
+    return {
+        "p50": round(statistics.median(tempi), 3),
+        "p95": round(tempi[min(len(tempi) - 1, int(len(tempi) * 0.95))], 3),
+        "max": round(tempi[-1], 3),
+    }
+
+
+def esegui_benchmark(
+    righe: int,
+    formato: str = "csv",
+    lingua: str = "en",
+    utenti_batch: int = 200,
+    campione_lookup: int = 50,
+    campione_scan: int = 3,
+    colonne_extra: int = 10,
+    processi: bool = False,
+    memoria: bool = False,
+    seed: int = 0,
+    motore: str = "pandas"
+) -> Dict[str, object]:
+    """
+    Esegue tutte le misure per una dimensione di export e ritorna un dizionario di metriche.
+    'impronta_batch' riassume i risultati del batch: a parità di export è la stessa per ogni motore.
+    """
+    imposta_motore(motore)
+    res: Dict[str, object] = {"righe_mg": righe, "formato": formato, "lingua": lingua, "motore": motore}
+    t0 = time.perf_counter()
+    dfs, accounts = genera_export(righe, lingua=lingua, colonne_extra=colonne_extra, seed=seed)
+    res["righe_per_file"] = {s: len(df) for s, df in dfs.items()}
+    res["generazione_s"] = round(time.perf_counter() - t0, 2)
+
+    rng = np.random.default_rng(seed + 1)
+    sams = list(rng.choice(accounts, min(utenti_batch, len(accounts)), replace=False))
+    sams.append("utente.inesistente")
+
+    with tempfile.TemporaryDirectory() as tmp:
+        paths = scrivi_export(dfs, Path(tmp), formato)
+        res["dimensione_file_mb"] = {s: round(p.stat().st_size / 1024 ** 2, 2) for s, p in paths.items()}
+
+        # lettura del singolo file MG: completa vs solo colonne usate
+        with _misura(res, "lettura_mg_completa", memoria):
+            _read_export_or_empty(apri_export(paths["mg"]))
+        with _misura(res, "lettura_mg_colonne", memoria):
+            _read_export_or_empty(apri_export(paths["mg"]), "mg")
+
+        cache = ExportCache()
+        with _misura(res, "caricamento_snapshot", memoria):
+            snapshot = carica_snapshot({s: paths[s] for s in SORGENTI}, cache, processi=processi)
+        res["errori"] = snapshot.errori
+        with _misura(res, "snapshot_da_cache", memoria):
+            carica_snapshot({s: paths[s] for s in SORGENTI}, cache)
+
+    # costruzione indici da DataFrame già in memoria
+    with _misura(res, "costruzione_indici", memoria):
+        indici_snapshot(ExportCache(), snapshot.dfs, {s: None for s in SORGENTI})
+
+    campione = sams[:campione_lookup]
+    res["latenza_utente_ms"] = _latenze_ms(lambda s: elabora_utente(s, snapshot), campione)
+
+    # confronto: percorso senza indici (scansione completa dei file a ogni chiamata)
+    d = snapshot.dfs
+
+    def _senza_indici(sam: str) -> None:
+        estrai_rimozione_gruppi(sam, d["mg"])
+        genera_deprovisioning(sam, d["dl"], d["sm"], d["mg"], d["entra"])
+        genera_device_csv(sam, d["device"])
+
+    res["latenza_senza_indici_ms"] = _latenze_ms(_senza_indici, sams[:campione_scan])
+
+    with _misura(res, "batch", memoria):
+        risultati = elabora_batch(sams, snapshot)
+    res["batch_utenti"] = len(risultati)
+    res["batch_utenti_al_s"] = round(len(risultati) / max(res["batch_s"], 1e-9), 1)
+    res["impronta_batch"] = hashlib.sha256(
+        json.dumps([r.to_dict() for r in risultati], ensure_ascii=False).encode("utf-8")
+    ).hexdigest()[:16]
+
+    # ricognizione su tutto il tenant con metà degli account nell'elenco attivi
+    attivi = [str(a) for a in rng.choice(accounts, len(accounts) // 2, replace=False)]
+    with _misura(res, "ricognizione", memoria):
+        residui, _, _ = ricognizione_accessi(attivi, snapshot)
+    res["ricognizione_account"] = len(residui)
+    res["rss_max_mb"] = round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1)
+    return res
+
+
+def _stampa(res: Dict[str, object]) -> None:
+    print(f"\n=== MG {res['righe_mg']:,} righe – {res['formato']} – intestazioni {res['lingua'].upper()} "
+          f"– motore {res['motore']} ===")
+    for k, v in res.items():
+        if k in ("righe_mg", "formato", "lingua", "motore"):
+            continue
+        print(f"  {k:28s} {v}")
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description="Benchmark deprovisioning su export sintetici.")
+    parser.add_argument("--righe", type=int, nargs="+", default=[10_000, 100_000],
+                        help="righe del file MG (una misura per valore)")
+    parser.add_argument("--formato", choices=["csv", "csv.gz", "xlsx"], default="csv")
+    parser.add_argument("--lingua", choices=["en", "it"], default="en", help="intestazioni EN o IT")
+    parser.add_argument("--utenti", type=int, default=200, help="account nel batch")
+    parser.add_argument("--colonne-extra", type=int, default=10, help="attributi aggiuntivi per file")
+    parser.add_argument("--processi", action="store_true", help="caricamento in processi separati")
+    parser.add_argument("--memoria", action="store_true", help="misura il picco di memoria (tracemalloc, più lento)")
+    parser.add_argument("--json", metavar="FILE", help="salva i risultati in JSON")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--motore", choices=list(MOTORI), nargs="+", default=["pandas"],
+                        help="motori delle operazioni su testo da confrontare (una misura per motore)")
+    args = parser.parse_args(argv)
+
+    tutti = []
+    for righe in args.righe:
+        impronte = set()
+        for motore in args.motore:
+            try:
+                res = esegui_benchmark(
+                    righe, formato=args.formato, lingua=args.lingua, utenti_batch=args.utenti,
+                    colonne_extra=args.colonne_extra, processi=args.processi, memoria=args.memoria,
+                    seed=args.seed, motore=motore,
+                )
+            except ValueError as exc:
+                print(exc, file=sys.stderr)
+                return 2
+            _stampa(res)
+            tutti.append(res)
+            impronte.add(res["impronta_batch"])
+        if len(impronte) > 1:
+            print(f"ATTENZIONE: risultati diversi tra i motori con {righe:,} righe", file=sys.stderr)
+    if args.json:
+        Path(args.json).write_text(json.dumps(tutti, indent=2, ensure_ascii=False), encoding="utf-8")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,281 @@
+# -*- coding: utf-8 -*-
+# Deprovisioning Consip – riga di comando (senza Streamlit)
+#
+# Esempio:
+#   python deprovisioning_cli.py --dl DL.xlsx --sm SM.xlsx --mg Estr_MembriGruppi.xlsx \
+#       --entra Entra.xlsx --device Estr_Device.csv --elenco uscite.txt --out output/
+#   python deprovisioning_cli.py --mg Estr_MembriGruppi.csv mario.rossi --json
+#   python deprovisioning_cli.py --store snapshot.db mario.rossi   (export già registrati)
+#   python deprovisioning_cli.py --mg MG.xlsx --device Dev.csv --elenco uscite.txt --zip uscite.zip
+#   python deprovisioning_cli.py --store snapshot.db --gruppi elenco_gruppi.txt --out report/
+#   python deprovisioning_cli.py --dl DL.xlsx --mg MG.xlsx --verifica   (solo intestazioni)
+#   python deprovisioning_cli.py --store snapshot.db --elenco uscite.txt --csv uscite.csv --motore arrow
+#   python deprovisioning_cli.py --store snapshot.db --attivi estratto_hr.csv --zip residui.zip
+
+import argparse
+import json
+import os
+import sys
+from contextlib import nullcontext
+from pathlib import Path
+from typing import Iterable, List, Optional, Tuple
+
+from deprovisioning_core import (
+    ETICHETTE_SORGENTI,
+    MOTORI,
+    SORGENTI,
+    SnapshotStore,
+    Strumentazione,
+    apri_export,
+    carica_snapshot,
+    elabora_batch,
+    gruppi_non_trovati,
+    imposta_motore,
+    itera_batch,
+    leggi_elenco_sam,
+    nome_report_gruppi,
+    nome_report_non_risolti,
+    nome_report_ricognizione,
+    parse_elenco_gruppi,
+    parse_elenco_sam,
+    preflight_export,
+    ricognizione_accessi,
+    report_membri_gruppi,
+    scrivi_csv_consolidato,
+    scrivi_risultati,
+    scrivi_zip,
+)
+
+
+def _parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(
+        description="Genera CSV utente, CSV device e istruzioni di deprovisioning "
+                    "per uno o più sAMAccountName a partire dagli export (xlsx/csv/tsv, anche .gz)."
+    )
+    parser.add_argument("sam", nargs="*", help="sAMAccountName da elaborare")
+    parser.add_argument("--elenco", help="file TXT/CSV con l'elenco degli account")
+    for source in SORGENTI:
+        parser.add_argument(f"--{source}", metavar="FILE", help=f"export {ETICHETTE_SORGENTI[source]}")
+    parser.add_argument("--out", metavar="DIR", help="cartella in cui scrivere i CSV e le istruzioni")
+    bundle = parser.add_mutually_exclusive_group()
+    bundle.add_argument("--zip", metavar="FILE",
+                        help="scrive tutti i file (CSV utente, CSV PC, istruzioni) in un unico ZIP, "
+                             "un account alla volta")
+    bundle.add_argument("--csv", metavar="FILE",
+                        help="scrive solo il CSV utenti consolidato, una riga per account")
+    parser.add_argument("--json", action="store_true", help="stampa i risultati in JSON su stdout")
+    parser.add_argument("--thread", action="store_true",
+                        help="carica i file con thread invece che con processi separati")
+    parser.add_argument("--workers", type=int, default=None, help="numero massimo di worker di caricamento")
+    parser.add_argument("--motore", choices=list(MOTORI), default=os.environ.get("DEPROVISIONING_MOTORE", "pandas"),
+                        help="motore delle operazioni su testo degli indici: stessi risultati, tempi diversi "
+                             "(arrow richiede pyarrow; default: variabile DEPROVISIONING_MOTORE o pandas)")
+    parser.add_argument("--store", metavar="FILE", default=os.environ.get("DEPROVISIONING_STORE"),
+                        help="archivio SQLite degli export: i file indicati vi vengono registrati, "
+                             "quelli non indicati sono presi dalla versione corrente; contiene solo dati "
+                             "(array e JSON, niente pickle) ma include account e appartenenze, va protetto "
+                             "come gli export (default: variabile DEPROVISIONING_STORE)")
+    parser.add_argument("--annidati", action="store_true",
+                        help="riporta anche i gruppi AD ereditati tramite gruppi annidati (export MG)")
+    parser.add_argument("--gruppi", metavar="FILE",
+                        help="report dei membri dei gruppi elencati in FILE (uno per riga: DL, caselle "
+                             "condivise, gruppi MG/Entra) invece del deprovisioning degli account")
+    parser.add_argument("--gruppo", action="append", default=[], metavar="NOME",
+                        help="come --gruppi per un singolo gruppo (ripetibile)")
+    parser.add_argument("--attivi", metavar="FILE",
+                        help="ricognizione su tutto il tenant: elenco degli account attivi (es. estratto HR, "
+                             "TXT/CSV con colonna sAMAccountName o prima colonna); produce report e file di "
+                             "deprovisioning di tutti gli altri account ancora presenti negli export")
+    parser.add_argument("--verifica", action="store_true",
+                        help="controlla solo le intestazioni dei file (colonne trovate, mancanti o ambigue) "
+                             "senza caricarli")
+    parser.add_argument("--profilo", metavar="FILE",
+                        help="scrive tempi e memoria per fase in FILE (.json oppure .csv)")
+    return parser
+
+
+def _scrivi_bundle(args, sams: List[str], snapshot, strumentazione: Optional[Strumentazione],
+                   allegati: Iterable[Tuple[str, str]] = ()) -> int:
+    """
+    --zip/--csv: risultati scritti man mano che sono prodotti, senza tenere in memoria il batch
+    (gli 'allegati' vanno nello ZIP).
+    """
+    def risultati():
+        for r in itera_batch(sams, snapshot, strumentazione):
+            for avviso in r.avvisi:
+                print(f"[{r.sam}] {avviso}", file=sys.stderr)
+            yield r
+
+    with strumentazione.fase("batch (totale)", righe=len(sams)) if strumentazione else nullcontext():
+        if args.zip:
+            scrivi_zip(risultati(), args.zip, allegati=allegati)
+            print(f"Scritto: {Path(args.zip)}")
+        else:
+            scrivi_csv_consolidato(risultati(), args.csv)
+            print(f"Scritto: {Path(args.csv)}")
+    if strumentazione is not None:
+        strumentazione.scrivi(args.profilo)
+    return 1 if snapshot.errori else 0
+
+
+def _scrivi_report_gruppi(args, gruppi: List[str], snapshot, strumentazione: Optional[Strumentazione]) -> int:
+    """--gruppi/--gruppo: membri per gruppo in CSV (--out, --csv o stdout) o JSON."""
+    with strumentazione.fase("report membri gruppi", righe=len(gruppi)) if strumentazione else nullcontext():
+        report = report_membri_gruppi(gruppi, snapshot)
+    if strumentazione is not None:
+        strumentazione.scrivi(args.profilo)
+    mancanti = gruppi_non_trovati(gruppi, report)
+    if args.json:
+        json.dump({"membri": report.to_dict(orient="records"), "gruppi_non_trovati": mancanti,
+                   "errori": snapshot.errori}, sys.stdout, ensure_ascii=False, indent=2)
+        print()
+    else:
+        for g in mancanti:
+            print(f"[{g}] gruppo non trovato negli export caricati", file=sys.stderr)
+        if args.out or args.csv:
+            path = Path(args.csv) if args.csv else Path(args.out) / nome_report_gruppi()
+            path.parent.mkdir(parents=True, exist_ok=True)
+            report.to_csv(path, index=False, encoding="utf-8")
+            print(f"Scritto: {path}")
+        else:
+            report.to_csv(sys.stdout, index=False)
+    return 1 if snapshot.errori else 0
+
+
+def _scrivi_ricognizione(args, attivi: List[str], snapshot, strumentazione: Optional[Strumentazione]) -> int:
+    """
+    --attivi: report degli account non attivi con accessi residui (--out, nello ZIP o su stdout),
+    degli identificativi non ricondotti a un account (--out, nello ZIP, --json) e i file di
+    deprovisioning degli account (--out, --zip, --csv o --json).
+    """
+    residui, non_risolti, non_trovati = ricognizione_accessi(attivi, snapshot, strumentazione)
+    print(f"Account in elenco attivi: {len(attivi)} (non trovati negli export: {len(non_trovati)}); "
+          f"account con accessi residui: {len(residui)}; identificativi non risolti: {len(non_risolti)}",
+          file=sys.stderr)
+    sams = residui["Account"].tolist()
+    report = [(nome_report_ricognizione(), residui)]
+    if len(non_risolti):
+        report.append((nome_report_non_risolti(), non_risolti))
+    if args.zip or args.csv:
+        return _scrivi_bundle(args, sams, snapshot, strumentazione,
+                              allegati=[(nome, df.to_csv(index=False)) for nome, df in report])
+
+    if args.json:
+        risultati = elabora_batch(sams, snapshot, strumentazione)
+        json.dump({"residui": residui.to_dict(orient="records"), "non_risolti": non_risolti.to_dict(orient="records"),
+                   "attivi_non_trovati": non_trovati, "risultati": [r.to_dict() for r in risultati], "errori": snapshot.errori},
+                  sys.stdout, ensure_ascii=False, indent=2)
+        print()
+    elif args.out:
+        Path(args.out).mkdir(parents=True, exist_ok=True)
+        for nome, df in report:
+            path = Path(args.out) / nome
+            df.to_csv(path, index=False, encoding="utf-8")
+            print(f"Scritto: {path}")
+        for scritto in scrivi_risultati(itera_batch(sams, snapshot, strumentazione), args.out):
+            print(f"Scritto: {Path(scritto)}")
+    else:
+        residui.to_csv(sys.stdout, index=False)
+    if strumentazione is not None:
+        strumentazione.scrivi(args.profilo)
+    return 1 if snapshot.errori else 0
+
+
+def _verifica(files) -> int:
+    """--verifica: colonne risolte per ogni file dalle sole intestazioni; 1 se mancano colonne o file illeggibili."""
+    schemi, errori = preflight_export(files)
+    if not schemi and not errori:
+        print("Nessun file indicato.", file=sys.stderr)
+        return 2
+    for source, errore in errori.items():
+        print(f"Errore nella lettura del file {ETICHETTE_SORGENTI[source]}: {errore}", file=sys.stderr)
+    for source, schema in schemi.items():
+        trovate = ", ".join(f"{ruolo}={col or '—'}" for ruolo, col in schema.ruoli.items())
+        print(f"{ETICHETTE_SORGENTI[source]}: {trovate}")
+        for avviso in schema.avvisi():
+            print(f"  {avviso}")
+    return 1 if errori or any(s.mancanti for s in schemi.values()) else 0
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    args = _parser().parse_args(argv)
+    if args.verifica:
+        return _verifica({source: getattr(args, source) for source in SORGENTI})
+
+    sams = parse_elenco_sam(" ".join(args.sam))
+    if args.elenco:
+        for s in leggi_elenco_sam(apri_export(args.elenco)):
+            if s not in sams:
+                sams.append(s)
+    gruppi = parse_elenco_gruppi("\n".join(args.gruppo))
+    if args.gruppi:
+        for g in parse_elenco_gruppi(apri_export(args.gruppi).getvalue().decode("utf-8-sig", errors="replace")):
+            if g.lower() not in {x.lower() for x in gruppi}:
+                gruppi.append(g)
+    if gruppi and sams:
+        print("Indicare account oppure gruppi (--gruppi/--gruppo), non entrambi.", file=sys.stderr)
+        return 2
+    attivi = leggi_elenco_sam(apri_export(args.attivi)) if args.attivi else []
+    if args.attivi and (sams or gruppi):
+        print("--attivi riguarda tutti gli account: non si combina con account o gruppi.", file=sys.stderr)
+        return 2
+    if args.attivi and not attivi:
+        print("Elenco attivi vuoto: tutti gli account risulterebbero da deprovisionare.", file=sys.stderr)
+        return 2
+    if not sams and not gruppi and not attivi:
+        print("Nessun sAMAccountName indicato (argomenti o --elenco).", file=sys.stderr)
+        return 2
+
+    try:
+        imposta_motore(args.motore)
+    except ValueError as exc:
+        print(exc, file=sys.stderr)
+        return 2
+    strumentazione = Strumentazione() if args.profilo else None
+    files = {source: getattr(args, source) for source in SORGENTI}
+    store = SnapshotStore(args.store) if args.store else None
+    snapshot = carica_snapshot(files, max_workers=args.workers, processi=not args.thread,
+                               strumentazione=strumentazione, store=store, annidati=args.annidati)
+    for source, errore in snapshot.errori.items():
+        print(f"Errore nella lettura del file {ETICHETTE_SORGENTI[source]}: {errore}", file=sys.stderr)
+
+    if gruppi:
+        return _scrivi_report_gruppi(args, gruppi, snapshot, strumentazione)
+
+    if (args.zip or args.csv) and (args.out or args.json):
+        print("--zip/--csv non si combinano con --out o --json.", file=sys.stderr)
+        return 2
+    if attivi:
+        return _scrivi_ricognizione(args, attivi, snapshot, strumentazione)
+    if args.zip or args.csv:
+        return _scrivi_bundle(args, sams, snapshot, strumentazione)
+
+    risultati = elabora_batch(sams, snapshot, strumentazione)
+    if strumentazione is not None:
+        strumentazione.scrivi(args.profilo)
+    scritti = scrivi_risultati(risultati, args.out) if args.out else []
+
+    if args.json:
+        json.dump({
+            "risultati": [r.to_dict() for r in risultati],
+            "file_scritti": [str(p) for p in scritti],
+            "errori": snapshot.errori,
+        }, sys.stdout, ensure_ascii=False, indent=2)
+        print()
+    else:
+        for r in risultati:
+            for avviso in r.avvisi:
+                print(f"[{r.sam}] {avviso}", file=sys.stderr)
+            if not args.out:
+                print(r.testo(), end="\n\n")
+                if r.gruppi_ad_diretti is not None:
+                    print("Gruppi AD diretti: " + (", ".join(r.gruppi_ad_diretti) or "—"))
+                    print("Gruppi AD ereditati: " + (", ".join(r.gruppi_ad_ereditati) or "—"), end="\n\n")
+        for path in scritti:
+            print(f"Scritto: {Path(path)}")
+
+    return 1 if snapshot.errori else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
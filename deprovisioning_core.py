@@ -0,0 +1,3387 @@
+# -*- coding: utf-8 -*-
+# Deprovisioning Consip – logica (senza Streamlit), robusta ai file EN/IT
+# Usata dall'app Streamlit (Deprovisioning.py) e dalla riga di comando (deprovisioning_cli.py)
+
+import re
+import csv
+import io
+import json
+import sys
+import os
+import gzip
+import sqlite3
+import codecs
+import hashlib
+import threading
+import time
+import zipfile
+from collections import OrderedDict
+from contextlib import contextmanager, nullcontext
+from contextvars import ContextVar
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, wait
+from dataclasses import asdict, dataclass, field
+from datetime import datetime
+from functools import lru_cache
+from pathlib import Path
+from typing import Any, Callable, Dict, FrozenSet, Hashable, Iterable, Iterator, List, Set, Tuple, Optional
+
+import numpy as np
+import pandas as pd
+from pandas.api.types import union_categoricals
+
+# ==============
+# Costanti CSV
+# ==============
+
+# Header CSV per lo Step 1 (Utente)
+HEADER_MODIFICA = [
+    "sAMAccountName", "Creation", "OU", "Name", "DisplayName", "cn", "GivenName", "Surname",
+    "employeeNumber", "employeeID", "department", "Description", "passwordNeverExpired",
+    "ExpireDate", "userprincipalname", "mail", "mobile", "RimozioneGruppo", "InserimentoGruppo",
+    "disable", "moveToOU", "telephoneNumber", "company"
+]
+
+# Header CSV per Device
+HEADER_DEVICE = [
+    "Computer", "OU", "add_mail", "remove_mail",
+    "add_mobile", "remove_mobile",
+    "add_userprincipalname", "remove_userprincipalname",
+    "disable", "moveToOU"
+]
+
+# =========================
+# Utility per colonne EN/IT
+# =========================
+
+_SPACES_UNDERS = re.compile(r"[\s_]+")
+
+
+def _norm_key(s: str) -> str:
+    """Normalizza una chiave colonna (minuscolo, senza spazi/underscore)."""
+    return _SPACES_UNDERS.sub("", str(s).strip().lower())
+
+
+def _find_col_in(columns, candidates: List[str]) -> Optional[str]:
+    """
+    Ritorna il nome della prima colonna in 'columns' che corrisponde ad almeno
+    uno dei 'candidates' (case/space/underscore insensitive).
+    Tenta prima match esatto normalizzato, poi 'contains'.
+    Il risultato è memorizzato per (colonne, candidati): le chiamate ripetute
+    (per fase, per utente) non rifanno la scansione.
+    """
+    return _risolvi_colonna(_chiave_colonne(columns), tuple(candidates))
+
+
+# Index pandas già convertiti in tupla (chiave dei risolutori), per identità
+_TUPLE_COLONNE: "OrderedDict[int, Tuple[pd.Index, Tuple[Any, ...]]]" = OrderedDict()
+_TUPLE_COLONNE_MAX = 256
+_TUPLE_COLONNE_LOCK = threading.Lock()
+
+
+def _chiave_colonne(columns) -> Tuple[Any, ...]:
+    """
+    Colonne come tupla hashable. Per uno stesso Index (df.columns) la conversione
+    avviene una volta: l'Index resta referenziato, quindi il suo id non può
+    essere riusato da un altro finché la voce è presente.
+    """
+    if isinstance(columns, tuple):
+        return columns
+    if not isinstance(columns, pd.Index):
+        return tuple(columns)
+    with _TUPLE_COLONNE_LOCK:
+        voce = _TUPLE_COLONNE.get(id(columns))
+        if voce is not None and voce[0] is columns:
+            _TUPLE_COLONNE.move_to_end(id(columns))
+            return voce[1]
+        tupla = tuple(columns.tolist())
+        _TUPLE_COLONNE[id(columns)] = (columns, tupla)
+        if len(_TUPLE_COLONNE) > _TUPLE_COLONNE_MAX:
+            _TUPLE_COLONNE.popitem(last=False)
+        return tupla
+
+
+@lru_cache(maxsize=4096)
+def _risolvi_colonna(columns: Tuple[Any, ...], candidates: Tuple[str, ...]) -> Optional[str]:
+    norm_map = {_norm_key(c): c for c in columns}
+    # tentativo 1: match esatto normalizzato
+    for cand in candidates:
+        key = _norm_key(cand)
+        if key in norm_map:
+            return norm_map[key]
+    # tentativo 2: contains
+    for cand in candidates:
+        ckey = _norm_key(cand)
+        for col in columns:
+            if ckey in _norm_key(col):
+                return col
+    return None
+
+
+def _find_col(df: pd.DataFrame, candidates: List[str]) -> Optional[str]:
+    """Come _find_col_in sulle colonne di df (None se df vuoto)."""
+    if df is None or df.empty:
+        return None
+    return _find_col_in(df.columns, candidates)
+
+
+def _find_col_preferred_in(columns, preferred: List[str], fallback: List[str]) -> Optional[str]:
+    """Cerca prima nelle 'preferred' (in ordine), se non trova usa una delle fallback."""
+    return _risolvi_preferita(_chiave_colonne(columns), tuple(preferred), tuple(fallback))
+
+
+@lru_cache(maxsize=1024)
+def _risolvi_preferita(columns: Tuple[Any, ...], preferred: Tuple[str, ...],
+                       fallback: Tuple[str, ...]) -> Optional[str]:
+    for cand in preferred:
+        col = _find_col_in(columns, [cand])
+        if col:
+            return col
+    return _find_col_in(columns, fallback)
+
+
+def _find_col_preferred(df: pd.DataFrame, preferred: List[str], fallback: List[str]) -> Optional[str]:
+    """Come _find_col_preferred_in sulle colonne di df (None se df vuoto)."""
+    if df is None or df.empty:
+        return None
+    return _find_col_preferred_in(df.columns, preferred, fallback)
+
+
+def _get_any(df: pd.DataFrame, candidates: List[str]) -> pd.Series:
+    """Ritorna la Series della prima colonna trovata tra i candidates; se non c'è, solleva KeyError."""
+    col = _find_col(df, candidates)
+    if not col:
+        raise KeyError(f"Columns not found: {candidates}")
+    return df[col]
+
+
+def _require_any(df: pd.DataFrame, required_map: dict, context: str) -> Tuple[bool, List[str]]:
+    """
+    Verifica che per ogni chiave di required_map almeno una delle colonne candidate esista.
+    Ritorna (ok, missing_list).
+    """
+    missing = []
+    for logical_name, cand_list in required_map.items():
+        if _find_col(df, cand_list) is None:
+            missing.append(logical_name)
+    return (len(missing) == 0, missing)
+
+
+def _avvisa(avvisi: Optional[List[str]], msg: str) -> None:
+    """Registra un avviso nella lista del chiamante (se fornita)."""
+    if avvisi is not None:
+        avvisi.append(msg)
+
+
+def _clean_series_to_list(series: pd.Series) -> List[str]:
+    """
+    Converte in lista di stringhe uniche/ordinate, rimuovendo vuoti.
+    """
+    if series is None or series.empty:
+        return []
+    vals = [str(x).strip() for x in series.dropna().astype(str).tolist()]
+    vals = [v for v in vals if v != ""]
+    # unici e ordinati (case-insensitive)
+    return sorted(list(set(vals)), key=lambda x: x.lower())
+
+
+# limiti della modalità read-only di openpyxl (es. primo foglio non di dati, parti
+# del pacchetto referenziate ma assenti): il file si rilegge per intero. Un file
+# corrotto (BadZipFile, InvalidFileException...) non rientra e fallisce subito.
+_ERRORI_SOLA_LETTURA = (AttributeError, KeyError, ValueError)
+
+
+def _read_excel(uploaded_file, source: Optional[str] = None) -> pd.DataFrame:
+    """
+    Legge un Excel con engine openpyxl; solleva l'eccezione se il file non è leggibile.
+    Con 'source' ("dl", "sm", "mg", "entra", "device") legge in streaming solo le
+    colonne usate per quel file (vedi _read_excel_columns); se non è possibile
+    legge tutto e ne lascia il motivo in df.attrs["lettura_completa"].
+    """
+    motivo = None
+    if source:
+        try:
+            df = _read_excel_columns(uploaded_file, source)
+        except _ERRORI_SOLA_LETTURA as exc:
+            motivo = f"lettura per colonne non riuscita ({type(exc).__name__}: {exc})"
+        else:
+            if df is not None:
+                return df
+            motivo = "nessuna colonna nota nell'intestazione"
+        _rewind(uploaded_file)
+    df = pd.read_excel(uploaded_file, engine="openpyxl")
+    if motivo is not None:
+        df.attrs["lettura_completa"] = motivo
+    return df
+
+
+def _read_excel_or_empty(uploaded_file, source: Optional[str] = None) -> pd.DataFrame:
+    """Come _read_excel; se non presente o errore, ritorna DF vuoto."""
+    if not uploaded_file:
+        return pd.DataFrame()
+    try:
+        return _read_excel(uploaded_file, source)
+    except Exception:
+        return pd.DataFrame()
+
+
+# =========================
+# Candidati colonne EN/IT
+# =========================
+
+# Membri / gruppi (export AD – "Estr_MembriGruppi")
+CAND_MG_MEMBER = [
+    "Member", "Membro",
+    "MemberSamAccountName", "MembroSamAccountName",
+    "SamAccountName", "sAMAccountName",
+    "MemberUserPrincipalName", "UserPrincipalNameMembro",
+    "userPrincipalName", "UPN",
+]
+CAND_MG_GROUP = [
+    "Group", "Gruppo",
+    "GroupName", "NomeGruppo",
+    "DisplayName", "NomeVisualizzato",
+    "cn", "CN", "Name", "Nome"
+]
+
+# Distribution List (DL) file
+# — nome DL preferito = Primary SMTP address (come richiesto)
+CAND_DL_GROUP_ADDR = [
+    "Distribution Group Primary SMTP address",   # preferito
+    "PrimarySmtpAddress", "SMTP", "Email",
+    "GroupName", "DisplayName", "Group", "Gruppo", "NomeGruppo",
+    "Nome", "NomeVisualizzato"
+]
+# — colonna membro con priorità su "Member Alias" (come richiesto)
+CAND_DL_MEMBER = [
+    "Member Alias", "Alias Membro", "MemberAlias",  # richiesto
+    "MemberUserPrincipalName", "UserPrincipalNameMembro",
+    "Member", "Membro",
+    "userPrincipalName", "UPN",
+    "MemberEmail", "EmailMembro", "Email", "E-mail"
+]
+# fallback "generico" per nomi gruppo (riuso funzioni esistenti)
+CAND_DL_GROUP = [
+    "Distribution Group", "Gruppo di distribuzione",
+    "Group", "Gruppo",
+    "GroupName", "NomeGruppo",
+    "DisplayName", "Nome", "NomeVisualizzato"
+]
+
+# Shared Mailbox / SM file
+# — membership via colonna member (incluso "Member")
+CAND_SM_MEMBER = [
+    "MemberUserPrincipalName", "UserPrincipalNameMembro",
+    "Member", "Membro",
+    "userPrincipalName", "UPN",
+    "MemberEmail", "EmailMembro", "Member Mail", "Email"
+]
+# — identificatore casella preferito = EmailAddress (come richiesto)
+CAND_SM_MAILBOX_ADDR = [
+    "EmailAddress",  # preferito
+    "PrimarySmtpAddress", "SMTP", "Email",
+    "DisplayName", "Mailbox", "SharedMailbox",
+    "Cassetta postale", "Casella condivisa"
+]
+# (già presente) gruppo/nome SM fallback generico
+CAND_SM_GROUP_NAME = [
+    "Group", "Gruppo",
+    "DisplayName", "Nome", "NomeVisualizzato",
+    "Mailbox", "SharedMailbox", "Cassetta postale", "Casella condivisa",
+    "PrimarySmtpAddress", "SMTP", "Email"
+]
+
+# Entra (gruppi utente)
+CAND_ENTRA_MEMBER_UPN = [
+    "MemberUserPrincipalName", "UserPrincipalNameMembro",
+    "userPrincipalName", "UPN",
+    "Email", "E-mail"
+]
+CAND_ENTRA_GROUP_NAME = [
+    "GroupName", "NomeGruppo",
+    "DisplayName", "Nome", "NomeVisualizzato",
+    "Group", "Gruppo"
+]
+
+# Stato dell'account membro, facoltativo (es. Enabled di Get-ADUser nell'export MG,
+# AccountEnabled nell'export Entra): usato solo dal report membri per gruppo
+CAND_MEMBER_ENABLED = ["MemberEnabled", "MembroAbilitato", "AccountEnabled", "Enabled", "Abilitato"]
+
+# Device export
+CAND_DEV_ENABLED = ["Enabled", "Abilitato"]
+CAND_DEV_DESC = ["Description", "Descrizione"]
+CAND_DEV_NAME = ["Name", "Nome", "Computer", "NomeComputer"]
+CAND_DEV_MAIL = ["Mail", "Email", "E-mail", "Posta"]
+CAND_DEV_MOBILE = ["Mobile", "Cellulare", "Telefono", "Phone"]
+CAND_DEV_UPN = ["userPrincipalName", "UPN", "NomePrincipaleUtente"]
+
+# Gruppi Entra mai proposti per la rimozione (minuscolo)
+ENTRA_ESCLUSIONI = frozenset({"o365 copilot plus", "o365 teams premium"})
+
+# Nomi gruppo "generici" (extract_group_names_from_df)
+CAND_GROUP_NAME_ANY = CAND_DL_GROUP + CAND_MG_GROUP + CAND_SM_GROUP_NAME
+CAND_GROUP_NAME_FALLBACK = ["Name", "Nome", "DisplayName", "NomeVisualizzato"]
+
+
+# =====================================================
+# Loader Excel in streaming con le sole colonne usate
+# =====================================================
+
+def _col_nomi_gruppo(columns) -> Optional[str]:
+    """Colonna dei nomi gruppo 'generici': group name esplicito, altrimenti 'name'/'nome'."""
+    return _find_col_in(columns, CAND_GROUP_NAME_ANY) or _find_col_in(columns, CAND_GROUP_NAME_FALLBACK)
+
+
+# Ruoli delle colonne per export: (ruolo, risolutore sulle colonne, candidati, obbligatoria).
+# I risolutori sono gli stessi usati dalle funzioni che leggono le colonne.
+_RUOLI_COLONNE: Dict[str, List[Tuple[str, Callable[[Any], Optional[str]], List[str], bool]]] = {
+    "mg": [
+        ("membro", lambda c: _find_col_in(c, CAND_MG_MEMBER), CAND_MG_MEMBER, True),
+        ("gruppo", lambda c: _find_col_in(c, CAND_MG_GROUP), CAND_MG_GROUP, True),
+        ("nomi gruppo", _col_nomi_gruppo, CAND_GROUP_NAME_ANY + CAND_GROUP_NAME_FALLBACK, False),
+        ("stato membro", lambda c: _find_col_in(c, CAND_MEMBER_ENABLED), CAND_MEMBER_ENABLED, False),
+    ],
+    "dl": [
+        ("membro", lambda c: _find_col_in(c, CAND_DL_MEMBER), CAND_DL_MEMBER, True),
+        ("gruppo", lambda c: _find_col_preferred_in(c, CAND_DL_GROUP_ADDR, CAND_DL_GROUP),
+         CAND_DL_GROUP_ADDR + CAND_DL_GROUP, True),
+        ("nomi gruppo", _col_nomi_gruppo, CAND_GROUP_NAME_ANY + CAND_GROUP_NAME_FALLBACK, False),
+    ],
+    "sm": [
+        ("membro", lambda c: _find_col_in(c, CAND_SM_MEMBER), CAND_SM_MEMBER, True),
+        ("casella", lambda c: _find_col_preferred_in(c, CAND_SM_MAILBOX_ADDR, CAND_SM_GROUP_NAME),
+         CAND_SM_MAILBOX_ADDR + CAND_SM_GROUP_NAME, True),
+        ("nomi gruppo", _col_nomi_gruppo, CAND_GROUP_NAME_ANY + CAND_GROUP_NAME_FALLBACK, False),
+    ],
+    "entra": [
+        ("membro", lambda c: _find_col_in(c, CAND_ENTRA_MEMBER_UPN), CAND_ENTRA_MEMBER_UPN, True),
+        ("gruppo", lambda c: _find_col_in(c, CAND_ENTRA_GROUP_NAME), CAND_ENTRA_GROUP_NAME, True),
+        ("stato membro", lambda c: _find_col_in(c, CAND_MEMBER_ENABLED), CAND_MEMBER_ENABLED, False),
+    ],
+    "device": [
+        ("abilitato", lambda c: _find_col_in(c, CAND_DEV_ENABLED), CAND_DEV_ENABLED, True),
+        ("descrizione", lambda c: _find_col_in(c, CAND_DEV_DESC), CAND_DEV_DESC, True),
+        ("nome", lambda c: _find_col_in(c, CAND_DEV_NAME), CAND_DEV_NAME, True),
+        ("mail", lambda c: _find_col_in(c, CAND_DEV_MAIL), CAND_DEV_MAIL, False),
+        ("cellulare", lambda c: _find_col_in(c, CAND_DEV_MOBILE), CAND_DEV_MOBILE, False),
+        ("upn", lambda c: _find_col_in(c, CAND_DEV_UPN), CAND_DEV_UPN, False),
+    ],
+}
+
+
+@dataclass(frozen=True)
+class SchemaColonne:
+    """
+    Colonne di un export risolte una volta dall'intestazione (vedi schema_colonne):
+    ruolo -> colonna scelta (None se assente), ruoli obbligatori senza colonna e
+    ruoli ambigui, cioè risolti per somiglianza ('contains') quando più colonne
+    del file corrispondono ai candidati.
+    """
+    source: str
+    colonne: Tuple[Any, ...]
+    ruoli: Dict[str, Optional[str]]
+    mancanti: Tuple[str, ...]
+    ambigue: Dict[str, Tuple[str, ...]]
+
+    def usate(self) -> List[str]:
+        """Colonne lette dal codice, nell'ordine del file e senza duplicati."""
+        wanted = {c for c in self.ruoli.values() if c}
+        return [c for c in self.colonne if c in wanted]
+
+    def avvisi(self) -> List[str]:
+        """Colonne mancanti o ambigue, come messaggi per l'operatore."""
+        etichetta = ETICHETTE_SORGENTI.get(self.source, self.source)
+        msgs = [f"{etichetta}: colonna '{ruolo}' non trovata" for ruolo in self.mancanti]
+        for ruolo, altre in self.ambigue.items():
+            msgs.append(f"{etichetta}: colonna '{ruolo}' ambigua, scelta '{self.ruoli[ruolo]}' "
+                        f"(corrispondono anche: {', '.join(map(str, altre))})")
+        return msgs
+
+
+def _alternative(columns: Tuple[Any, ...], candidati: List[str], scelta: str) -> Tuple[str, ...]:
+    """Altre colonne che corrispondono ai candidati, se 'scelta' non è un match esatto."""
+    chiavi = {_norm_key(c) for c in candidati}
+    if _norm_key(scelta) in chiavi:
+        return ()
+    return tuple(c for c in columns if c != scelta and any(k in _norm_key(c) for k in chiavi))
+
+
+@lru_cache(maxsize=256)
+def _schema(source: str, columns: Tuple[Any, ...]) -> SchemaColonne:
+    if source not in _RUOLI_COLONNE:
+        raise ValueError(f"Sorgente sconosciuta: {source}")
+    ruoli: Dict[str, Optional[str]] = {}
+    mancanti: List[str] = []
+    ambigue: Dict[str, Tuple[str, ...]] = {}
+    for ruolo, risolvi, candidati, obbligatoria in _RUOLI_COLONNE[source]:
+        col = ruoli[ruolo] = risolvi(columns)
+        if col is None:
+            if obbligatoria:
+                mancanti.append(ruolo)
+            continue
+        altre = _alternative(columns, candidati, col)
+        if altre:
+            ambigue[ruolo] = altre
+    return SchemaColonne(source, columns, ruoli, tuple(mancanti), ambigue)
+
+
+def schema_colonne(source: str, columns) -> SchemaColonne:
+    """Schema delle colonne di un export 'source' (chiavi in SORGENTI), memorizzato per intestazione."""
+    return _schema(source, _chiave_colonne(columns))
+
+
+def _colonne_usate(source: str, columns: List[str]) -> List[str]:
+    """
+    Colonne di 'columns' effettivamente lette dal codice per il file 'source',
+    risolte con gli stessi candidati EN/IT delle funzioni che le usano.
+    """
+    return schema_colonne(source, columns).usate()
+
+
+def _intestazioni_pandas(raw_header) -> List[str]:
+    """Intestazioni come le produrrebbe pd.read_excel (Unnamed: i, duplicati .1, .2...)."""
+    header: List[str] = []
+    seen: Dict[Any, int] = {}
+    for i, h in enumerate(raw_header):
+        # celle vuote (None anche se scritte come ""); pandas lascia invariati gli spazi
+        name = f"Unnamed: {i}" if h is None or h == "" else h
+        if name in seen:
+            seen[name] += 1
+            name = f"{name}.{seen[name]}"
+        seen.setdefault(name, 0)
+        header.append(name)
+    return header
+
+
+def _rewind(uploaded_file) -> None:
+    if hasattr(uploaded_file, "seek"):
+        uploaded_file.seek(0)
+
+
+def _read_excel_columns(uploaded_file, source: str) -> Optional[pd.DataFrame]:
+    """
+    Legge il primo foglio in modalità read-only: prima solo la riga di intestazione,
+    poi, in streaming, le sole colonne usate per 'source' come stringhe.
+    Ritorna None se nessuna colonna nota è presente (il chiamante rilegge tutto,
+    così la diagnostica delle colonne mancanti resta invariata).
+    Le intestazioni originali restano in df.attrs["colonne_originali"].
+    """
+    from openpyxl import load_workbook
+
+    _rewind(uploaded_file)
+    wb = load_workbook(uploaded_file, read_only=True, data_only=True)
+    try:
+        ws = wb.worksheets[0]
+        rows = ws.iter_rows(values_only=True)
+        raw_header = next(rows, None)
+        if raw_header is None:
+            return pd.DataFrame()
+        header = _intestazioni_pandas(raw_header)
+        usate = _colonne_usate(source, header)
+        if not usate:
+            return None
+        positions = [header.index(c) for c in usate]
+        data: List[List[Any]] = [[] for _ in usate]
+        for row in ws.iter_rows(min_row=2, max_col=max(positions) + 1, values_only=True):
+            values = [row[p] if p < len(row) else None for p in positions]
+            if all(v is None for v in values):
+                continue
+            for col_data, v in zip(data, values):
+                col_data.append(float("nan") if v is None else str(v))
+    finally:
+        wb.close()
+    df = pd.DataFrame({c: pd.Series(d, dtype=object) for c, d in zip(usate, data)})
+    df.attrs["colonne_originali"] = header
+    return df
+
+
+# ======================================
+# Loader CSV/TSV (anche .gz) a blocchi
+# ======================================
+
+# Estensioni accettate dagli uploader degli export
+TIPI_EXPORT = ["xlsx", "csv", "tsv", "txt", "gz"]
+# Righe per blocco nella lettura CSV
+CSV_CHUNK_ROWS = 200_000
+
+_GZIP_MAGIC = b"\x1f\x8b"
+_XLSX_MAGIC = b"PK\x03\x04"
+
+
+def _apri_binario(raw: bytes):
+    """Stream binario sul contenuto, decompresso al volo se gzip."""
+    stream = io.BytesIO(raw)
+    if raw[:2] == _GZIP_MAGIC:
+        return gzip.GzipFile(fileobj=stream)
+    return stream
+
+
+def _csv_dialetto(raw: bytes) -> Tuple[str, str, int]:
+    """
+    Ritorna (encoding, separatore, righe da saltare) guardando l'inizio del file:
+    BOM UTF-8/UTF-16 degli export PowerShell, riga '#TYPE' di Export-Csv,
+    separatore tra , ; TAB | più frequente nell'intestazione.
+    """
+    with _apri_binario(raw) as stream:
+        head = stream.read(64 * 1024)
+    if head.startswith((codecs.BOM_UTF16_LE, codecs.BOM_UTF16_BE)):
+        encoding = "utf-16"
+    elif head.startswith(codecs.BOM_UTF8):
+        encoding = "utf-8-sig"
+    else:
+        try:
+            head[:head.rfind(b"\n") + 1 or len(head)].decode("utf-8")
+            encoding = "utf-8"
+        except UnicodeDecodeError:
+            encoding = "cp1252"
+    lines = head.decode(encoding, errors="replace").lstrip("\ufeff").splitlines() or [""]
+    skip = 1 if lines[0].startswith("#TYPE") else 0
+    first = lines[skip] if len(lines) > skip else ""
+    sep = max([",", ";", "\t", "|"], key=first.count)
+    return encoding, sep, skip
+
+
+def _intestazioni_csv(raw: bytes) -> Tuple[List[str], Dict[str, Any]]:
+    """Intestazioni di un export CSV/TSV (anche .gz) e opzioni di lettura, senza leggere le righe."""
+    encoding, sep, skip = _csv_dialetto(raw)
+    opts = dict(sep=sep, encoding=encoding, skiprows=skip)
+    with _apri_binario(raw) as stream:
+        header = pd.read_csv(stream, nrows=0, **opts).columns.tolist()
+    return header, opts
+
+
+def _read_csv_columns(raw: bytes, source: Optional[str] = None) -> pd.DataFrame:
+    """
+    Legge un export CSV/TSV (eventualmente gzip) a blocchi, con tutte le colonne
+    come stringhe. Con 'source' legge solo le colonne usate per quel file
+    (stessi candidati EN/IT del loader Excel); se nessuna è presente legge tutto.
+    Oltre il primo blocco ogni blocco diventa categorico appena letto: in memoria
+    restano i codici e le stringhe distinte, non tutti i blocchi più la copia unita.
+    """
+    header, opts = _intestazioni_csv(raw)
+    usate = _colonne_usate(source, header) if source else []
+    usecols = [header.index(c) for c in usate] if usate else None
+    blocchi: List[pd.DataFrame] = []
+    with _apri_binario(raw) as stream:
+        for blocco in pd.read_csv(stream, dtype=str, usecols=usecols, chunksize=CSV_CHUNK_ROWS, **opts):
+            if len(blocchi) == 1:
+                blocchi[0] = blocchi[0].astype("category")
+            blocchi.append(blocco.astype("category") if blocchi else blocco)
+    if not blocchi:
+        df = pd.DataFrame(columns=usate or header)
+    elif len(blocchi) == 1:
+        df = blocchi[0]
+    else:
+        df = _unisci_blocchi(blocchi)
+    df.attrs["colonne_originali"] = header
+    return df
+
+
+def _unisci_blocchi(blocchi: List[pd.DataFrame]) -> pd.DataFrame:
+    """
+    Unisce i blocchi categorici di un CSV colonna per colonna; le colonne con
+    troppi valori distinti (vedi _compatta) tornano testo, come in una lettura unica.
+    """
+    colonne: Dict[Any, pd.Series] = {}
+    for col in blocchi[0].columns:
+        unita = pd.Series(union_categoricals([b[col] for b in blocchi], sort_categories=True))
+        if len(unita) and len(unita.cat.categories) > QUOTA_CATEGORICA * len(unita):
+            unita = unita.astype(unita.cat.categories.dtype)
+        colonne[col] = unita
+    return pd.DataFrame(colonne, columns=blocchi[0].columns)
+
+
+def _read_export(uploaded_file, source: Optional[str] = None) -> pd.DataFrame:
+    """
+    Legge un export Excel (.xlsx) o CSV/TSV (anche .gz), riconosciuto dal contenuto;
+    solleva l'eccezione se il file non è leggibile.
+    """
+    raw = uploaded_file.getvalue()
+    if raw[:4] == _XLSX_MAGIC:
+        return _compatta(_read_excel(uploaded_file, source))
+    return _compatta(_read_csv_columns(raw, source))
+
+
+# sotto questa quota di valori distinti per riga una colonna di testo diventa categorica
+QUOTA_CATEGORICA = 0.5
+
+
+def _compatta(df: pd.DataFrame) -> pd.DataFrame:
+    """
+    Converte in categoriche le colonne di testo con molti valori ripetuti
+    (membri, nomi gruppo, flag): ogni stringa distinta è memorizzata una volta
+    e le righe contengono solo codici interi. I valori non cambiano.
+    """
+    for col in df.columns:
+        serie = df[col]
+        if not (pd.api.types.is_object_dtype(serie) or pd.api.types.is_string_dtype(serie)):
+            continue
+        if len(serie) and serie.nunique(dropna=True) <= QUOTA_CATEGORICA * len(serie):
+            df[col] = serie.astype("category")
+    return df
+
+
+def _read_export_or_empty(uploaded_file, source: Optional[str] = None) -> pd.DataFrame:
+    """Come _read_export; se non presente o errore, ritorna DF vuoto."""
+    if not uploaded_file:
+        return pd.DataFrame()
+    try:
+        return _read_export(uploaded_file, source)
+    except Exception:
+        return pd.DataFrame()
+
+
+# ==========================================
+# Motori di calcolo per le operazioni su testo
+# ==========================================
+
+# separatori dei membri multipli nella stessa cella (DL/SM)
+_SEP_MEMBRI = r"[;,\s]+"
+# separatore dei segmenti della Description dei PC (" - <sam> - ")
+_SEP_DESCRIZIONE = r"\s-\s"
+# indirizzo email: parte locale e dominio
+_RE_EMAIL = r"^(?P<locale>[^@]+)@(?P<dominio>[^@]+)$"
+
+# caratteri per cui str.isspace() è vero (\s di re): tutti sotto U+3001
+_SPAZI = "".join(c for c in map(chr, range(0x3001)) if c.isspace())
+
+
+class MotorePandas:
+    """
+    Operazioni su testo usate da indici e tabella identità (normalizzazione,
+    divisione, email), con i metodi .str di pandas: è il riferimento, gli
+    altri motori producono gli stessi valori. I valori mancanti restano
+    mancanti e non producono parti.
+    """
+
+    nome = "pandas"
+
+    def testo(self, valori, strip: bool = True, minuscolo: bool = False) -> np.ndarray:
+        """Valori come stringhe (str), con strip e/o minuscolo."""
+        s = pd.Series(valori, dtype=object).astype(str)
+        if strip:
+            s = s.str.strip()
+        if minuscolo:
+            s = s.str.lower()
+        return s.to_numpy(dtype=object)
+
+    def dividi(self, valori, separatore: str) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Parti dei valori divisi dall'espressione 'separatore': (righe, parti),
+        con righe[i] la posizione del valore da cui viene parti[i], in ordine.
+        """
+        parti = pd.Series(valori, dtype=object).reset_index(drop=True).str.split(separatore, regex=True).explode()
+        parti = parti[parti.notna()]
+        return parti.index.to_numpy(dtype=np.int64), parti.to_numpy(dtype=object)
+
+    def email(self, valori) -> Tuple[np.ndarray, np.ndarray]:
+        """(locale, dominio) degli indirizzi; NaN dove il valore non è un indirizzo."""
+        parti = pd.Series(valori, dtype=object).str.extract(_RE_EMAIL)
+        return parti["locale"].to_numpy(dtype=object), parti["dominio"].to_numpy(dtype=object)
+
+
+def _re2(pattern: str) -> str:
+    """Espressione re in sintassi RE2 (Arrow): \\s diventa l'elenco esplicito degli spazi di Python."""
+    spazi = "".join(f"\\x{{{ord(c):x}}}" for c in _SPAZI)
+    out, in_classe, i = [], False, 0
+    while i < len(pattern):
+        if pattern.startswith(r"\s", i):
+            out.append(spazi if in_classe else f"[{spazi}]")
+            i += 2
+            continue
+        if pattern[i] == "\\":
+            out.append(pattern[i:i + 2])
+            i += 2
+            continue
+        in_classe = (in_classe and pattern[i] != "]") or (not in_classe and pattern[i] == "[")
+        out.append(pattern[i])
+        i += 1
+    return "".join(out)
+
+
+class MotoreArrow(MotorePandas):
+    """
+    Stesse operazioni con i kernel di pyarrow.compute (C++, senza GIL: le
+    letture in thread procedono in parallelo), senza passare da oggetti Python
+    riga per riga. Strip e minuscolo sono quelli che pandas usa per le colonne
+    str con pyarrow; nelle espressioni \\s sono gli spazi di Python, come in re.
+    """
+
+    nome = "arrow"
+
+    def __init__(self):
+        import pyarrow as pa
+        import pyarrow.compute as pc
+        self.pa, self.pc = pa, pc
+        self._pattern: Dict[str, str] = {}
+
+    def _stringhe(self, valori):
+        """Array Arrow di stringhe: le colonne str di pandas passano senza copie."""
+        if not isinstance(valori, pd.Series):
+            valori = pd.Series(valori, dtype=object)
+        if valori.dtype == object and pd.api.types.infer_dtype(valori, skipna=True) in ("string", "empty"):
+            arr = self.pa.array(valori, type=self.pa.string(), from_pandas=True)
+        else:
+            # categorie, numeri, date: stessa conversione str del motore pandas
+            if not isinstance(valori.dtype, pd.StringDtype):
+                valori = valori.astype(str)
+            arr = self.pa.array(valori.array)
+        return arr.combine_chunks() if isinstance(arr, self.pa.ChunkedArray) else arr
+
+    def _re(self, pattern: str) -> str:
+        if pattern not in self._pattern:
+            self._pattern[pattern] = _re2(pattern)
+        return self._pattern[pattern]
+
+    def testo(self, valori, strip: bool = True, minuscolo: bool = False) -> np.ndarray:
+        arr = self._stringhe(valori)
+        if strip:
+            arr = self.pc.utf8_trim_whitespace(arr)
+        if minuscolo:
+            arr = self.pc.utf8_lower(arr)
+        return arr.to_numpy(zero_copy_only=False)
+
+    def dividi(self, valori, separatore: str) -> Tuple[np.ndarray, np.ndarray]:
+        pc = self.pc
+        liste = pc.split_pattern_regex(self._stringhe(valori), pattern=self._re(separatore))
+        righe = pc.list_parent_indices(liste).to_numpy(zero_copy_only=False).astype(np.int64)
+        return righe, pc.list_flatten(liste).to_numpy(zero_copy_only=False)
+
+    def email(self, valori) -> Tuple[np.ndarray, np.ndarray]:
+        parti = self.pc.extract_regex(self._stringhe(valori), pattern=self._re(_RE_EMAIL))
+        # nessuna corrispondenza: NaN come str.extract
+        return tuple(pd.Series(campo.to_numpy(zero_copy_only=False), dtype=object).fillna(np.nan).to_numpy()
+                     for campo in parti.flatten())
+
+
+# motori selezionabili; quelli con dipendenze mancanti non sono disponibili
+MOTORI: Dict[str, Callable[[], MotorePandas]] = {"pandas": MotorePandas, "arrow": MotoreArrow}
+
+# motore predefinito del processo (vedi imposta_motore)
+_motore: MotorePandas = MotorePandas()
+# motore del lavoro in corso nel thread/contesto corrente (vedi usa_motore): ha la precedenza
+_motore_lavoro: "ContextVar[Optional[MotorePandas]]" = ContextVar("motore_lavoro", default=None)
+
+
+def motori_disponibili() -> List[str]:
+    """Nomi dei motori utilizzabili in questo ambiente (pandas sempre)."""
+    disponibili = []
+    for nome, classe in MOTORI.items():
+        try:
+            classe()
+        except ImportError:
+            continue
+        disponibili.append(nome)
+    return disponibili
+
+
+@lru_cache(maxsize=None)
+def _istanza_motore(nome: str) -> MotorePandas:
+    """Istanza (condivisa, senza stato) del motore 'nome'; ValueError se sconosciuto o non disponibile."""
+    if nome not in MOTORI:
+        raise ValueError(f"Motore sconosciuto: {nome} (ammessi: {', '.join(MOTORI)})")
+    try:
+        return MOTORI[nome]()
+    except ImportError as exc:
+        raise ValueError(f"Motore {nome} non disponibile: {exc}") from exc
+
+
+def imposta_motore(nome: str) -> MotorePandas:
+    """
+    Sceglie il motore predefinito delle operazioni su testo per tutto il
+    processo (i risultati non cambiano, solo i tempi): per CLI, servizio e
+    benchmark, che ne usano uno solo. ValueError se sconosciuto o non
+    disponibile. Per un singolo lavoro in un processo condiviso vedi usa_motore.
+    """
+    global _motore
+    _motore = _istanza_motore(nome)
+    return _motore
+
+
+@contextmanager
+def usa_motore(nome: str):
+    """
+    Motore 'nome' per il solo blocco e il solo contesto corrente (thread o task):
+    lavori concorrenti nello stesso processo, come le sessioni dell'app, possono
+    usare motori diversi senza toccare quello predefinito.
+    """
+    token = _motore_lavoro.set(_istanza_motore(nome))
+    try:
+        yield _motore_lavoro.get()
+    finally:
+        _motore_lavoro.reset(token)
+
+
+def motore() -> MotorePandas:
+    """Motore corrente: quello del blocco usa_motore in corso, altrimenti il predefinito."""
+    return _motore_lavoro.get() or _motore
+
+
+# =============================================
+# Indice invertito membro -> gruppi (per file)
+# =============================================
+
+
+def _codifica(series: pd.Series, minuscolo: bool = False) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Codici interi per riga e valori distinti normalizzati (strip, eventualmente
+    minuscolo) di una colonna. La normalizzazione è fatta sui soli valori
+    distinti, non riga per riga; vuoti e mancanti hanno codice -1.
+    """
+    codes, uniques = pd.factorize(series, use_na_sentinel=True)
+    norm = motore().testo(np.asarray(uniques, dtype=object), minuscolo=minuscolo)
+    remap, valori = pd.factorize(norm)
+    remap = np.where(norm == "", -1, remap)
+    # l'ultimo elemento serve ai codici -1 (mancanti), che restano -1
+    remap = np.append(remap, -1).astype(np.int64)
+    return remap[codes], np.asarray(valori, dtype=object)
+
+
+def coppie_membri(df: pd.DataFrame, member_col: str, group_col: str, explode: bool = False,
+                  pesi: Optional[np.ndarray] = None
+                  ) -> Tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Appartenenze codificate una volta per file: ritorna (membri, gruppi,
+    codici_membro, codici_gruppo, conteggi), dove membri/gruppi sono i valori
+    distinti normalizzati (membri strip + minuscolo, gruppi strip) e ogni coppia
+    di interi, senza vuoti, compare una volta con il numero di righe che la
+    producono (pesate con 'pesi', se indicati: serve agli aggiornamenti per
+    differenza). Con explode=True le celle con più membri separati da ; , o
+    spazi diventano una coppia per membro.
+    """
+    m_codes, membri = _codifica(df[member_col], minuscolo=True)
+    g_codes, gruppi = _codifica(df[group_col])
+    w = np.ones(len(df), dtype=np.int64) if pesi is None else np.asarray(pesi, dtype=np.int64)
+    keep = (m_codes >= 0) & (g_codes >= 0)
+    coppie = pd.DataFrame({"m": m_codes[keep], "g": g_codes[keep], "w": w[keep]})
+
+    if explode:
+        # si divide ogni membro distinto una volta sola, poi si rimappano le righe
+        righe, parti = motore().dividi(membri, _SEP_MEMBRI)
+        piene = parti != ""
+        nuovi, membri = pd.factorize(parti[piene])
+        membri = np.asarray(membri, dtype=object)
+        # stesso membro ripetuto nella stessa cella: conta una volta
+        mappa = pd.DataFrame({"m": righe[piene], "nuovo": nuovi}).drop_duplicates()
+        coppie = coppie.merge(mappa, on="m")[["nuovo", "g", "w"]].rename(columns={"nuovo": "m"})
+
+    conteggi = coppie.groupby(["m", "g"], sort=False)["w"].sum()
+    conteggi = conteggi[conteggi != 0]
+    return (membri, gruppi,
+            conteggi.index.get_level_values("m").to_numpy(dtype=np.int64),
+            conteggi.index.get_level_values("g").to_numpy(dtype=np.int64),
+            conteggi.to_numpy(dtype=np.int64))
+
+
+def tabella_membri(df: pd.DataFrame, member_col: str, group_col: str, explode: bool = False) -> pd.DataFrame:
+    """
+    Tabella lunga (member, group) normalizzata una volta per file: membri strip +
+    minuscolo, gruppi strip, senza vuoti né duplicati, come colonne categoriche
+    (ogni valore distinto è memorizzato una volta). Vedi coppie_membri.
+    """
+    membri, gruppi, m, g, _ = coppie_membri(df, member_col, group_col, explode=explode)
+    return pd.DataFrame({
+        "member": pd.Categorical.from_codes(m, categories=pd.Index(membri, dtype=object)),
+        "group": pd.Categorical.from_codes(g, categories=pd.Index(gruppi, dtype=object)),
+    })
+
+
+def _estendi_vocabolario(vocab: np.ndarray, posizioni: Dict[str, int],
+                         nuovi: np.ndarray) -> Tuple[np.ndarray, Dict[str, int], np.ndarray]:
+    """
+    Aggiunge a 'vocab' (con 'posizioni' valore -> codice) i valori mancanti di
+    'nuovi', pochi rispetto al vocabolario; ritorna vocabolario e posizioni
+    (copiati solo se estesi) e i codici di 'nuovi'.
+    """
+    codici = np.array([posizioni.get(v, -1) for v in nuovi], dtype=np.int64)
+    mancanti = np.flatnonzero(codici < 0)
+    if len(mancanti) == 0:
+        return vocab, posizioni, codici
+    codici[mancanti] = len(vocab) + np.arange(len(mancanti))
+    posizioni = dict(posizioni)
+    posizioni.update({nuovi[i]: int(codici[i]) for i in mancanti})
+    return np.concatenate([vocab, np.asarray(nuovi, dtype=object)[mancanti]]), posizioni, codici
+
+
+def _rango_gruppi(gruppi: np.ndarray) -> np.ndarray:
+    """Posizione di ogni gruppo nell'ordine di lookup (minuscolo, poi originale)."""
+    ordine = np.array(sorted(range(len(gruppi)), key=lambda i: (gruppi[i].lower(), gruppi[i])), dtype=np.int64)
+    rango = np.empty(len(gruppi), dtype=np.int64)
+    rango[ordine] = np.arange(len(gruppi))
+    return rango
+
+
+def chiave_gruppo(nome: Any) -> str:
+    """Nome di gruppo normalizzato per il confronto (strip + minuscolo), vedi membri_di."""
+    return str(nome).strip().lower()
+
+
+class MembershipIndex:
+    """
+    Indice membro -> gruppi costruito una sola volta per file caricato.
+    I nomi dei gruppi sono memorizzati una volta (self.gruppi, in ordine
+    case-insensitive); per ogni membro normalizzato (strip + minuscolo) c'è
+    l'intervallo dei suoi codici gruppo, ordinati, in un unico array di interi:
+    ogni ricerca per utente è un accesso a dizionario e l'unione tra più
+    identificativi dello stesso utente è un'operazione su interi.
+    Le coppie codificate, con il numero di righe che le producono, sono tenute
+    nello stesso ordine e permettono di aggiornare l'indice per differenza
+    (vedi aggiorna).
+    """
+
+    def __init__(self, vocab_membri: np.ndarray, vocab_gruppi: np.ndarray, coppie_m: np.ndarray,
+                 coppie_g: np.ndarray, conteggi: np.ndarray, member_col: str, group_col: str,
+                 explode: bool = False, rango: Optional[np.ndarray] = None,
+                 membri: Optional[Dict[str, int]] = None):
+        self.vocab_membri = vocab_membri
+        self.vocab_gruppi = vocab_gruppi
+        self.member_col = member_col
+        self.group_col = group_col
+        self.explode = explode
+        # codice membro -> posizione nel vocabolario (riusato e solo esteso dagli aggiornamenti)
+        self.membri = membri if membri is not None else {v: i for i, v in enumerate(vocab_membri)}
+        self.rango = rango if rango is not None else _rango_gruppi(vocab_gruppi)
+        # coppie in ordine di lookup: membro, poi gruppo case-insensitive
+        ordine = np.lexsort((self.rango[coppie_g], coppie_m)) if rango is None else slice(None)
+        self.coppie_m = coppie_m[ordine]
+        self.coppie_g = coppie_g[ordine]
+        self.conteggi = conteggi[ordine]
+        self._compila()
+
+    def _compila(self) -> None:
+        """Strutture di lookup dalle coppie ordinate: gruppi in ordine di lookup e intervalli per membro."""
+        ordine_gruppi = np.empty(len(self.rango), dtype=np.int64)
+        ordine_gruppi[self.rango] = np.arange(len(self.rango))
+        self.gruppi = self.vocab_gruppi[ordine_gruppi]
+        per_membro = np.bincount(self.coppie_m, minlength=len(self.vocab_membri))
+        self.offsets = np.concatenate([[0], np.cumsum(per_membro)]).astype(np.int64)
+        self.codici = self.rango[self.coppie_g].astype(np.int32 if len(self.rango) < 2 ** 31 else np.int64)
+        self._n_membri = int(np.count_nonzero(per_membro))
+        self._inverso = None
+
+    @classmethod
+    def from_df(cls, df: pd.DataFrame, member_col: str, group_col: str, explode: bool = False) -> "MembershipIndex":
+        membri, gruppi, m, g, n = coppie_membri(df, member_col, group_col, explode=explode)
+        return cls(membri, gruppi, m, g, n, member_col, group_col, explode)
+
+    def aggiorna(self, aggiunte: pd.DataFrame, pesi_aggiunte: np.ndarray,
+                 rimosse: pd.DataFrame, pesi_rimosse: np.ndarray) -> "MembershipIndex":
+        """
+        Nuovo indice con le righe aggiunte/rimosse (vedi delta_righe) applicate
+        alle coppie: si normalizzano solo le righe cambiate, una coppia resta
+        finché almeno una riga la produce. Se non compaiono gruppi nuovi le coppie
+        restano ordinate e il delta è inserito per ricerca binaria, senza riordinare.
+        L'indice corrente non viene modificato.
+        """
+        vocab_m, membri = self.vocab_membri, self.membri
+        vocab_g, pos_g = self.vocab_gruppi, None
+        dm, dg, dn = [], [], []
+        for delta, pesi, segno in ((aggiunte, pesi_aggiunte, 1), (rimosse, pesi_rimosse, -1)):
+            if delta.empty:
+                continue
+            v_m, v_g, m, g, n = coppie_membri(delta, self.member_col, self.group_col,
+                                              explode=self.explode, pesi=pesi)
+            if pos_g is None:
+                pos_g = {v: i for i, v in enumerate(vocab_g)}
+            vocab_m, membri, mappa_m = _estendi_vocabolario(vocab_m, membri, v_m)
+            vocab_g, pos_g, mappa_g = _estendi_vocabolario(vocab_g, pos_g, v_g)
+            dm.append(mappa_m[m])
+            dg.append(mappa_g[g])
+            dn.append(segno * n)
+        if not dm:
+            return self
+
+        nuovi_gruppi = len(vocab_g) != len(self.vocab_gruppi)
+        rango = _rango_gruppi(vocab_g) if nuovi_gruppi else self.rango
+        G = max(len(vocab_g), 1)
+        chiave = self.coppie_m * G + rango[self.coppie_g]
+        m_old, g_old, n_old = self.coppie_m, self.coppie_g, self.conteggi
+        if nuovi_gruppi:
+            ordine = np.argsort(chiave, kind="stable")
+            chiave, m_old, g_old, n_old = chiave[ordine], m_old[ordine], g_old[ordine], n_old[ordine]
+
+        # delta aggregato per coppia e ordinato come le coppie esistenti
+        d = pd.DataFrame({"m": np.concatenate(dm), "g": np.concatenate(dg), "n": np.concatenate(dn)})
+        d = d.groupby(["m", "g"], sort=False)["n"].sum().reset_index()
+        d_chiave = d["m"].to_numpy() * G + rango[d["g"].to_numpy()]
+        o = np.argsort(d_chiave, kind="stable")
+        d_chiave, d_m, d_g, d_n = d_chiave[o], d["m"].to_numpy()[o], d["g"].to_numpy()[o], d["n"].to_numpy()[o]
+
+        pos = np.searchsorted(chiave, d_chiave)
+        trovate = pos < len(chiave)
+        trovate[trovate] = chiave[pos[trovate]] == d_chiave[trovate]
+        conteggi = n_old.copy()
+        np.add.at(conteggi, pos[trovate], d_n[trovate])
+        nuove = ~trovate & (d_n > 0)
+        m_new = np.insert(m_old, pos[nuove], d_m[nuove])
+        g_new = np.insert(g_old, pos[nuove], d_g[nuove])
+        conteggi = np.insert(conteggi, pos[nuove], d_n[nuove])
+        attive = conteggi > 0
+        return MembershipIndex(vocab_m, vocab_g, m_new[attive], g_new[attive], conteggi[attive],
+                               self.member_col, self.group_col, self.explode, rango=rango, membri=membri)
+
+    def _codici(self, member: str) -> np.ndarray:
+        i = self.membri.get(str(member).strip().lower())
+        if i is None:
+            return self.codici[:0]
+        return self.codici[self.offsets[i]:self.offsets[i + 1]]
+
+    def lookup(self, *members: str) -> List[str]:
+        """Gruppi di uno o più identificativi dello stesso utente (unione, ordinata)."""
+        found = [self._codici(m) for m in members]
+        codici = found[0] if len(found) == 1 else np.unique(np.concatenate(found))
+        return self.gruppi[codici].tolist()
+
+    def __getstate__(self):
+        # la struttura inversa si ricalcola al primo uso: non va ai processi
+        stato = self.__dict__.copy()
+        stato["_inverso"] = None
+        return stato
+
+    def esporta(self) -> Tuple[Dict[str, np.ndarray], Dict[str, Any]]:
+        """Array e metadati che ricostruiscono l'indice (vedi importa), senza oggetti Python."""
+        array = {"coppie_m": self.coppie_m, "coppie_g": self.coppie_g, "conteggi": self.conteggi,
+                 "rango": self.rango}
+        array.update(_testi_in_array("vocab_membri", self.vocab_membri))
+        array.update(_testi_in_array("vocab_gruppi", self.vocab_gruppi))
+        meta = {"member_col": self.member_col, "group_col": self.group_col, "explode": self.explode}
+        return array, meta
+
+    @classmethod
+    def importa(cls, array: Dict[str, np.ndarray], meta: Dict[str, Any]) -> "MembershipIndex":
+        # le coppie sono già in ordine di lookup: con 'rango' il costruttore non riordina
+        return cls(_testi_da_array("vocab_membri", array), _testi_da_array("vocab_gruppi", array),
+                   array["coppie_m"], array["coppie_g"], array["conteggi"],
+                   meta["member_col"], meta["group_col"], meta["explode"], rango=array["rango"])
+
+    def _indice_inverso(self) -> Tuple[Dict[str, List[int]], np.ndarray, np.ndarray]:
+        """
+        Struttura gruppo -> membri, calcolata al primo uso dalle stesse coppie:
+        (nome gruppo normalizzato -> codici nell'ordine di lookup, intervalli per
+        codice gruppo, posizioni dei membri nel vocabolario ordinate per gruppo).
+        """
+        inverso = getattr(self, "_inverso", None)
+        if inverso is None:
+            membro_di_coppia = np.repeat(np.arange(len(self.vocab_membri)), np.diff(self.offsets))
+            ordine = np.argsort(self.codici, kind="stable")
+            per_gruppo = np.bincount(self.codici, minlength=len(self.gruppi))
+            offsets = np.concatenate([[0], np.cumsum(per_gruppo)]).astype(np.int64)
+            nomi: Dict[str, List[int]] = {}
+            for codice, nome in enumerate(self.gruppi):
+                nomi.setdefault(chiave_gruppo(nome), []).append(codice)
+            inverso = self._inverso = (nomi, offsets, membro_di_coppia[ordine])
+        return inverso
+
+    def membri_di(self, *gruppi: str) -> List[str]:
+        """
+        Membri (normalizzati, in ordine alfabetico) di uno o più gruppi, con lo
+        stesso confronto strip + minuscolo sul nome del gruppo.
+        """
+        nomi, offsets, membri = self._indice_inverso()
+        trovati = [membri[offsets[c]:offsets[c + 1]]
+                   for g in gruppi for c in nomi.get(chiave_gruppo(g), [])]
+        if not trovati:
+            return []
+        return sorted(self.vocab_membri[np.unique(np.concatenate(trovati))].tolist())
+
+    def __len__(self) -> int:
+        """Numero di membri con almeno un gruppo."""
+        return self._n_membri
+
+    def nbytes(self) -> int:
+        """Stima approssimativa della memoria occupata (per i limiti della cache)."""
+        total = sys.getsizeof(self.membri) + sum(sys.getsizeof(m) for m in self.vocab_membri)
+        total += self.vocab_gruppi.nbytes + self.gruppi.nbytes + sum(sys.getsizeof(g) for g in self.vocab_gruppi)
+        total += self.coppie_m.nbytes + self.coppie_g.nbytes + self.conteggi.nbytes + self.rango.nbytes
+        inverso = getattr(self, "_inverso", None)
+        if inverso is not None:
+            total += sys.getsizeof(inverso[0]) + inverso[1].nbytes + inverso[2].nbytes
+        return total + self.offsets.nbytes + self.codici.nbytes
+
+
+def _indice_da_df(df: pd.DataFrame, member_col: Optional[str], group_col: Optional[str],
+                  explode: bool = False) -> Optional[MembershipIndex]:
+    if df is None or df.empty or not member_col or not group_col:
+        return None
+    return MembershipIndex.from_df(df, member_col, group_col, explode=explode)
+
+
+def indice_mg(mg_df: pd.DataFrame) -> Optional[MembershipIndex]:
+    """Indice membri per "Estr_MembriGruppi" (None se file vuoto o colonne mancanti)."""
+    if mg_df is None or mg_df.empty:
+        return None
+    return _indice_da_df(mg_df, _find_col(mg_df, CAND_MG_MEMBER), _find_col(mg_df, CAND_MG_GROUP))
+
+
+def indice_dl(dl_df: pd.DataFrame) -> Optional[MembershipIndex]:
+    """Indice membri per il file DL (nome DL = Primary SMTP address, celle multi-membro esplose)."""
+    if dl_df is None or dl_df.empty:
+        return None
+    return _indice_da_df(
+        dl_df,
+        _find_col(dl_df, CAND_DL_MEMBER),
+        _find_col_preferred(dl_df, CAND_DL_GROUP_ADDR, CAND_DL_GROUP),
+        explode=True
+    )
+
+
+def indice_sm(sm_df: pd.DataFrame) -> Optional[MembershipIndex]:
+    """Indice membri per il file SM (nome SM = EmailAddress, celle multi-membro esplose)."""
+    if sm_df is None or sm_df.empty:
+        return None
+    return _indice_da_df(
+        sm_df,
+        _find_col(sm_df, CAND_SM_MEMBER),
+        _find_col_preferred(sm_df, CAND_SM_MAILBOX_ADDR, CAND_SM_GROUP_NAME),
+        explode=True
+    )
+
+
+def indice_entra(entra_df: pd.DataFrame) -> Optional[MembershipIndex]:
+    """Indice membri (UPN/email) per il file Entra."""
+    if entra_df is None or entra_df.empty:
+        return None
+    return _indice_da_df(
+        entra_df,
+        _find_col(entra_df, CAND_ENTRA_MEMBER_UPN),
+        _find_col(entra_df, CAND_ENTRA_GROUP_NAME)
+    )
+
+
+def costruisci_indici(
+    dl_df: pd.DataFrame,
+    sm_df: pd.DataFrame,
+    mg_df: pd.DataFrame,
+    entra_df: pd.DataFrame,
+    device_df: Optional[pd.DataFrame] = None
+) -> Dict[str, Any]:
+    """Costruisce gli indici di tutti i file una volta per caricamento (membri e, se c'è, device)."""
+    return {
+        "dl": indice_dl(dl_df),
+        "sm": indice_sm(sm_df),
+        "mg": indice_mg(mg_df),
+        "entra": indice_entra(entra_df),
+        "device": indice_device(device_df),
+    }
+
+
+# ====================================================
+# Funzione per comporre la stringa di rimozione gruppi
+# ====================================================
+
+# Gruppi AD generici/di default mai proposti (minuscolo)
+GRUPPI_AD_ESCLUSI = frozenset({"domain users", "utenti del dominio"})
+
+
+def estrai_rimozione_gruppi(sam_lower: str, mg_df: pd.DataFrame,
+                            mg_index: Optional[MembershipIndex] = None,
+                            avvisi: Optional[List[str]] = None,
+                            identificativi: Optional[Tuple[str, ...]] = None) -> str:
+    """
+    Ritorna stringa gruppi AD (da "Estr_MembriGruppi") da rimuovere, separata da ';',
+    con esclusioni note (Domain Users/Utenti del dominio).
+    Supporta intestazioni EN/IT. Se 'mg_index' è fornito (vedi costruisci_indici)
+    la ricerca è una lookup sull'indice, senza riscandire il file.
+    Eventuali avvisi (colonne mancanti) sono aggiunti alla lista 'avvisi'.
+    'identificativi' sono le forme note dell'account (vedi TabellaIdentita);
+    senza, si confrontano sAMAccountName e sam@consip.it.
+    """
+    if mg_index is None:
+        if mg_df is None or mg_df.empty:
+            return ""
+
+        required = {
+            "member": CAND_MG_MEMBER,
+            "group": CAND_MG_GROUP
+        }
+        ok, missing = _require_any(mg_df, required, "Estr_MembriGruppi")
+        if not ok:
+            # Se mancano colonne, non blocchiamo l'esecuzione: ritorniamo stringa vuota
+            _avvisa(avvisi, f"Nel file 'Estr_MembriGruppi' non ho trovato i campi: {', '.join(missing)}")
+            return ""
+        mg_index = indice_mg(mg_df)
+
+    # Confronta sia sAMAccountName sia UPN (per tolleranza)
+    groups = mg_index.lookup(*(identificativi or forme_predefinite(sam_lower)))
+
+    # Escludi gruppi generici/di default
+    filtered = [g for g in groups if g.lower() not in GRUPPI_AD_ESCLUSI]
+    if not filtered:
+        return ""
+
+    joined = ";".join(filtered)
+    # Se ci sono spazi, racchiudi l'intera stringa nelle virgolette per sicurezza
+    return f"\"{joined}\"" if any(" " in g for g in filtered) else joined
+
+
+# ==================================================
+# Appartenenze annidate (gruppi membri di altri gruppi)
+# ==================================================
+
+class GrafoGruppi:
+    """
+    Grafo gruppo -> gruppi padre ricavato dall'indice MG: un gruppo è membro di
+    un altro se il suo nome compare come membro (stesso confronto strip +
+    minuscolo degli account). La chiusura transitiva di ogni gruppo è calcolata
+    una volta sola, al primo utente che la richiede, e memorizzata; i cicli
+    (A in B, B in A) sono gestiti calcolando la chiusura per componente
+    fortemente connessa (Tarjan), così un batch di centinaia di utenti visita
+    ogni gruppo al più una volta.
+    """
+
+    def __init__(self, mg_index: MembershipIndex):
+        self.mg_index = mg_index
+        # codici nell'ordine di lookup di mg_index.gruppi -> chiusura (gruppo incluso)
+        self._chiusure: Dict[int, FrozenSet[int]] = {}
+        self._lock = threading.Lock()
+
+    def _padri(self, codice: int) -> np.ndarray:
+        return self.mg_index._codici(self.mg_index.gruppi[codice])
+
+    def _calcola(self, radice: int) -> None:
+        """Tarjan iterativo dai gruppi non ancora calcolati raggiungibili da 'radice'."""
+        chiusure = self._chiusure
+        indice: Dict[int, int] = {}
+        minimo: Dict[int, int] = {}
+        pila: List[int] = []
+        in_pila: Set[int] = set()
+        lavoro = [(radice, iter(self._padri(radice).tolist()))]
+        indice[radice] = minimo[radice] = 0
+        pila.append(radice)
+        in_pila.add(radice)
+        while lavoro:
+            nodo, figli = lavoro[-1]
+            avanzato = False
+            for figlio in figli:
+                if figlio in chiusure:
+                    continue
+                if figlio not in indice:
+                    indice[figlio] = minimo[figlio] = len(indice)
+                    pila.append(figlio)
+                    in_pila.add(figlio)
+                    lavoro.append((figlio, iter(self._padri(figlio).tolist())))
+                    avanzato = True
+                    break
+                if figlio in in_pila:
+                    minimo[nodo] = min(minimo[nodo], indice[figlio])
+            if avanzato:
+                continue
+            lavoro.pop()
+            if lavoro:
+                padre = lavoro[-1][0]
+                minimo[padre] = min(minimo[padre], minimo[nodo])
+            if minimo[nodo] != indice[nodo]:
+                continue
+            # nodo radice di una componente: la chiusura è la componente più le
+            # chiusure (già calcolate) dei padri esterni alla componente
+            componente: List[int] = []
+            while True:
+                x = pila.pop()
+                in_pila.discard(x)
+                componente.append(x)
+                if x == nodo:
+                    break
+            chiusura: Set[int] = set(componente)
+            for x in componente:
+                for padre in self._padri(x).tolist():
+                    if padre in chiusure:
+                        chiusura |= chiusure[padre]
+            chiusura_f = frozenset(chiusura)
+            for x in componente:
+                chiusure[x] = chiusura_f
+
+    def chiusura(self, codici) -> Set[int]:
+        """Unione delle chiusure transitive dei gruppi indicati (codici inclusi)."""
+        risultato: Set[int] = set()
+        with self._lock:
+            for c in codici:
+                if c not in self._chiusure:
+                    self._calcola(c)
+                risultato |= self._chiusure[c]
+        return risultato
+
+    def diretti_ed_ereditati(self, sam_lower: str,
+                             identificativi: Optional[Tuple[str, ...]] = None) -> Tuple[List[str], List[str]]:
+        """
+        Gruppi AD dell'account: diretti (come in estrai_rimozione_gruppi) ed
+        ereditati tramite gruppi annidati, senza i gruppi di default, in ordine
+        case-insensitive.
+        """
+        cercati = identificativi or forme_predefinite(sam_lower)
+        diretti = np.unique(np.concatenate([self.mg_index._codici(i) for i in cercati]))
+        ereditati = sorted(self.chiusura(diretti.tolist()) - set(diretti.tolist()))
+        gruppi = self.mg_index.gruppi
+
+        def _nomi(codici) -> List[str]:
+            return [g for g in gruppi[np.asarray(codici, dtype=np.int64)].tolist() if g.lower() not in GRUPPI_AD_ESCLUSI]
+
+        return _nomi(diretti), _nomi(ereditati)
+
+    def __len__(self) -> int:
+        return len(self._chiusure)
+
+    def nbytes(self) -> int:
+        """Stima della memoria delle chiusure memorizzate (l'indice MG è contato a parte)."""
+        distinte = {id(c): c for c in self._chiusure.values()}
+        return sys.getsizeof(self._chiusure) + sum(sys.getsizeof(c) + 28 * len(c) for c in distinte.values())
+
+
+def grafo_gruppi(mg_index: Optional[MembershipIndex]) -> Optional[GrafoGruppi]:
+    """Grafo dei gruppi annidati dall'indice MG (None se l'export MG non è disponibile)."""
+    return GrafoGruppi(mg_index) if mg_index is not None else None
+
+
+# ======================================================
+# Helper: estrai nomi gruppi "generici" da un DataFrame
+# ======================================================
+
+def extract_group_names_from_df(df: pd.DataFrame) -> Set[str]:
+    """
+    Prova a estrarre nomi di gruppi da dataframe generici (DL/SM/MG).
+    Cerca prima colonne 'GROUP/GROUPNAME/DISPLAYNAME', altrimenti 'NAME/NOME'.
+    """
+    if df is None or df.empty:
+        return set()
+
+    # 1) tenta group name esplicito, 2) fallback su 'name' / 'nome'
+    col = _col_nomi_gruppo(df.columns)
+    if not col:
+        return set()
+    return _valori_unici(df[col])
+
+
+def _valori_unici(series: pd.Series) -> Set[str]:
+    """Valori distinti (strip, senza vuoti) di una colonna, calcolati in modo vettoriale."""
+    # strip sui soli valori distinti (per le colonne categoriche: le categorie)
+    vals = motore().testo(np.asarray(series.dropna().unique(), dtype=object))
+    return {v for v in vals if v != ""}
+
+
+# =======================================================
+# Helper: estrai gruppi Entra per user_email/UPN (EN/IT)
+# =======================================================
+
+def extract_entra_groups_for_user(entra_df: pd.DataFrame, user_email_or_upn: str,
+                                  entra_index: Optional[MembershipIndex] = None,
+                                  avvisi: Optional[List[str]] = None,
+                                  identificativi: Optional[Tuple[str, ...]] = None) -> Set[str]:
+    """
+    Cerca i gruppi Entra a cui l'utente (UPN/email, o una delle sue forme
+    in 'identificativi') appartiene.
+    Supporta intestazioni EN/IT: MemberUserPrincipalName/UserPrincipalNameMembro + GroupName/NomeGruppo/DisplayName
+    """
+    cercati = identificativi or (user_email_or_upn,)
+    if entra_index is not None:
+        return set(entra_index.lookup(*cercati))
+    if entra_df is None or entra_df.empty:
+        return set()
+
+    required = {
+        "member_upn": CAND_ENTRA_MEMBER_UPN,
+        "group_name": CAND_ENTRA_GROUP_NAME
+    }
+    ok, missing = _require_any(entra_df, required, "Entra")
+    if not ok:
+        _avvisa(avvisi, f"Nel file 'Entra' mancano i campi: {', '.join(missing)}")
+        return set()
+
+    return set(indice_entra(entra_df).lookup(*cercati))
+
+
+# =========================================================
+# Funzione testuale di deprovisioning (Step 2) – EN/IT safe
+# =========================================================
+
+def titolo_deprovisioning(sam: str) -> str:
+    """Titolo della richiesta di deprovisioning (Cognome Nome, con suffisso per gli esterni)."""
+    sam_lower = sam.lower().strip()
+    clean = sam_lower.replace(".ext", "")
+    parts = clean.split('.', 1)
+    if sam_lower.endswith(".ext") and len(parts) == 2:
+        nome, cognome = parts
+        return f"[Consip – SR] Casella di posta - Deprovisioning - {cognome.capitalize()} {nome.capitalize()} (esterno)"
+    elif len(parts) == 2:
+        nome, cognome = parts
+        return f"[Consip – SR] Casella di posta - Deprovisioning - {cognome.capitalize()} {nome.capitalize()}"
+    return f"[Consip – SR] Casella di posta - Deprovisioning - {clean}"
+
+
+def calcola_gruppi_gestiti_lower(
+    dl_df: pd.DataFrame,
+    sm_df: pd.DataFrame,
+    mg_df: pd.DataFrame
+) -> FrozenSet[str]:
+    """
+    Insieme (minuscolo) dei gruppi Entra da non proporre: quelli già gestiti
+    tramite DL/MG/SM più le esclusioni note (ENTRA_ESCLUSIONI).
+    Dipende solo dai file, non dall'utente: va calcolato una volta per snapshot
+    (vedi indici_snapshot), così lo scremamento per utente costa solo quanto
+    la lista dei suoi gruppi Entra.
+    """
+    return gruppi_gestiti_da_conteggi(
+        conteggio_nomi_gruppo(dl_df, "dl"),
+        conteggio_nomi_gruppo(sm_df, "sm"),
+        conteggio_nomi_gruppo(mg_df, "mg"),
+    )
+
+
+def conteggio_nomi_gruppo(df: pd.DataFrame, source: str, pesi: Optional[np.ndarray] = None) -> Dict[str, int]:
+    """
+    Righe per nome gruppo (strip + minuscolo) di un file DL/SM/MG: per MG la colonna
+    gruppo, per DL/SM la colonna nome (vedi extract_group_names_from_df).
+    Con 'pesi' (anche negativi) conta le righe di un delta (vedi delta_righe).
+    """
+    if df is None or df.empty:
+        return {}
+    col = _find_col(df, CAND_MG_GROUP) if source == "mg" else _col_nomi_gruppo(df.columns)
+    if not col:
+        return {}
+    codes, valori = _codifica(df[col], minuscolo=True)
+    keep = codes >= 0
+    w = np.ones(len(df), dtype=np.int64) if pesi is None else np.asarray(pesi, dtype=np.int64)
+    somme = np.bincount(codes[keep], weights=w[keep], minlength=len(valori)).astype(np.int64)
+    return {v: int(s) for v, s in zip(valori, somme) if s != 0}
+
+
+def somma_conteggi(base: Dict[str, int], *delta: Dict[str, int]) -> Dict[str, int]:
+    """Somma dei conteggi per nome, senza i nomi rimasti a zero."""
+    risultato = dict(base)
+    for d in delta:
+        for nome, n in d.items():
+            risultato[nome] = risultato.get(nome, 0) + n
+    return {nome: n for nome, n in risultato.items() if n > 0}
+
+
+def gruppi_gestiti_da_conteggi(*conteggi: Dict[str, int]) -> FrozenSet[str]:
+    """Insieme dei gruppi gestiti dai conteggi per nome dei file DL/SM/MG, più ENTRA_ESCLUSIONI."""
+    return frozenset().union(*conteggi) | ENTRA_ESCLUSIONI
+
+
+def genera_deprovisioning(
+    sam: str,
+    dl_df: pd.DataFrame,
+    sm_df: pd.DataFrame,
+    mg_df: pd.DataFrame,
+    entra_df: pd.DataFrame,
+    gruppi_gestiti_lower: Optional[FrozenSet[str]] = None,
+    indici: Optional[Dict[str, Any]] = None,
+    avvisi: Optional[List[str]] = None,
+    strumentazione: Optional["Strumentazione"] = None,
+    identificativi: Optional[Tuple[str, ...]] = None
+) -> List[str]:
+    """
+    Ritorna le righe del testo di deprovisioning per 'sam' (il titolo è
+    titolo_deprovisioning(sam)); gli avvisi sul file Entra vanno in 'avvisi'.
+    Con 'strumentazione' misura i lookup DL/SM e lo scremamento Entra.
+    'gruppi_gestiti_lower' (opzionale) è il risultato di calcola_gruppi_gestiti_lower:
+    in modalità batch viene calcolato una volta sui file completi e riusato.
+    'indici' (opzionale) è il risultato di costruisci_indici: se assente gli
+    indici vengono costruiti dai DataFrame.
+    'identificativi' sono le forme note dell'account (vedi TabellaIdentita),
+    usate per tutti i file; senza, sAMAccountName e sam@consip.it.
+    """
+    indici = indici or {}
+    sam_lower = sam.lower().strip()
+    user_email = f"{sam_lower}@consip.it"
+    identificativi = identificativi or forme_predefinite(sam_lower)
+
+    lines = [f"Ciao,\nper {user_email} :"]
+    warnings: List[str] = []
+    step = 1
+
+    fixed = [
+        "Disabilitare invio ad utente (Message Delivery Restrictions)",
+        "Impostare Hide dalla Rubrica",
+        "Disabilitare accesso Mailbox (Mailbox features – Disable Protocolli/OWA)",
+        f"Estrarre il PST (O365 eDiscovery) da archiviare in \\nasconsip2....\\backuppst\\03 - backup email cancellate\\{user_email} (in z7 con psw condivisa)",
+        "Rimuovere i Ruoli assegnati",
+        "Rimuovere le applicazioni dall’utenza Azure"
+    ]
+    for desc in fixed:
+        lines.append(f"{step}. {desc}")
+        step += 1
+
+    # --- DL (Distribution Lists): rimozione abilitazione
+    dl_list: List[str] = []
+    with _fase(strumentazione, "utente: lookup DL", memoria=False) as fase:
+        dl_index = indici.get("dl")
+        if dl_index is None:
+            dl_index = indice_dl(dl_df)  # nome DL = Primary SMTP address, membro = "Member Alias" o equivalenti
+        if dl_index is not None:
+            # i membri multipli in cella (separati da ; , o spazi) sono già esplosi nell'indice
+            dl_list = dl_index.lookup(*identificativi)
+        fase["righe"] = len(dl_list)
+    if dl_index is None and dl_df is not None and not dl_df.empty:
+        warnings.append("Nel file DL non ho trovato colonne per 'Member Alias/Member' o 'Distribution Group Primary SMTP address'.")
+    if dl_list:
+        lines.append(f"{step}. Rimozione abilitazione dalle DL")
+        for dl in dl_list:
+            lines.append(f"   - {dl}")
+        step += 1
+    else:
+        warnings.append("⚠️ Non sono state trovate DL per l'utente indicato")
+
+    # --- Disabilita account Azure
+    lines.append(f"{step}. Disabilitare l’account di Azure")
+    step += 1
+
+    # --- SM (Shared Mailboxes): rimozione abilitazioni
+    sm_list: List[str] = []
+    with _fase(strumentazione, "utente: lookup SM", memoria=False) as fase:
+        sm_index = indici.get("sm")
+        if sm_index is None:
+            sm_index = indice_sm(sm_df)  # membro = colonna "member", nome SM = EmailAddress
+        if sm_index is not None:
+            # i membri multipli in cella (separati da ; , o spazi) sono già esplosi nell'indice
+            sm_list = sm_index.lookup(*identificativi)
+        fase["righe"] = len(sm_list)
+    if sm_index is None and sm_df is not None and not sm_df.empty:
+        warnings.append("Nel file SM non ho trovato colonne per 'Member' o 'EmailAddress/SMTP'.")
+    if sm_list:
+        lines.append(f"{step}. Rimozione abilitazione da SM")
+        for sm in sm_list:
+            lines.append(f"   - {sm}")
+        step += 1
+    else:
+        warnings.append("⚠️ Non sono state trovate SM profilate all'utente indicato")
+
+    # --- Azure (Entra) gruppi da rimuovere dopo scrematura DL/MG/SM
+    with _fase(strumentazione, "utente: scremamento Entra", memoria=False) as fase:
+        entra_groups = extract_entra_groups_for_user(entra_df, user_email, indici.get("entra"), avvisi,
+                                                     identificativi)
+        if gruppi_gestiti_lower is None:
+            gruppi_gestiti_lower = calcola_gruppi_gestiti_lower(dl_df, sm_df, mg_df)
+
+        # gruppi già gestiti da DL/MG/SM ed esclusioni specifiche note sono nello stesso insieme
+        subset = {g for g in entra_groups if g.lower() not in gruppi_gestiti_lower}
+        fase["righe"] = len(entra_groups)
+
+    if subset:
+        lines.append(f"{step}. Rimozione gruppi Azure:")
+        for g in sorted(subset, key=lambda x: x.lower()):
+            lines.append(f"   - {g}")
+        step += 1
+    else:
+        warnings.append("⚠️ Nessun gruppo Azure (file Entra) da rimuovere dopo lo scremamento con DL/MG/SM")
+
+    final_rest = [
+        "Cancellare la foto da Azure (se applicabile)",
+        "Rimozione Wi-Fi"
+    ]
+    for desc in final_rest:
+        lines.append(f"{step}. {desc}")
+        step += 1
+
+    if warnings:
+        lines.append("\n⚠️ Avvisi:")
+        lines.extend(warnings)
+
+    return lines
+
+
+# ==========================================
+# Funzione per generare CSV Device – EN/IT
+# ==========================================
+
+# valori (minuscoli) delle colonne Enabled letti come abilitato / disabilitato
+_VALORI_VERI = ["true", "1", "yes", "si", "sì"]
+_VALORI_FALSI = ["false", "0", "no"]
+
+
+def _segmenti_descrizione(descrizioni: pd.Series) -> Tuple[np.ndarray, np.ndarray]:
+    """Segmenti (minuscolo) delle Description divise da " - ": (righe, segmenti), vedi MotorePandas.dividi."""
+    m = motore()
+    return m.dividi(m.testo(descrizioni, strip=False, minuscolo=True), _SEP_DESCRIZIONE)
+
+
+def _interni(righe: np.ndarray) -> np.ndarray:
+    """Maschera delle parti né prime né ultime del proprio valore (righe ordinate, vedi dividi)."""
+    cambio = righe[1:] != righe[:-1]
+    return ~np.concatenate([[True], cambio]) & ~np.concatenate([cambio, [True]])
+
+
+def _mask_enabled(enabled_series: pd.Series) -> pd.Series:
+    """Maschera dei device abilitati (valori tipo "True"/"Yes"/"Sì" o booleani nativi)."""
+    # se la colonna è nativa booleana, preserva
+    if enabled_series.dtype == bool:
+        return enabled_series == True
+    # confronto sui soli valori distinti, poi riportato alle righe con i codici
+    codes, valori = _codifica(enabled_series, minuscolo=True)
+    abilitato = np.append(np.isin(valori, _VALORI_VERI), False)
+    return pd.Series(abilitato[codes], index=enabled_series.index)
+
+
+class DeviceIndex:
+    """
+    Indice account -> PC abilitati, costruito una sola volta per export Device.
+    L'account è ricavato dalla Description (" - <sam> - ", case-insensitive);
+    per ogni account i PC sono nell'ordine del file, come tuple
+    (computer, remove_mail, remove_mobile, remove_upn).
+    """
+
+    def __init__(self, devices_by_account: Dict[str, List[Tuple[str, str, str, str]]]):
+        self.devices_by_account = devices_by_account
+
+    @classmethod
+    def from_df(cls, device_df: pd.DataFrame) -> Optional["DeviceIndex"]:
+        """None se mancano le colonne Enabled/Description/Name."""
+        col_enabled = _find_col(device_df, CAND_DEV_ENABLED)
+        col_desc = _find_col(device_df, CAND_DEV_DESC)
+        col_name = _find_col(device_df, CAND_DEV_NAME)
+        if not col_enabled or not col_desc or not col_name:
+            return None
+
+        # Filtra solo enabled == True/vero
+        device_df = device_df[_mask_enabled(device_df[col_enabled])]
+
+        def _has_val(colname: Optional[str]) -> List[str]:
+            if not colname:
+                return [""] * len(device_df)
+            return ["SI" if str(v).strip() else "" for v in device_df[colname].tolist()]
+
+        records = list(zip(
+            [str(v).strip() for v in device_df[col_name].tolist()],
+            _has_val(_find_col(device_df, CAND_DEV_MAIL)),
+            _has_val(_find_col(device_df, CAND_DEV_MOBILE)),
+            _has_val(_find_col(device_df, CAND_DEV_UPN)),
+        ))
+
+        # segmenti interni della Description, delimitati da " - " su entrambi i lati
+        righe, segmenti = _segmenti_descrizione(device_df[col_desc])
+        interni = _interni(righe)
+        # stesso account ripetuto nella stessa Description: un PC una volta
+        coppie = pd.DataFrame({"riga": righe[interni], "account": segmenti[interni]}).drop_duplicates()
+        devices_by_account: Dict[str, List[Tuple[str, str, str, str]]] = {}
+        for riga, account in zip(coppie["riga"].tolist(), coppie["account"].tolist()):
+            devices_by_account.setdefault(account, []).append(records[riga])
+        return cls(devices_by_account)
+
+    def esporta(self) -> Tuple[Dict[str, np.ndarray], Dict[str, Any]]:
+        """Metadati JSON che ricostruiscono l'indice (vedi importa)."""
+        return {}, {"devices_by_account": self.devices_by_account}
+
+    @classmethod
+    def importa(cls, array: Dict[str, np.ndarray], meta: Dict[str, Any]) -> "DeviceIndex":
+        return cls({account: [tuple(d) for d in devices] for account, devices in meta["devices_by_account"].items()})
+
+    def lookup(self, *accounts: str) -> List[Tuple[str, str, str, str]]:
+        """PC abilitati di uno o più identificativi dello stesso account (senza ripetizioni)."""
+        trovati = [self.devices_by_account.get(a.strip().lower(), []) for a in accounts]
+        if len(trovati) == 1:
+            return list(trovati[0])
+        return list(dict.fromkeys(d for lista in trovati for d in lista))
+
+    def __len__(self) -> int:
+        return len(self.devices_by_account)
+
+    def nbytes(self) -> int:
+        """Stima approssimativa della memoria occupata (per i limiti della cache)."""
+        total = sys.getsizeof(self.devices_by_account)
+        for account, devices in self.devices_by_account.items():
+            total += sys.getsizeof(account) + sys.getsizeof(devices)
+            total += sum(sys.getsizeof(d) + sum(sys.getsizeof(v) for v in d) for d in devices)
+        return total
+
+
+def indice_device(device_df: pd.DataFrame) -> Optional[DeviceIndex]:
+    """Indice PC per l'export Device (None se file vuoto o colonne mancanti)."""
+    if device_df is None or device_df.empty:
+        return None
+    return DeviceIndex.from_df(device_df)
+
+
+def genera_device_csv(sam: str, device_df: pd.DataFrame,
+                      device_index: Optional[DeviceIndex] = None,
+                      identificativi: Optional[Tuple[str, ...]] = None) -> Tuple[Optional[str], Optional[str]]:
+    """
+    Ritorna (contenuto_csv, nome_file) oppure (None, None) se non applicabile.
+    Supporta colonne EN/IT tipiche degli export Device.
+    Una riga per ogni PC abilitato dell'utente con almeno un riferimento da rimuovere.
+    Se 'device_index' è fornito (vedi indice_device) non riscandisce il file.
+    Con 'identificativi' (vedi TabellaIdentita) cerca nella Description anche gli alias.
+    """
+    if device_index is None:
+        device_index = indice_device(device_df)
+        if device_index is None:
+            return None, None
+
+    # PC collegati all'utente (in Description) con almeno un riferimento da rimuovere
+    devices = [d for d in device_index.lookup(*(identificativi or (sam,))) if any(d[1:])]
+    if not devices:
+        return None, None
+
+    # Nome file: AAAAMMGG_Computer_riferimenti_remove[Cognome].csv
+    today = datetime.now().strftime("%Y%m%d")
+    clean = sam.replace(".ext", "")
+    parts = clean.split('.')
+    cognome = parts[1].capitalize() if len(parts) >= 2 else clean.capitalize()
+    file_name = f"{today}_Computer_riferimenti_remove[{cognome}].csv"
+
+    buf = io.StringIO()
+    writer = csv.writer(buf, quoting=csv.QUOTE_NONE, escapechar='\\')
+    writer.writerow(HEADER_DEVICE)
+    for computer_name, remove_mail, remove_mobile, remove_upn in devices:
+        writer.writerow([computer_name, "", "", remove_mail, "", remove_mobile, "", remove_upn, "", ""])
+    # Riga EOF
+    writer.writerow(["EOF-riga lasciata appositamente scritta così per verificare che nessun PC sia andato nella OU/dismessi/computer"])
+    buf.seek(0)
+    return buf.getvalue(), file_name
+
+
+# ===============================================
+# Identità: sAM, UPN, alias ed email di un account
+# ===============================================
+
+# Dominio predefinito delle email/UPN degli account
+DOMINIO_PREDEFINITO = "consip.it"
+
+
+def forme_predefinite(sam_lower: str) -> Tuple[str, str]:
+    """Forme dell'account senza tabella identità: sAMAccountName e sam@consip.it."""
+    return sam_lower, f"{sam_lower}@{DOMINIO_PREDEFINITO}"
+
+
+def _dominio_tenant(domini: pd.Series) -> pd.Series:
+    """Domini del tenant: consip.it, i suoi sottodomini e i domini consip*.onmicrosoft.com."""
+    return (
+        (domini == DOMINIO_PREDEFINITO)
+        | domini.str.endswith("." + DOMINIO_PREDEFINITO)
+        | (domini.str.startswith("consip") & domini.str.endswith(".onmicrosoft.com"))
+    )
+
+
+def _parti_email(valori: pd.Series) -> pd.DataFrame:
+    """Colonne 'locale' e 'dominio' (NaN se il valore non è un indirizzo)."""
+    locale, dominio = motore().email(valori)
+    return pd.DataFrame({"locale": locale, "dominio": dominio}, index=valori.index)
+
+
+class TabellaIdentita:
+    """
+    Tabella unica identificativo -> chiave canonica (sAMAccountName minuscolo),
+    costruita una volta per snapshot dai valori distinti dei membri di tutti gli
+    export e dai riferimenti dell'export Device:
+    - email/UPN di un dominio del tenant -> parte locale (stesso account con
+      suffissi diversi, es. @consip.it e @consip.onmicrosoft.com);
+    - Mail/UPN di un PC la cui Description indica un solo account -> quell'account
+      (ha precedenza sulla regola precedente, salvo che la parte locale sia un
+      altro account presente negli export: in quel caso vale la regola precedente).
+    Si mappano solo indirizzi: un identificativo senza "@" è già una chiave e non
+    viene mai ricondotto a un altro account. Gli identificativi associati a più
+    account dalla stessa regola sono scartati.
+    Ogni file viene poi interrogato con tutte le forme dell'account (vedi forme).
+    """
+
+    COLONNE = ["identificativo", "chiave", "origine"]
+
+    def __init__(self, tabella: pd.DataFrame):
+        self.tabella = tabella.reset_index(drop=True)
+        self._chiave = dict(zip(self.tabella["identificativo"], self.tabella["chiave"]))
+        forme: Dict[str, List[str]] = {}
+        for ident, chiave in self._chiave.items():
+            forme.setdefault(chiave, []).append(ident)
+        self._forme = {chiave: tuple(v) for chiave, v in forme.items()}
+
+    @classmethod
+    def da_indici(cls, indici: Dict[str, Any], device_df: Optional[pd.DataFrame] = None) -> "TabellaIdentita":
+        parti: List[pd.DataFrame] = []
+        vocab = [ix.vocab_membri for ix in indici.values() if isinstance(ix, MembershipIndex)]
+        valori = pd.Series(pd.unique(np.concatenate(vocab)) if vocab else [], dtype=object)
+
+        # 1) riferimenti espliciti dei PC: Description " - <sam> - " con Mail/UPN
+        if device_df is not None and not device_df.empty:
+            col_desc = _find_col(device_df, CAND_DEV_DESC)
+            col_rif = [c for c in (_find_col(device_df, CAND_DEV_MAIL), _find_col(device_df, CAND_DEV_UPN)) if c]
+            if col_desc and col_rif:
+                righe, segmenti = _segmenti_descrizione(device_df[col_desc])
+                # un solo segmento interno: Description di tre segmenti
+                unico = np.bincount(righe, minlength=len(device_df)) == 3
+                indice = device_df.index[unico]
+                secondi = np.searchsorted(righe, np.flatnonzero(unico)) + 1
+                account = pd.Series(motore().testo(segmenti[secondi]), index=indice, dtype="str")
+                for col in col_rif:
+                    rif = pd.Series(motore().testo(device_df.loc[unico, col], minuscolo=True),
+                                    index=indice, dtype="str")
+                    ok = rif.str.contains("@", regex=False) & (account != "")
+                    link = pd.DataFrame({"identificativo": rif[ok], "chiave": account[ok]})
+                    # la parte locale non diventa un alias: potrebbe essere il sAM di un altro account
+                    email = _parti_email(link["identificativo"])
+                    tenant = _dominio_tenant(email["dominio"]).fillna(False).astype(bool)
+                    noti = email["locale"].isin(valori[~valori.str.contains("@", regex=False)])
+                    link = link[~(tenant & noti & (email["locale"] != link["chiave"]))]
+                    parti.append(link.assign(origine="device", priorita=0))
+
+        # 2) email/UPN del tenant nei membri degli export -> parte locale
+        if len(valori):
+            email = _parti_email(valori)
+            tenant = _dominio_tenant(email["dominio"]).fillna(False).astype(bool)
+            parti.append(pd.DataFrame({
+                "identificativo": valori[tenant], "chiave": email["locale"][tenant],
+                "origine": "dominio", "priorita": 1,
+            }))
+
+        if not parti:
+            return cls(pd.DataFrame(columns=cls.COLONNE))
+        tabella = pd.concat(parti, ignore_index=True).drop_duplicates(["identificativo", "chiave", "priorita"])
+        tabella = tabella[tabella["identificativo"] != tabella["chiave"]]
+        # stesso identificativo, stessa regola, account diversi: ambiguo
+        ambigui = tabella.duplicated(["identificativo", "priorita"], keep=False)
+        tabella = tabella[~ambigui].sort_values("priorita", kind="stable")
+        tabella = tabella.drop_duplicates("identificativo")
+        return cls(tabella[cls.COLONNE])
+
+    def chiave(self, identificativo: str) -> str:
+        """Chiave canonica (sAMAccountName) di una qualsiasi forma nota; altrimenti il valore stesso."""
+        ident = identificativo.strip().lower()
+        return self._chiave.get(ident, ident)
+
+    def forme(self, sam: str) -> Tuple[str, ...]:
+        """Tutte le forme note dell'account, a partire da sAMAccountName e sam@consip.it."""
+        sam_lower = self.chiave(sam)
+        return tuple(dict.fromkeys(forme_predefinite(sam_lower) + self._forme.get(sam_lower, ())))
+
+    def risolvi(self, sams: List[str]) -> Dict[str, Tuple[str, ...]]:
+        """Forme di più account in un colpo (chiave: valore richiesto, minuscolo)."""
+        return {s.strip().lower(): self.forme(s) for s in sams}
+
+    def __len__(self) -> int:
+        return len(self.tabella)
+
+    def nbytes(self) -> int:
+        """Stima approssimativa della memoria occupata (per i limiti della cache)."""
+        return int(self.tabella.memory_usage(deep=True).sum()) * 3
+
+
+def tabella_identita(indici: Dict[str, Any], device_df: Optional[pd.DataFrame] = None) -> TabellaIdentita:
+    """Tabella identità dello snapshot dagli indici membri e dall'export Device."""
+    return TabellaIdentita.da_indici(indici, device_df)
+
+
+# ==============================================
+# Strumentazione: tempi e memoria per fase
+# ==============================================
+
+def _rss_mb() -> Optional[float]:
+    """Memoria residente attuale del processo in MB (None se non disponibile)."""
+    try:
+        with open("/proc/self/statm") as f:
+            pages = int(f.read().split()[1])
+        return pages * os.sysconf("SC_PAGE_SIZE") / 1024 ** 2
+    except (OSError, ValueError, AttributeError, IndexError):
+        return None
+
+
+class Strumentazione:
+    """
+    Raccoglie per ogni fase (lettura file, indici, lookup per utente, CSV...)
+    tempo totale, numero di chiamate, righe elaborate e delta di memoria
+    residente. Le fasi con lo stesso nome si sommano (es. lookup su più utenti).
+    Thread-safe; il delta di memoria è indicativo quando più fasi girano insieme.
+    """
+
+    COLONNE = ["fase", "chiamate", "tempo_s", "tempo_medio_ms", "righe", "memoria_delta_mb"]
+
+    def __init__(self):
+        self._fasi: "OrderedDict[str, Dict[str, Any]]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def fase(self, nome: str, righe: Optional[int] = None, memoria: bool = True):
+        """Misura il blocco; il chiamante può impostare info["righe"] dentro il blocco."""
+        info: Dict[str, Any] = {"righe": righe}
+        rss0 = _rss_mb() if memoria else None
+        t0 = time.perf_counter()
+        try:
+            yield info
+        finally:
+            elapsed = time.perf_counter() - t0
+            rss1 = _rss_mb() if rss0 is not None else None
+            self.registra(nome, elapsed, info.get("righe"), (rss1 - rss0) if rss1 is not None else None)
+
+    def registra(self, nome: str, tempo_s: float, righe: Optional[int] = None,
+                 memoria_delta_mb: Optional[float] = None) -> None:
+        """Aggiunge una misura già presa (es. in un processo di caricamento)."""
+        with self._lock:
+            f = self._fasi.setdefault(nome, {"chiamate": 0, "tempo_s": 0.0, "righe": None, "memoria_delta_mb": None})
+            f["chiamate"] += 1
+            f["tempo_s"] += tempo_s
+            if righe is not None:
+                f["righe"] = (f["righe"] or 0) + int(righe)
+            if memoria_delta_mb is not None:
+                f["memoria_delta_mb"] = (f["memoria_delta_mb"] or 0.0) + memoria_delta_mb
+
+    def records(self) -> List[Dict[str, Any]]:
+        with self._lock:
+            return [{
+                "fase": nome,
+                "chiamate": f["chiamate"],
+                "tempo_s": round(f["tempo_s"], 4),
+                "tempo_medio_ms": round(f["tempo_s"] * 1000 / f["chiamate"], 3),
+                "righe": f["righe"],
+                "memoria_delta_mb": None if f["memoria_delta_mb"] is None else round(f["memoria_delta_mb"], 1),
+            } for nome, f in self._fasi.items()]
+
+    def to_json(self) -> str:
+        return json.dumps(self.records(), ensure_ascii=False, indent=2)
+
+    def to_csv(self) -> str:
+        buf = io.StringIO()
+        writer = csv.DictWriter(buf, fieldnames=self.COLONNE)
+        writer.writeheader()
+        writer.writerows(self.records())
+        return buf.getvalue()
+
+    def scrivi(self, path) -> Path:
+        """Scrive il log in JSON o CSV secondo l'estensione del file."""
+        path = Path(path)
+        contenuto = self.to_csv() if path.suffix.lower() == ".csv" else self.to_json()
+        path.write_text(contenuto, encoding="utf-8", newline="")
+        return path
+
+
+def _fase(strumentazione: Optional[Strumentazione], nome: str, righe: Optional[int] = None,
+          memoria: bool = True):
+    """Contesto di misura, o un contesto vuoto se la strumentazione non è attiva."""
+    if strumentazione is None:
+        return nullcontext({})
+    return strumentazione.fase(nome, righe=righe, memoria=memoria)
+
+
+# ==============================================
+# Avanzamento e annullamento dei lavori lunghi
+# ==============================================
+
+class LavoroAnnullato(Exception):
+    """Lavoro interrotto con Avanzamento.annulla()."""
+
+
+class Avanzamento:
+    """
+    Avanzamento di un lavoro lungo (caricamento export, batch), aggiornato dal
+    thread che lo esegue e letto da un altro (es. la UI): fase corrente, passi
+    fatti sul totale e ultimo elemento completato. annulla() chiede
+    l'interruzione, che avviene al passo successivo sollevando LavoroAnnullato.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._annulla = threading.Event()
+        self._fase = ""
+        self._fatti = 0
+        self._totale = 0
+        self._ultimo = ""
+
+    def inizia(self, fase: str, totale: int = 0) -> None:
+        """Nuova fase di 'totale' passi (0: durata non nota)."""
+        with self._lock:
+            self._fase, self._fatti, self._totale, self._ultimo = fase, 0, totale, ""
+        self.controlla()
+
+    def passo(self, ultimo: str = "") -> None:
+        with self._lock:
+            self._fatti += 1
+            self._ultimo = ultimo
+        self.controlla()
+
+    def annulla(self) -> None:
+        self._annulla.set()
+
+    @property
+    def annullato(self) -> bool:
+        return self._annulla.is_set()
+
+    def controlla(self) -> None:
+        """Solleva LavoroAnnullato se è stato chiesto l'annullamento."""
+        if self._annulla.is_set():
+            raise LavoroAnnullato(self._fase)
+
+    def stato(self) -> Tuple[str, int, int, str]:
+        """(fase, fatti, totale, ultimo) letti insieme."""
+        with self._lock:
+            return self._fase, self._fatti, self._totale, self._ultimo
+
+    def frazione(self) -> Optional[float]:
+        """Frazione completata della fase corrente (None se il totale non è noto)."""
+        _, fatti, totale, _ = self.stato()
+        return min(fatti / totale, 1.0) if totale else None
+
+
+def _inizia(avanzamento: Optional[Avanzamento], fase: str, totale: int = 0) -> None:
+    if avanzamento is not None:
+        avanzamento.inizia(fase, totale)
+
+
+def _passo(avanzamento: Optional[Avanzamento], ultimo: str = "") -> None:
+    if avanzamento is not None:
+        avanzamento.passo(ultimo)
+
+
+# ==========================================================
+# Cache export: DataFrame e indici per hash del contenuto
+# ==========================================================
+
+# Limiti della cache condivisa tra rerun e sessioni Streamlit
+CACHE_MAX_ENTRIES = 64
+CACHE_MAX_BYTES = 2 * 1024 ** 3
+# Limiti della cache dei risultati per account (vedi Snapshot.risultati), separata
+# dalla cache export per non scartarne DataFrame e indici con i batch grandi
+RISULTATI_MAX_ENTRIES = 5000
+RISULTATI_MAX_BYTES = 128 * 1024 ** 2
+
+
+def _stima_bytes(value: Any) -> int:
+    """Stima della memoria occupata da un valore in cache."""
+    if isinstance(value, pd.DataFrame):
+        return int(value.memory_usage(deep=True).sum())
+    if isinstance(value, (MembershipIndex, DeviceIndex, GrafoGruppi, TabellaIdentita, RisultatoUtente)):
+        return value.nbytes()
+    if isinstance(value, (set, frozenset, list, tuple)):
+        return sys.getsizeof(value) + sum(sys.getsizeof(v) for v in value)
+    if isinstance(value, dict):
+        return sys.getsizeof(value) + sum(sys.getsizeof(k) + _stima_bytes(v) for k, v in value.items())
+    return sys.getsizeof(value)
+
+
+def hash_contenuto(uploaded_file) -> Optional[str]:
+    """SHA-256 dei byte del file caricato (None se non caricato)."""
+    if not uploaded_file:
+        return None
+    return hashlib.sha256(uploaded_file.getvalue()).hexdigest()
+
+
+class ExportCache:
+    """
+    Cache LRU limitata per numero di voci e memoria stimata, con chiave derivata
+    dall'hash del contenuto dei file: lo stesso export caricato di nuovo (anche
+    da un altro operatore) non viene riletto né re-indicizzato.
+    I valori in cache sono condivisi: non vanno modificati in place.
+    """
+
+    def __init__(self, max_entries: int = CACHE_MAX_ENTRIES, max_bytes: int = CACHE_MAX_BYTES):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self._data: "OrderedDict[Hashable, Tuple[Any, int]]" = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.RLock()
+
+    def memo(self, key: Hashable, builder: Callable[[], Any]) -> Any:
+        """Ritorna il valore per 'key', calcolandolo con builder() se assente."""
+        with self._lock:
+            if key in self._data:
+                self._data.move_to_end(key)
+                return self._data[key][0]
+        value = builder()
+        self.put(key, value)
+        return value
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        """Valore in cache per 'key' (aggiorna l'ordine LRU), altrimenti default."""
+        with self._lock:
+            if key not in self._data:
+                return default
+            self._data.move_to_end(key)
+            return self._data[key][0]
+
+    def __contains__(self, key: Hashable) -> bool:
+        with self._lock:
+            return key in self._data
+
+    def put(self, key: Hashable, value: Any) -> None:
+        """Inserisce un valore, eliminando i meno usati di recente oltre i limiti."""
+        size = _stima_bytes(value)
+        with self._lock:
+            if key in self._data:
+                self._bytes -= self._data.pop(key)[1]
+            if size > self.max_bytes:
+                # troppo grande per la cache: viene solo restituito
+                return
+            self._data[key] = (value, size)
+            self._bytes += size
+            while len(self._data) > self.max_entries or self._bytes > self.max_bytes:
+                _, (_, old_size) = self._data.popitem(last=False)
+                self._bytes -= old_size
+
+    def dataframe(self, uploaded_file, source: Optional[str] = None) -> Tuple[pd.DataFrame, Optional[str]]:
+        """
+        DataFrame del file caricato e relativo hash (dalla cache se già letto).
+        Solleva l'eccezione di lettura se il file non è leggibile (nulla viene messo in cache).
+        """
+        digest = hash_contenuto(uploaded_file)
+        if digest is None:
+            return pd.DataFrame(), None
+        return self.memo(("df", source, digest), lambda: _read_export(uploaded_file, source)), digest
+
+    def clear(self) -> None:
+        with self._lock:
+            self._data.clear()
+            self._bytes = 0
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    @property
+    def nbytes(self) -> int:
+        return self._bytes
+
+
+# Export gestiti, nell'ordine degli uploader
+SORGENTI = ("dl", "sm", "mg", "entra", "device")
+ETICHETTE_SORGENTI = {"dl": "DL", "sm": "SM", "mg": "Estr_MembriGruppi", "entra": "Entra", "device": "Estr_Device"}
+
+_BUILDER_INDICI = {
+    "dl": indice_dl, "sm": indice_sm, "mg": indice_mg, "entra": indice_entra, "device": indice_device,
+}
+
+
+def apri_export(file_or_path) -> Any:
+    """
+    Normalizza un export in un oggetto con getvalue()/seek() come gli upload
+    Streamlit: accetta percorsi (str/Path), file caricati o None.
+    """
+    if file_or_path is None or file_or_path == "":
+        return None
+    if isinstance(file_or_path, (str, Path)):
+        path = Path(file_or_path)
+        buf = io.BytesIO(path.read_bytes())
+        buf.name = path.name
+        return buf
+    return file_or_path
+
+
+def intestazioni_export(raw: bytes) -> List[str]:
+    """
+    Intestazioni di un export (xlsx, csv/tsv anche .gz) leggendo solo la prima
+    riga, con gli stessi nomi prodotti dai loader (Unnamed: i, duplicati .1).
+    """
+    if raw[:4] != _XLSX_MAGIC:
+        return _intestazioni_csv(raw)[0]
+    from openpyxl import load_workbook
+
+    wb = load_workbook(io.BytesIO(raw), read_only=True, data_only=True)
+    try:
+        raw_header = next(wb.worksheets[0].iter_rows(max_row=1, values_only=True), None)
+    finally:
+        wb.close()
+    return _intestazioni_pandas(raw_header) if raw_header is not None else []
+
+
+def preflight_export(
+    files: Dict[str, Any],
+    cache: Optional[ExportCache] = None
+) -> Tuple[Dict[str, SchemaColonne], Dict[str, str]]:
+    """
+    Controllo preliminare degli export indicati in 'files' (chiavi in SORGENTI):
+    legge le sole intestazioni, senza analizzare le righe, e risolve le colonne
+    di ogni file (vedi SchemaColonne.avvisi per mancanti e ambigue), così un
+    file sbagliato si vede prima del caricamento completo.
+    Ritorna (schemi, errori) per i soli file presenti; con 'cache' le
+    intestazioni di un file già visto (stesso hash) non vengono rilette.
+    """
+    schemi: Dict[str, SchemaColonne] = {}
+    errori: Dict[str, str] = {}
+    for source in SORGENTI:
+        try:
+            f = apri_export(files.get(source))
+            if f is None:
+                continue
+            raw = f.getvalue()
+            if cache is not None:
+                chiave = ("intestazioni", source, hashlib.sha256(raw).hexdigest())
+                header = cache.memo(chiave, lambda: intestazioni_export(raw))
+            else:
+                header = intestazioni_export(raw)
+            schemi[source] = schema_colonne(source, header)
+        except Exception as exc:
+            errori[source] = f"{type(exc).__name__}: {exc}"
+    return schemi, errori
+
+
+def _carica_sorgente(raw: bytes, source: str, indicizza: bool = True,
+                     nome_motore: Optional[str] = None) -> Tuple[pd.DataFrame, Any, Dict[str, float]]:
+    """
+    Legge un export dai suoi byte e, con indicizza=True, ne costruisce l'indice
+    (eseguibile in un thread o processo separato, con il motore 'nome_motore'
+    del lavoro chiamante: i worker non ne ereditano il contesto).
+    Ritorna anche i tempi di lettura e indicizzazione in secondi.
+    """
+    with usa_motore(nome_motore) if nome_motore is not None else nullcontext():
+        t0 = time.perf_counter()
+        df = _read_export(io.BytesIO(raw), source)
+        t1 = time.perf_counter()
+        build = _BUILDER_INDICI.get(source)
+        index = build(df) if build is not None and indicizza else None
+    return df, index, {"lettura": t1 - t0, "indice": time.perf_counter() - t1}
+
+
+# oltre questa quota di righe cambiate conviene ricostruire l'indice da zero
+QUOTA_DELTA = 0.5
+
+
+def delta_righe(vecchio: pd.DataFrame, nuovo: pd.DataFrame
+                ) -> Tuple[pd.DataFrame, np.ndarray, pd.DataFrame, np.ndarray]:
+    """
+    Righe aggiunte e rimosse tra due versioni dello stesso export (stesse colonne),
+    confrontate per hash di riga e con molteplicità: ritorna (aggiunte, pesi,
+    rimosse, pesi), una riga per valore distinto con il numero di copie.
+    """
+    def _conta(df: pd.DataFrame) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        # hash di riga distinti, numero di copie e posizione della prima copia (tabelle hash, senza ordinare)
+        codici, uniche = pd.factorize(pd.util.hash_pandas_object(df, index=False).to_numpy())
+        prime = np.full(len(uniche), len(codici), dtype=np.int64)
+        np.minimum.at(prime, codici, np.arange(len(codici)))
+        return np.asarray(uniche), np.bincount(codici, minlength=len(uniche)), prime
+
+    uv, cv, pos_v = _conta(vecchio)
+    un, cn, pos_n = _conta(nuovo)
+    # per ogni hash del nuovo: copie in più rispetto al vecchio (negative se in meno)
+    in_nuovo = pd.Index(un).get_indexer(uv)
+    presenti = in_nuovo >= 0
+    diff = cn.astype(np.int64)
+    diff[in_nuovo[presenti]] -= cv[presenti]
+    solo_vecchio = ~presenti
+    meno_comuni = diff[in_nuovo[presenti]] < 0
+
+    piu = diff > 0
+    aggiunte = nuovo.iloc[pos_n[piu]]
+    rimosse = vecchio.iloc[np.concatenate([pos_v[solo_vecchio], pos_v[presenti][meno_comuni]])]
+    pesi_rimosse = np.concatenate([cv[solo_vecchio], -diff[in_nuovo[presenti]][meno_comuni]]).astype(np.int64)
+    return aggiunte, diff[piu], rimosse, pesi_rimosse
+
+
+def aggiorna_per_differenza(
+    source: str,
+    vecchio_df: pd.DataFrame,
+    vecchio_indice: Any,
+    vecchio_conteggio: Optional[Dict[str, int]],
+    nuovo_df: pd.DataFrame
+) -> Optional[Tuple[Any, Optional[Dict[str, int]], int]]:
+    """
+    Indice e conteggio dei nomi gruppo della nuova versione di un export ottenuti
+    da quelli della versione precedente, applicando solo le righe cambiate.
+    Ritorna (indice, conteggio, righe_cambiate), oppure None se conviene la
+    ricostruzione completa (colonne diverse o troppe righe cambiate).
+    L'indice Device, piccolo e dipendente dall'ordine delle righe, è sempre ricostruito.
+    """
+    if vecchio_df.empty or list(vecchio_df.columns) != list(nuovo_df.columns):
+        return None
+    aggiunte, pesi_agg, rimosse, pesi_rim = delta_righe(vecchio_df, nuovo_df)
+    cambiate = int(pesi_agg.sum() + pesi_rim.sum())
+    if cambiate > QUOTA_DELTA * max(len(nuovo_df), 1):
+        return None
+
+    build = _BUILDER_INDICI.get(source)
+    if isinstance(vecchio_indice, MembershipIndex):
+        indice = vecchio_indice.aggiorna(aggiunte, pesi_agg, rimosse, pesi_rim) if cambiate else vecchio_indice
+    else:
+        indice = build(nuovo_df) if build is not None else None
+
+    conteggio = None
+    if vecchio_conteggio is not None:
+        conteggio = somma_conteggi(
+            vecchio_conteggio,
+            conteggio_nomi_gruppo(aggiunte, source, pesi_agg),
+            conteggio_nomi_gruppo(rimosse, source, -pesi_rim),
+        )
+    return indice, conteggio, cambiate
+
+
+def carica_export(
+    files: Dict[str, Any],
+    cache: ExportCache,
+    max_workers: Optional[int] = None,
+    processi: bool = False,
+    strumentazione: Optional[Strumentazione] = None,
+    store: Optional["SnapshotStore"] = None,
+    avanzamento: Optional[Avanzamento] = None
+) -> Tuple[Dict[str, pd.DataFrame], Dict[str, Optional[str]], Dict[str, str]]:
+    """
+    Carica in parallelo gli export in 'files' (chiavi in SORGENTI, valori file
+    caricati, percorsi o None) e ne costruisce l'indice membri, così il tempo
+    totale tende a quello del file più lento. Con processi=True la lettura
+    avviene in processi separati (il parsing xlsx di openpyxl non rilascia il GIL).
+    I file già in cache (stesso hash) non vengono riletti.
+    Ritorna (dfs, digests, errori): un file illeggibile produce un DF vuoto e
+    il messaggio in errori[sorgente], senza bloccare gli altri.
+    Con 'strumentazione' registra lettura e indice di ogni file più il totale
+    (una lettura xlsx per intero invece che per colonne riporta il motivo nel nome della fase).
+    Con 'store' (vedi SnapshotStore) i file già registrati non vengono riletti,
+    quelli nuovi vengono registrati come correnti e le sorgenti senza file
+    usano l'export corrente dell'archivio.
+    Con 'avanzamento' segnala un passo per file e si interrompe se annullato
+    (le letture già avviate nei worker terminano senza essere attese).
+    """
+    with _fase(strumentazione, "caricamento export (totale)") as fase:
+        dfs, digests, errori = _carica_export(files, cache, max_workers, processi, strumentazione, store,
+                                              avanzamento)
+        fase["righe"] = sum(len(df) for df in dfs.values())
+    return dfs, digests, errori
+
+
+def _da_archivio(store: "SnapshotStore", cache: ExportCache, source: str, digest: str) -> Optional[pd.DataFrame]:
+    """DF di una versione registrata, passando dalla cache in memoria (None se assente)."""
+    cached = cache.get(("df", source, digest))
+    if cached is not None and (source not in _BUILDER_INDICI or ("indice", source, digest) in cache):
+        return cached
+    try:
+        trovato = store.carica(source, digest)
+    except Exception:
+        # archivio illeggibile: si rilegge il file, se c'è
+        return None
+    if trovato is None:
+        return None
+    df, index = trovato
+    cache.put(("df", source, digest), df)
+    if source in _BUILDER_INDICI:
+        cache.put(("indice", source, digest), index)
+    return df
+
+
+def _carica_export(files, cache, max_workers, processi, strumentazione, store=None, avanzamento=None):
+    dfs: Dict[str, pd.DataFrame] = {}
+    digests: Dict[str, Optional[str]] = {}
+    errori: Dict[str, str] = {}
+    pending = {}
+    precedenti: Dict[str, Tuple[str, pd.DataFrame, Any]] = {}
+    nomi: Dict[str, Optional[str]] = {}
+    correnti = store.corrente() if store is not None else {}
+    workers = max_workers or min(len(SORGENTI), os.cpu_count() or 1)
+    executor = ProcessPoolExecutor if processi else ThreadPoolExecutor
+    _inizia(avanzamento, "caricamento export", len(SORGENTI))
+    pool = executor(max_workers=max(1, workers))
+    try:
+        for source in SORGENTI:
+            dfs[source], digests[source] = pd.DataFrame(), None
+            if avanzamento is not None:
+                avanzamento.controlla()
+            try:
+                f = apri_export(files.get(source))
+                if f is None:
+                    # nessun file: export corrente dell'archivio, se registrato
+                    digest = correnti.get(source)
+                    if digest is not None:
+                        with _fase(strumentazione, f"lettura {source} (archivio)") as fase:
+                            df = _da_archivio(store, cache, source, digest)
+                            fase["righe"] = None if df is None else len(df)
+                        if df is not None:
+                            dfs[source], digests[source] = df, digest
+                    continue
+                raw = f.getvalue()
+            except Exception as exc:
+                errori[source] = f"{type(exc).__name__}: {exc}"
+                continue
+            digest = hashlib.sha256(raw).hexdigest()
+            cached = cache.get(("df", source, digest))
+            if cached is not None and (source not in _BUILDER_INDICI or ("indice", source, digest) in cache):
+                dfs[source], digests[source] = cached, digest
+                if strumentazione is not None:
+                    strumentazione.registra(f"lettura {source} (cache)", 0.0, len(cached))
+                if store is not None and correnti.get(source) != digest:
+                    _registra_in_archivio(store, errori, source, digest, getattr(f, "name", None), cached, cache)
+                continue
+            if store is not None:
+                with _fase(strumentazione, f"lettura {source} (archivio)") as fase:
+                    df = _da_archivio(store, cache, source, digest)
+                    fase["righe"] = None if df is None else len(df)
+                if df is not None:
+                    dfs[source], digests[source] = df, digest
+                    if correnti.get(source) != digest:
+                        store.imposta_corrente(source, digest)
+                    continue
+            nomi[source] = getattr(f, "name", None)
+            # versione precedente dello stesso export: l'indice si aggiorna per differenza
+            prec_digest = correnti.get(source) or cache.get(("ultimo", source))
+            prec = _versione(store, cache, source, prec_digest) if prec_digest not in (None, digest) else None
+            if prec is not None:
+                precedenti[source] = (prec_digest,) + prec
+            pending[source] = (digest, pool.submit(_carica_sorgente, raw, source, prec is None, motore().nome))
+        # sorgenti risolte subito (cache, archivio, nessun file o errore)
+        for source in SORGENTI:
+            if source not in pending:
+                _passo(avanzamento, source)
+        for source, (digest, future) in pending.items():
+            # attesa a intervalli brevi: un annullamento non aspetta la fine della lettura
+            while avanzamento is not None and not wait([future], timeout=0.2)[0]:
+                avanzamento.controlla()
+            try:
+                df, index, tempi = future.result()
+            except Exception as exc:
+                errori[source] = f"{type(exc).__name__}: {exc}"
+                _passo(avanzamento, source)
+                continue
+            if strumentazione is not None:
+                motivo = df.attrs.get("lettura_completa")
+                nome = f"lettura {source}" + (f" (completa: {motivo})" if motivo else "")
+                strumentazione.registra(nome, tempi["lettura"], len(df))
+            if source in precedenti:
+                index = _indice_da_precedente(cache, source, digest, df, precedenti[source], strumentazione)
+            elif strumentazione is not None:
+                strumentazione.registra(f"indice {source}", tempi["indice"], len(df))
+            cache.put(("df", source, digest), df)
+            if source in _BUILDER_INDICI:
+                cache.put(("indice", source, digest), index)
+            dfs[source], digests[source] = df, digest
+            if store is not None:
+                _registra_in_archivio(store, errori, source, digest, nomi.get(source), df, cache)
+            _passo(avanzamento, source)
+    finally:
+        annullato = avanzamento is not None and avanzamento.annullato
+        pool.shutdown(wait=not annullato, cancel_futures=annullato)
+    for source, digest in digests.items():
+        if digest is not None:
+            cache.put(("ultimo", source), digest)
+    return dfs, digests, errori
+
+
+def _versione(store: Optional["SnapshotStore"], cache: ExportCache, source: str,
+              digest: str) -> Optional[Tuple[pd.DataFrame, Any]]:
+    """(df, indice) di una versione già caricata, dalla cache o dall'archivio (None se assente)."""
+    df = _da_archivio(store, cache, source, digest) if store is not None else cache.get(("df", source, digest))
+    if df is None:
+        return None
+    return df, cache.get(("indice", source, digest))
+
+
+def _indice_da_precedente(cache: ExportCache, source: str, digest: str, df: pd.DataFrame,
+                          precedente: Tuple[str, pd.DataFrame, Any],
+                          strumentazione: Optional[Strumentazione]) -> Any:
+    """
+    Indice della nuova versione aggiornato per differenza dalla precedente
+    (anche il conteggio dei nomi gruppo, se in cache); ricostruzione completa
+    se il delta non è applicabile.
+    """
+    prec_digest, prec_df, prec_indice = precedente
+    with _fase(strumentazione, f"delta {source}") as fase:
+        aggiornato = aggiorna_per_differenza(
+            source, prec_df, prec_indice, cache.get(("nomi_gruppo", source, prec_digest)), df
+        )
+        if aggiornato is not None:
+            index, conteggio, fase["righe"] = aggiornato
+            if conteggio is not None:
+                cache.put(("nomi_gruppo", source, digest), conteggio)
+            return index
+    build = _BUILDER_INDICI.get(source)
+    with _fase(strumentazione, f"indice {source}", righe=len(df)):
+        return build(df) if build is not None else None
+
+
+def _registra_in_archivio(store: "SnapshotStore", errori: Dict[str, str], source: str, digest: str,
+                          nome: Optional[str], df: pd.DataFrame, cache: ExportCache) -> None:
+    """Registra un export letto come corrente; un errore dell'archivio non blocca il caricamento."""
+    try:
+        store.salva(source, digest, df, cache.get(("indice", source, digest)), nome=nome)
+    except Exception as exc:
+        errori[source] = f"Archivio snapshot non aggiornato ({type(exc).__name__}: {exc})"
+
+
+def indici_snapshot(
+    cache: ExportCache,
+    dfs: Dict[str, pd.DataFrame],
+    digests: Dict[str, Optional[str]],
+    strumentazione: Optional[Strumentazione] = None
+) -> Tuple[Dict[str, Any], FrozenSet[str]]:
+    """
+    Indici membri e insieme dei gruppi DL/MG/SM per i file caricati, memorizzati
+    nella cache con chiave l'hash del file (o dei file) da cui derivano.
+    'dfs' e 'digests' hanno chiavi in SORGENTI.
+    """
+    with _fase(strumentazione, "indici snapshot"):
+        indici = {
+            nome: cache.memo(("indice", nome, digests.get(nome)), lambda b=build, n=nome: b(dfs[n]))
+            for nome, build in _BUILDER_INDICI.items()
+        }
+    with _fase(strumentazione, "gruppi DL/MG/SM (scremamento Entra)") as fase:
+        # conteggi per file in cache: dopo un delta sono già aggiornati (vedi aggiorna_per_differenza)
+        gruppi = cache.memo(
+            ("gruppi_gestiti", digests.get("dl"), digests.get("sm"), digests.get("mg")),
+            lambda: gruppi_gestiti_da_conteggi(*[
+                cache.memo(("nomi_gruppo", s, digests.get(s)), lambda s=s: conteggio_nomi_gruppo(dfs[s], s))
+                for s in ("dl", "sm", "mg")
+            ])
+        )
+        fase["righe"] = len(gruppi)
+    return indici, gruppi
+
+
+# ===================================================
+# Archivio snapshot su disco (condiviso tra sessioni)
+# ===================================================
+
+# versioni conservate per sorgente oltre a quella corrente
+STORE_VERSIONI = 3
+# formato dei dati registrati: se cambia, l'archivio viene svuotato e ripopolato
+FORMATO_ARCHIVIO = 4
+
+# tipi di indice registrabili, per nome nel blob
+_TIPI_INDICE = {"membri": MembershipIndex, "device": DeviceIndex}
+
+
+def _testi_in_array(nome: str, valori) -> Dict[str, np.ndarray]:
+    """Stringhe come byte UTF-8 concatenati più offset, registrabili senza pickle."""
+    codificati = [str(v).encode("utf-8") for v in valori]
+    lunghezze = np.fromiter((len(b) for b in codificati), dtype=np.int64, count=len(codificati))
+    return {f"{nome}.dati": np.frombuffer(b"".join(codificati), dtype=np.uint8),
+            f"{nome}.offset": np.concatenate([[0], np.cumsum(lunghezze)]).astype(np.int64)}
+
+
+def _testi_da_array(nome: str, array: Dict[str, np.ndarray]) -> np.ndarray:
+    testo, offset = array[f"{nome}.dati"].tobytes(), array[f"{nome}.offset"].tolist()
+    return np.array([testo[a:b].decode("utf-8") for a, b in zip(offset[:-1], offset[1:])], dtype=object)
+
+
+def _blob(array: Dict[str, np.ndarray], meta: Dict[str, Any]) -> bytes:
+    """Array numpy (.npz) più metadati JSON: nessun oggetto Python serializzato."""
+    buf = io.BytesIO()
+    np.savez(buf, _meta=np.array(json.dumps(meta, ensure_ascii=False, default=str)), **array)
+    return buf.getvalue()
+
+
+def _da_blob(blob: bytes) -> Tuple[Dict[str, np.ndarray], Dict[str, Any]]:
+    # allow_pickle=False: un archivio manomesso può al più contenere dati sbagliati, non codice
+    with np.load(io.BytesIO(blob), allow_pickle=False) as npz:
+        array = {k: npz[k] for k in npz.files if k != "_meta"}
+        meta = json.loads(str(npz["_meta"]))
+    return array, meta
+
+
+def _df_in_blob(df: pd.DataFrame) -> bytes:
+    """
+    DF di un export come blob: le colonne di testo (categoriche o no) come codici
+    più valori distinti, le altre (numeri, date, flag) come array numpy.
+    L'indice di riga non è registrato (i loader producono sempre 0..n-1).
+    """
+    array: Dict[str, np.ndarray] = {}
+    colonne = []
+    for i, col in enumerate(df.columns):
+        serie = df[col]
+        if isinstance(serie.dtype, pd.CategoricalDtype):
+            tipo, codici, valori = "categoria", serie.cat.codes.to_numpy(), serie.cat.categories
+            dtype = str(valori.dtype)
+        elif serie.dtype.kind in "biufcmM" and not pd.api.types.is_extension_array_dtype(serie):
+            tipo, dtype = "numpy", str(serie.dtype)
+            array[f"c{i}"] = serie.to_numpy()
+        else:
+            tipo, dtype = "testo", str(serie.dtype)
+            codici, valori = pd.factorize(serie, use_na_sentinel=True)
+        if tipo != "numpy":
+            # nelle colonne di testo un valore non testuale (solo lettura Excel completa) resta come testo
+            array[f"c{i}.codici"] = np.asarray(codici, dtype=np.int64)
+            array.update(_testi_in_array(f"c{i}", valori))
+        colonne.append({"nome": col, "tipo": tipo, "dtype": dtype})
+    return _blob(array, {"colonne": colonne, "righe": len(df), "attrs": df.attrs})
+
+
+def _df_da_blob(blob: bytes) -> pd.DataFrame:
+    array, meta = _da_blob(blob)
+    dati = {}
+    for i, c in enumerate(meta["colonne"]):
+        if c["tipo"] == "numpy":
+            dati[i] = array[f"c{i}"]
+            continue
+        codici, valori = array[f"c{i}.codici"], _testi_da_array(f"c{i}", array)
+        if c["tipo"] == "categoria":
+            dati[i] = pd.Categorical.from_codes(codici, categories=pd.Index(valori, dtype=c["dtype"]))
+        else:
+            serie = pd.Series(np.append(valori, np.nan)[codici], dtype=object)
+            dati[i] = serie if c["dtype"] == "object" else serie.astype(c["dtype"])
+    df = pd.DataFrame(dati, index=pd.RangeIndex(meta["righe"]))
+    df.columns = [c["nome"] for c in meta["colonne"]]
+    df.attrs.update(meta["attrs"])
+    return df
+
+
+def _indice_in_blob(indice: Any) -> bytes:
+    tipo = next(nome for nome, cls in _TIPI_INDICE.items() if isinstance(indice, cls))
+    array, meta = indice.esporta()
+    return _blob(array, {"tipo": tipo, "indice": meta})
+
+
+def _indice_da_blob(blob: bytes) -> Any:
+    array, meta = _da_blob(blob)
+    return _TIPI_INDICE[meta["tipo"]].importa(array, meta["indice"])
+
+
+class SnapshotStore:
+    """
+    Archivio SQLite su disco degli export già normalizzati (DF con le sole colonne
+    usate, in forma categorica) e dei loro indici, con chiave (sorgente, hash del
+    file). Più sessioni Streamlit, processi e la CLI possono condividere lo stesso
+    file: un export viene letto e indicizzato una sola volta e ricaricato solo
+    quando cambia il contenuto. Per ogni sorgente una versione è "corrente" ed è
+    usata quando non viene caricato un file.
+    I dati sono registrati come array numpy e JSON, mai con pickle: aprire un
+    archivio di provenienza ignota non esegue codice. Contiene però gli export
+    (account e appartenenze), quindi va protetto come i file originali.
+    """
+
+    def __init__(self, path, versioni: int = STORE_VERSIONI):
+        self.path = Path(path)
+        self.versioni = versioni
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        with self._connessione() as conn:
+            conn.execute("PRAGMA journal_mode=WAL")
+            if conn.execute("PRAGMA user_version").fetchone()[0] != FORMATO_ARCHIVIO:
+                conn.executescript("DROP TABLE IF EXISTS export; DROP TABLE IF EXISTS corrente;")
+                conn.execute(f"PRAGMA user_version = {FORMATO_ARCHIVIO}")
+            conn.executescript("""
+                CREATE TABLE IF NOT EXISTS export (
+                    source TEXT NOT NULL,
+                    digest TEXT NOT NULL,
+                    nome TEXT,
+                    righe INTEGER,
+                    registrato TEXT NOT NULL,
+                    tabella BLOB NOT NULL,
+                    indice BLOB,
+                    PRIMARY KEY (source, digest)
+                );
+                CREATE TABLE IF NOT EXISTS corrente (
+                    source TEXT PRIMARY KEY,
+                    digest TEXT NOT NULL
+                );
+            """)
+
+    @contextmanager
+    def _connessione(self):
+        conn = sqlite3.connect(self.path, timeout=60)
+        try:
+            with conn:
+                yield conn
+        finally:
+            conn.close()
+
+    def carica(self, source: str, digest: str) -> Optional[Tuple[pd.DataFrame, Any]]:
+        """(df, indice) della versione registrata, o None se non presente."""
+        with self._connessione() as conn:
+            row = conn.execute(
+                "SELECT tabella, indice FROM export WHERE source = ? AND digest = ?", (source, digest)
+            ).fetchone()
+        if row is None:
+            return None
+        return _df_da_blob(row[0]), (_indice_da_blob(row[1]) if row[1] is not None else None)
+
+    def salva(self, source: str, digest: str, df: pd.DataFrame, indice: Any = None,
+              nome: Optional[str] = None, corrente: bool = True) -> None:
+        """Registra una versione (se non c'è già), la rende corrente ed elimina le più vecchie."""
+        tabella = _df_in_blob(df)
+        blob_indice = _indice_in_blob(indice) if indice is not None else None
+        with self._connessione() as conn:
+            conn.execute(
+                "INSERT OR IGNORE INTO export (source, digest, nome, righe, registrato, tabella, indice) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (source, digest, nome, len(df), datetime.now().isoformat(timespec="seconds"), tabella, blob_indice)
+            )
+            if corrente:
+                conn.execute("INSERT OR REPLACE INTO corrente (source, digest) VALUES (?, ?)", (source, digest))
+            self._elimina_vecchie(conn, source)
+
+    def _elimina_vecchie(self, conn, source: str) -> None:
+        conn.execute("""
+            DELETE FROM export WHERE source = ? AND digest NOT IN (
+                SELECT digest FROM corrente WHERE source = ?
+            ) AND digest NOT IN (
+                SELECT digest FROM export WHERE source = ? ORDER BY registrato DESC, rowid DESC LIMIT ?
+            )
+        """, (source, source, source, self.versioni + 1))
+
+    def imposta_corrente(self, source: str, digest: str) -> None:
+        with self._connessione() as conn:
+            conn.execute("INSERT OR REPLACE INTO corrente (source, digest) VALUES (?, ?)", (source, digest))
+
+    def corrente(self) -> Dict[str, str]:
+        """Hash della versione corrente per sorgente (solo le sorgenti registrate)."""
+        with self._connessione() as conn:
+            return dict(conn.execute("SELECT source, digest FROM corrente").fetchall())
+
+    def versioni_registrate(self) -> List[Dict[str, Any]]:
+        """Versioni presenti (senza i dati), dalla più recente, con il flag 'corrente'."""
+        with self._connessione() as conn:
+            rows = conn.execute("""
+                SELECT e.source, e.digest, e.nome, e.righe, e.registrato, c.digest IS NOT NULL
+                FROM export e LEFT JOIN corrente c ON c.source = e.source AND c.digest = e.digest
+                ORDER BY e.registrato DESC, e.rowid DESC
+            """).fetchall()
+        campi = ["source", "digest", "nome", "righe", "registrato", "corrente"]
+        return [dict(zip(campi, r[:5] + (bool(r[5]),))) for r in rows]
+
+
+# ==================================================
+# Modalità batch: più utenti sugli stessi file export
+# ==================================================
+
+_SEP_ELENCO = re.compile(r"[\s;,]+")
+
+
+def parse_elenco_sam(testo: str) -> List[str]:
+    """
+    Estrae gli sAMAccountName da un testo incollato (uno per riga o separati da ; , spazi).
+    Ritorna valori minuscoli, unici, nell'ordine di inserimento; ignora l'intestazione 'sAMAccountName'.
+    """
+    visti: Set[str] = set()
+    result: List[str] = []
+    for token in _SEP_ELENCO.split(testo or ""):
+        sam = token.strip().strip('"').strip("'").lower()
+        if not sam or sam == "samaccountname" or sam in visti:
+            continue
+        visti.add(sam)
+        result.append(sam)
+    return result
+
+
+def leggi_elenco_sam(uploaded_file) -> List[str]:
+    """
+    Legge un elenco di account da file TXT/CSV caricato.
+    Se il CSV ha una colonna 'sAMAccountName' usa solo quella, altrimenti la prima colonna.
+    """
+    if not uploaded_file:
+        return []
+    raw = uploaded_file.getvalue()
+    testo = raw.decode("utf-8-sig", errors="replace") if isinstance(raw, bytes) else str(raw)
+    righe = [r for r in testo.splitlines() if r.strip()]
+    if not righe:
+        return []
+    try:
+        dialect = csv.Sniffer().sniff(righe[0], delimiters=",;\t")
+    except csv.Error:
+        # nessun separatore riconoscibile: elenco semplice
+        return parse_elenco_sam(testo)
+    rows = list(csv.reader(righe, dialect))
+    header = [_norm_key(c) for c in rows[0]]
+    idx = header.index("samaccountname") if "samaccountname" in header else 0
+    valori = [r[idx] for r in rows if len(r) > idx]
+    return parse_elenco_sam("\n".join(valori))
+
+
+def nome_csv_utente(sam: str) -> str:
+    """Nome del CSV utente: Deprovisioning_<Cognome>_<Iniziale>.csv."""
+    if not sam:
+        return "Deprovisioning_.csv"
+    clean = sam.replace(".ext", "")
+    parts = clean.split('.')
+    if len(parts) == 2:
+        nome, cognome = parts
+        return f"Deprovisioning_{cognome.capitalize()}_{nome[0].upper()}.csv"
+    return f"Deprovisioning_{clean}.csv"
+
+
+def riga_modifica(sam: str, rimozione: str) -> List[str]:
+    """Riga CSV (ordine HEADER_MODIFICA) per disabilitare l'utente e rimuoverne i gruppi."""
+    row_map = {h: "" for h in HEADER_MODIFICA}
+    row_map["sAMAccountName"] = sam
+    row_map["RimozioneGruppo"] = rimozione
+    row_map["disable"] = "SI"
+    row_map["moveToOU"] = "SI"
+    return [row_map.get(h, "") for h in HEADER_MODIFICA]
+
+
+def _writer_modifica(stream):
+    """csv.writer con il formato del CSV utente (senza virgolette aggiunte, escape con backslash)."""
+    return csv.writer(stream, quoting=csv.QUOTE_NONE, escapechar='\\')
+
+
+def csv_modifica(rows: List[List[str]]) -> str:
+    """CSV utente con intestazione HEADER_MODIFICA e una riga per utente."""
+    buf = io.StringIO()
+    writer = _writer_modifica(buf)
+    writer.writerow(HEADER_MODIFICA)
+    writer.writerows(rows)
+    return buf.getvalue()
+
+
+# ==================================================
+# API: snapshot degli export e risultati per utente
+# ==================================================
+
+@dataclass
+class Snapshot:
+    """Export caricati (chiavi in SORGENTI) con gli indici derivati, pronti per più utenti."""
+    dfs: Dict[str, pd.DataFrame]
+    indici: Dict[str, Any]
+    gruppi_gestiti_lower: FrozenSet[str]
+    digests: Dict[str, Optional[str]] = field(default_factory=dict)
+    errori: Dict[str, str] = field(default_factory=dict)
+    # presente solo in modalità gruppi annidati (vedi GrafoGruppi)
+    grafo: Optional[GrafoGruppi] = None
+    identita: Optional[TabellaIdentita] = None
+    # cache dei risultati per account (vedi elabora_utente), condivisa tra snapshot
+    risultati: Optional[ExportCache] = None
+
+    @property
+    def impronta(self) -> Optional[str]:
+        """
+        Impronta degli export caricati (hash dei file e modalità gruppi annidati):
+        cambia con qualunque export. None per snapshot senza hash (da_dataframe).
+        """
+        if not any(self.digests.values()):
+            return None
+        chiave = json.dumps([self.digests.get(s) for s in SORGENTI] + [self.grafo is not None])
+        return hashlib.sha256(chiave.encode()).hexdigest()
+
+    @classmethod
+    def da_dataframe(cls, annidati: bool = False, **dfs: pd.DataFrame) -> "Snapshot":
+        """Snapshot da DataFrame già in memoria (parametri dl=, sm=, mg=, entra=, device=)."""
+        frames = {s: dfs.get(s) if dfs.get(s) is not None else pd.DataFrame() for s in SORGENTI}
+        indici = costruisci_indici(frames["dl"], frames["sm"], frames["mg"], frames["entra"], frames["device"])
+        return cls(
+            dfs=frames,
+            indici=indici,
+            gruppi_gestiti_lower=calcola_gruppi_gestiti_lower(frames["dl"], frames["sm"], frames["mg"]),
+            grafo=grafo_gruppi(indici["mg"]) if annidati else None,
+            identita=tabella_identita(indici, frames["device"]),
+        )
+
+
+@dataclass
+class RisultatoUtente:
+    """Output del deprovisioning di un account: riga CSV utente, istruzioni, CSV device."""
+    sam: str
+    titolo: str
+    csv_name: str
+    riga: List[str]
+    istruzioni: List[str]
+    device_csv: Optional[str] = None
+    device_file: Optional[str] = None
+    avvisi: List[str] = field(default_factory=list)
+    # solo in modalità gruppi annidati: gruppi AD diretti ed ereditati
+    gruppi_ad_diretti: Optional[List[str]] = None
+    gruppi_ad_ereditati: Optional[List[str]] = None
+
+    def csv_utente(self) -> str:
+        return csv_modifica([self.riga])
+
+    def testo(self) -> str:
+        return self.titolo + "\n" + "\n".join(self.istruzioni)
+
+    def csv_gruppi_ad(self) -> Optional[str]:
+        """CSV Gruppo,Appartenenza (diretta/ereditata); None se non in modalità gruppi annidati."""
+        if self.gruppi_ad_diretti is None:
+            return None
+        buf = io.StringIO()
+        writer = csv.writer(buf)
+        writer.writerow(["Gruppo", "Appartenenza"])
+        writer.writerows([g, "diretta"] for g in self.gruppi_ad_diretti)
+        writer.writerows([g, "ereditata"] for g in self.gruppi_ad_ereditati or [])
+        return buf.getvalue()
+
+    def to_dict(self) -> Dict[str, Any]:
+        return asdict(self)
+
+    def nbytes(self) -> int:
+        """Stima della memoria occupata (per la cache dei risultati)."""
+        testi = [self.sam, self.titolo, self.csv_name, self.device_csv or "", self.device_file or ""]
+        liste = [self.riga, self.istruzioni, self.avvisi, self.gruppi_ad_diretti or [], self.gruppi_ad_ereditati or []]
+        return sum(sys.getsizeof(t) for t in testi) + sum(sys.getsizeof(v) for lista in liste for v in lista)
+
+
+def carica_snapshot(
+    files: Dict[str, Any],
+    cache: Optional[ExportCache] = None,
+    max_workers: Optional[int] = None,
+    processi: bool = False,
+    strumentazione: Optional[Strumentazione] = None,
+    store: Optional[SnapshotStore] = None,
+    annidati: bool = False,
+    avanzamento: Optional[Avanzamento] = None,
+    risultati: Optional[ExportCache] = None
+) -> Snapshot:
+    """
+    Carica gli export (percorsi o file caricati, chiavi in SORGENTI) e costruisce
+    indici e gruppi DL/MG/SM una volta per tutti gli utenti da elaborare.
+    Con 'store' le sorgenti senza file usano la versione corrente dell'archivio.
+    Con annidati=True i risultati riportano anche i gruppi AD ereditati tramite
+    gruppi annidati; le chiusure restano in cache per l'export MG.
+    Con 'avanzamento' segnala file letti e fasi successive (vedi Avanzamento).
+    Con 'risultati' (es. ExportCache(RISULTATI_MAX_ENTRIES, RISULTATI_MAX_BYTES))
+    gli account già elaborati sugli stessi export non vengono ricalcolati.
+    """
+    cache = cache if cache is not None else ExportCache()
+    dfs, digests, errori = carica_export(files, cache, max_workers=max_workers, processi=processi,
+                                         strumentazione=strumentazione, store=store, avanzamento=avanzamento)
+    _inizia(avanzamento, "indici e tabella identità")
+    indici, gruppi = indici_snapshot(cache, dfs, digests, strumentazione)
+    if avanzamento is not None:
+        avanzamento.controlla()
+    grafo = None
+    if annidati and indici["mg"] is not None:
+        grafo = cache.memo(("grafo_gruppi", digests.get("mg")), lambda: grafo_gruppi(indici["mg"]))
+    with _fase(strumentazione, "tabella identità") as fase:
+        identita = cache.memo(("identita",) + tuple(digests.get(s) for s in SORGENTI),
+                              lambda: tabella_identita(indici, dfs["device"]))
+        fase["righe"] = len(identita)
+    return Snapshot(dfs=dfs, indici=indici, gruppi_gestiti_lower=gruppi, digests=digests, errori=errori,
+                    grafo=grafo, identita=identita, risultati=risultati)
+
+
+def elabora_utente(sam: str, snapshot: Snapshot,
+                   strumentazione: Optional[Strumentazione] = None) -> RisultatoUtente:
+    """
+    Deprovisioning di un account sullo snapshot (solo lookup sugli indici).
+    'sam' può essere anche una UPN/email o un alias noto alla tabella identità.
+    Con la cache snapshot.risultati un account già elaborato sugli stessi export
+    (e nello stesso giorno, che entra nel nome del CSV device) non viene
+    ricalcolato: il risultato restituito è condiviso e non va modificato.
+    """
+    sam = sam.strip().lower()
+    identificativi = None
+    if snapshot.identita is not None:
+        sam = snapshot.identita.chiave(sam)
+        identificativi = snapshot.identita.forme(sam)
+    impronta = snapshot.impronta if snapshot.risultati is not None else None
+    if impronta is None:
+        return _elabora_utente(sam, identificativi, snapshot, strumentazione)
+    chiave = ("risultato", impronta, datetime.now().strftime("%Y%m%d"), sam)
+    risultato = snapshot.risultati.get(chiave)
+    if risultato is not None:
+        if strumentazione is not None:
+            strumentazione.registra("utente (cache)", 0.0, None)
+        return risultato
+    risultato = _elabora_utente(sam, identificativi, snapshot, strumentazione)
+    snapshot.risultati.put(chiave, risultato)
+    return risultato
+
+
+def _elabora_utente(sam: str, identificativi: Optional[Tuple[str, ...]], snapshot: Snapshot,
+                    strumentazione: Optional[Strumentazione]) -> RisultatoUtente:
+    dfs = snapshot.dfs
+    avvisi: List[str] = []
+    with _fase(strumentazione, "utente: gruppi MG", memoria=False):
+        rimozione = estrai_rimozione_gruppi(sam, dfs["mg"], snapshot.indici.get("mg"), avvisi, identificativi)
+    istruzioni = genera_deprovisioning(
+        sam, dfs["dl"], dfs["sm"], dfs["mg"], dfs["entra"],
+        gruppi_gestiti_lower=snapshot.gruppi_gestiti_lower, indici=snapshot.indici, avvisi=avvisi,
+        strumentazione=strumentazione, identificativi=identificativi
+    )
+    with _fase(strumentazione, "utente: CSV device", memoria=False):
+        device_csv, device_file = genera_device_csv(sam, dfs["device"], snapshot.indici.get("device"),
+                                                    identificativi)
+    with _fase(strumentazione, "utente: riga CSV utente", memoria=False):
+        riga = riga_modifica(sam, rimozione)
+    diretti = ereditati = None
+    if snapshot.grafo is not None:
+        with _fase(strumentazione, "utente: gruppi annidati", memoria=False) as fase:
+            diretti, ereditati = snapshot.grafo.diretti_ed_ereditati(sam, identificativi)
+            fase["righe"] = len(ereditati)
+    return RisultatoUtente(
+        sam=sam,
+        titolo=titolo_deprovisioning(sam),
+        csv_name=nome_csv_utente(sam),
+        riga=riga,
+        istruzioni=istruzioni,
+        device_csv=device_csv,
+        device_file=device_file,
+        avvisi=avvisi,
+        gruppi_ad_diretti=diretti,
+        gruppi_ad_ereditati=ereditati,
+    )
+
+
+def elabora_batch(sams: List[str], snapshot: Snapshot,
+                  strumentazione: Optional[Strumentazione] = None,
+                  avanzamento: Optional[Avanzamento] = None) -> List[RisultatoUtente]:
+    """
+    Deprovisioning di più account sullo stesso snapshot (indici costruiti una volta).
+    Forme diverse dello stesso account (es. sAM e UPN) producono un solo risultato.
+    """
+    with _fase(strumentazione, "batch (totale)", righe=len(sams)):
+        return list(itera_batch(sams, snapshot, strumentazione, avanzamento))
+
+
+def itera_batch(sams: List[str], snapshot: Snapshot,
+                strumentazione: Optional[Strumentazione] = None,
+                avanzamento: Optional[Avanzamento] = None) -> Iterator[RisultatoUtente]:
+    """
+    Come elabora_batch, ma produce un risultato alla volta: chi scrive i file
+    (scrivi_zip, scrivi_csv_consolidato) non tiene in memoria tutto il batch.
+    Con 'avanzamento' un passo per account; se annullato si ferma con LavoroAnnullato.
+    """
+    if snapshot.identita is not None:
+        sams = list(dict.fromkeys(snapshot.identita.chiave(s) for s in sams))
+    _inizia(avanzamento, "elaborazione account", len(sams))
+    for sam in sams:
+        risultato = elabora_utente(sam, snapshot, strumentazione)
+        _passo(avanzamento, sam)
+        yield risultato
+
+
+def file_utente(r: RisultatoUtente) -> List[Tuple[str, str]]:
+    """
+    File di un account come (nome, contenuto): CSV utente, istruzioni (.txt),
+    eventuale CSV device e, in modalità gruppi annidati, i gruppi AD.
+    """
+    stem = Path(r.csv_name).stem
+    files = [(r.csv_name, r.csv_utente()), (stem + ".txt", r.testo() + "\n")]
+    if r.device_csv and r.device_file:
+        files.append((r.device_file, r.device_csv))
+    gruppi_ad = r.csv_gruppi_ad()
+    if gruppi_ad is not None:
+        files.append((stem + "_gruppi_AD.csv", gruppi_ad))
+    return files
+
+
+def nome_batch() -> str:
+    """Nome del CSV utenti consolidato del batch."""
+    return f"Deprovisioning_batch_{datetime.now().strftime('%Y%m%d')}.csv"
+
+
+class _NomiUnici:
+    """Nomi file già usati: stesso nome per due utenti (es. stesso cognome) -> suffisso con lo sAM."""
+
+    def __init__(self):
+        self.usati: Set[str] = set()
+
+    def __call__(self, nome: str, sam: str = "") -> str:
+        if nome in self.usati:
+            p = Path(nome)
+            nome = f"{p.stem}_{sam}{p.suffix}"
+        self.usati.add(nome)
+        return nome
+
+
+def scrivi_risultati(risultati: Iterable[RisultatoUtente], out_dir) -> List[Path]:
+    """
+    Scrive in 'out_dir' per ogni utente i file di file_utente; con più utenti
+    anche il CSV utenti consolidato. Ritorna i percorsi scritti.
+    """
+    out = Path(out_dir)
+    out.mkdir(parents=True, exist_ok=True)
+    nomi = _NomiUnici()
+    scritti: List[Path] = []
+    rows: List[List[str]] = []
+    for r in risultati:
+        for nome, contenuto in file_utente(r):
+            path = out / nomi(nome, r.sam)
+            path.write_text(contenuto, encoding="utf-8", newline="")
+            scritti.append(path)
+        rows.append(r.riga)
+    if len(rows) > 1:
+        path = out / nomi(nome_batch())
+        path.write_text(csv_modifica(rows), encoding="utf-8", newline="")
+        scritti.append(path)
+    return scritti
+
+
+def scrivi_zip(risultati: Iterable[RisultatoUtente], dest, consolidato: bool = True,
+               allegati: Iterable[Tuple[str, str]] = ()) -> List[str]:
+    """
+    Scrive i file di ogni account (vedi file_utente) in un unico ZIP, 'dest'
+    percorso o file binario, man mano che i risultati arrivano (es. da
+    itera_batch): in memoria resta solo l'account corrente e le righe del CSV
+    consolidato, aggiunto alla fine con più di un account. Gli 'allegati'
+    (nome, contenuto), es. un report, sono scritti per primi. Ritorna i nomi scritti.
+    """
+    nomi = _NomiUnici()
+    scritti: List[str] = []
+    rows: List[List[str]] = []
+    with zipfile.ZipFile(dest, "w", compression=zipfile.ZIP_DEFLATED) as zf:
+        for nome, contenuto in allegati:
+            nome = nomi(nome)
+            zf.writestr(nome, contenuto)
+            scritti.append(nome)
+        for r in risultati:
+            for nome, contenuto in file_utente(r):
+                nome = nomi(nome, r.sam)
+                zf.writestr(nome, contenuto)
+                scritti.append(nome)
+            rows.append(r.riga)
+        if consolidato and len(rows) > 1:
+            nome = nomi(nome_batch())
+            with zf.open(nome, "w") as raw, io.TextIOWrapper(raw, encoding="utf-8", newline="") as stream:
+                writer = _writer_modifica(stream)
+                writer.writerow(HEADER_MODIFICA)
+                writer.writerows(rows)
+            scritti.append(nome)
+    return scritti
+
+
+def scrivi_csv_consolidato(risultati: Iterable[RisultatoUtente], dest) -> int:
+    """
+    Scrive il CSV utenti consolidato (HEADER_MODIFICA, una riga per account) in
+    'dest', percorso o stream di testo, una riga alla volta. Ritorna le righe scritte.
+    """
+    if isinstance(dest, (str, Path)):
+        with open(dest, "w", encoding="utf-8", newline="") as stream:
+            return scrivi_csv_consolidato(risultati, stream)
+    writer = _writer_modifica(dest)
+    writer.writerow(HEADER_MODIFICA)
+    n = 0
+    for r in risultati:
+        writer.writerow(r.riga)
+        n += 1
+    return n
+
+
+# ==================================================
+# Report membri per gruppo (domanda inversa)
+# ==================================================
+
+# Export con appartenenze a gruppi, nell'ordine del report
+SORGENTI_GRUPPI = ("dl", "sm", "mg", "entra")
+COLONNE_REPORT_GRUPPI = ["Gruppo", "Origine", "Membro", "Account", "Esterno", "Disabilitato"]
+
+_SEP_GRUPPI = re.compile(r"[\r\n;]+")
+
+
+def parse_elenco_gruppi(testo: str) -> List[str]:
+    """
+    Nomi (o indirizzi) di gruppi da un testo incollato, uno per riga o separati
+    da ';' (i nomi possono contenere spazi e virgole). Unici senza distinzione
+    di maiuscole, nell'ordine di inserimento.
+    """
+    visti: Set[str] = set()
+    result: List[str] = []
+    for token in _SEP_GRUPPI.split(testo or ""):
+        nome = token.strip().strip('"').strip("'").strip()
+        if not nome or nome.lower() in visti:
+            continue
+        visti.add(nome.lower())
+        result.append(nome)
+    return result
+
+
+def stato_membri(dfs: Dict[str, pd.DataFrame]) -> Dict[str, bool]:
+    """
+    Membro normalizzato (strip + minuscolo) -> account abilitato, dalle colonne
+    facoltative CAND_MEMBER_ENABLED degli export MG ed Entra. Un account
+    disabilitato in almeno un export è disabilitato; i membri senza valore
+    riconoscibile non compaiono (stato non noto).
+    """
+    stato: Dict[str, bool] = {}
+    for source, cand_membro in (("mg", CAND_MG_MEMBER), ("entra", CAND_ENTRA_MEMBER_UPN)):
+        df = dfs.get(source)
+        if df is None or df.empty:
+            continue
+        col_membro, col_stato = _find_col(df, cand_membro), _find_col(df, CAND_MEMBER_ENABLED)
+        if not col_membro or not col_stato or col_membro == col_stato:
+            continue
+        codes_m, membri = _codifica(df[col_membro], minuscolo=True)
+        codes_s, valori = _codifica(df[col_stato], minuscolo=True)
+        noto = np.append(np.isin(valori, _VALORI_VERI + _VALORI_FALSI), False)[codes_s] & (codes_m >= 0)
+        abilitato = np.append(np.isin(valori, _VALORI_VERI), False)[codes_s]
+        per_membro = pd.Series(abilitato[noto]).groupby(codes_m[noto]).min()
+        for membro, valore in zip(membri[per_membro.index.to_numpy()], per_membro.to_numpy()):
+            stato[membro] = stato.get(membro, True) and bool(valore)
+    return stato
+
+
+def report_membri_gruppi(gruppi: List[str], snapshot: Snapshot) -> pd.DataFrame:
+    """
+    Membri diretti di più gruppi (DL, caselle condivise, gruppi MG ed Entra) in
+    una sola passata, dalla struttura gruppo -> membri degli indici già
+    costruiti (vedi MembershipIndex.membri_di). Una riga per gruppo, export e
+    membro (colonne COLONNE_REPORT_GRUPPI) con l'account risolto dalla tabella
+    identità, se è esterno (.ext) e se è disabilitato ("sì"/"no", vuoto se gli
+    export non ne riportano lo stato). I gruppi non trovati non producono righe.
+    """
+    stato = stato_membri(snapshot.dfs)
+    identita = snapshot.identita
+    righe: List[List[str]] = []
+    for gruppo in gruppi:
+        for source in SORGENTI_GRUPPI:
+            indice = snapshot.indici.get(source)
+            if indice is None:
+                continue
+            for membro in indice.membri_di(gruppo):
+                account = identita.chiave(membro) if identita is not None else membro
+                abilitato = stato.get(membro)
+                if abilitato is None and stato:
+                    forme = identita.forme(account) if identita is not None else forme_predefinite(account)
+                    abilitato = next((stato[f] for f in forme if f in stato), None)
+                esterno = account.split("@", 1)[0].endswith(".ext")
+                righe.append([gruppo, ETICHETTE_SORGENTI[source], membro, account,
+                              "sì" if esterno else "no",
+                              "" if abilitato is None else ("no" if abilitato else "sì")])
+    return pd.DataFrame(righe, columns=COLONNE_REPORT_GRUPPI)
+
+
+def gruppi_non_trovati(gruppi: List[str], report: pd.DataFrame) -> List[str]:
+    """Gruppi richiesti senza righe nel report, con lo stesso confronto dei nomi di membri_di."""
+    trovati = {chiave_gruppo(g) for g in report["Gruppo"]}
+    return [g for g in gruppi if chiave_gruppo(g) not in trovati]
+
+
+def nome_report_gruppi() -> str:
+    """Nome del CSV del report membri per gruppo."""
+    return f"Deprovisioning_membri_gruppi_{datetime.now().strftime('%Y%m%d')}.csv"
+
+
+# ====================================================
+# Ricognizione accessi residui (elenco account attivi)
+# ====================================================
+
+COLONNE_RICOGNIZIONE = ["Account", "Esterno", "Disabilitato", "DL", "SM", "MG", "Entra", "PC", "Identificativi"]
+# colonna del report con il numero di gruppi (o PC) per export
+ETICHETTE_RICOGNIZIONE = {"dl": "DL", "sm": "SM", "mg": "MG", "entra": "Entra", "device": "PC"}
+# identificativi con accessi residui non ricondotti a un account (vedi ricognizione_accessi)
+COLONNE_NON_RISOLTI = ["Identificativo", "Motivo", "DL", "SM", "MG", "Entra", "PC"]
+
+
+def chiavi_account(valori, identita: Optional[TabellaIdentita]) -> np.ndarray:
+    """
+    Chiave canonica di molti identificativi in un colpo, come
+    TabellaIdentita.chiave (strip + minuscolo, poi tabella identità); gli
+    indirizzi del tenant non in tabella passano alla parte locale, come le
+    forme predefinite sam@consip.it.
+    """
+    chiavi = motore().testo(np.asarray(valori, dtype=object), minuscolo=True)
+    if identita is not None and len(identita):
+        pos = pd.Index(identita.tabella["identificativo"]).get_indexer(chiavi)
+        trovati = pos >= 0
+        chiavi[trovati] = identita.tabella["chiave"].to_numpy(dtype=object)[pos[trovati]]
+    email = _parti_email(pd.Series(chiavi, dtype=object))
+    tenant = _dominio_tenant(email["dominio"].astype("str")).fillna(False).astype(bool).to_numpy()
+    chiavi[tenant] = email["locale"].to_numpy(dtype=object)[tenant]
+    return chiavi
+
+
+def _gruppi_annidati(snapshot: Snapshot, chiavi: np.ndarray, membri_mg: np.ndarray) -> np.ndarray:
+    """
+    Maschera delle chiavi che sono gruppi annidati: nome di un gruppo MG che
+    compare a sua volta tra i membri MG ('membri_mg', maschera sulle chiavi).
+    Una chiave che la tabella identità riconduce a un account (es. dall'UPN
+    Entra o dalla Mail di un PC) resta un account anche se un gruppo ha lo
+    stesso nome; gli indirizzi di DL e caselle condivise non contano: una
+    casella personale con delegati è ancora un account.
+    """
+    mg = snapshot.indici.get("mg")
+    if not isinstance(mg, MembershipIndex) or not len(mg.vocab_gruppi):
+        return np.zeros(len(chiavi), dtype=bool)
+    annidati = pd.Index(chiavi).isin(motore().testo(mg.vocab_gruppi, minuscolo=True)) & membri_mg
+    if snapshot.identita is not None and len(snapshot.identita):
+        annidati &= ~pd.Index(chiavi).isin(snapshot.identita.tabella["chiave"])
+    return annidati
+
+
+def _motivi_non_risolti(chiavi: np.ndarray, gruppo: np.ndarray) -> np.ndarray:
+    """Perché un identificativo non è un account: gruppo annidato, computer, indirizzo esterno o testo libero."""
+    testo = pd.Series(chiavi, dtype="str")
+    return np.select(
+        [gruppo, testo.str.endswith("$").to_numpy(), testo.str.contains("@", regex=False).to_numpy()],
+        ["gruppo annidato", "computer", "indirizzo esterno o non risolto"],
+        default="non è un account (contiene spazi)",
+    ).astype(object)
+
+
+def ricognizione_accessi(
+    attivi: List[str],
+    snapshot: Snapshot,
+    strumentazione: Optional[Strumentazione] = None
+) -> Tuple[pd.DataFrame, pd.DataFrame, List[str]]:
+    """
+    Accessi residui di tutto il tenant: gli account ancora membri di DL, caselle
+    condivise, gruppi MG o Entra, o indicati nella Description di un PC
+    abilitato, che non compaiono nell'elenco 'attivi' (es. estratto HR:
+    sAMAccountName, UPN o alias). Ogni identificativo (sAM, UPN, alias,
+    account nella Description) è ricondotto all'account dalla tabella identità
+    una volta per valore distinto; poi l'elenco attivi è sottratto con
+    un'anti-join sui codici interi delle coppie degli indici già costruiti,
+    senza interrogare gli account uno alla volta. I membri non attivi che non
+    si riconducono a un account (indirizzi esterni al tenant o non risolti,
+    gruppi annidati, computer $, testo con spazi) non finiscono tra i residui
+    ma sono riportati a parte, con il motivo.
+    Ritorna (residui, non_risolti, attivi_non_trovati): una riga per account
+    (colonne COLONNE_RICOGNIZIONE: gruppi distinti per export, PC, forme
+    trovate) in ordine di account; una riga per identificativo non risolto
+    (COLONNE_NON_RISOLTI) in ordine di motivo; le voci dell'elenco che non
+    compaiono in nessun export (se sono quasi tutte, l'elenco ha probabilmente
+    un formato diverso).
+    Le righe HEADER_MODIFICA e le istruzioni si ottengono con
+    itera_batch(list(residui["Account"]), snapshot).
+    """
+    with _fase(strumentazione, "ricognizione accessi residui") as fase:
+        # coppie (identificativo, voce) per export: gruppi per DL/SM/MG/Entra, PC per Device
+        sorgenti: List[Tuple[str, np.ndarray, np.ndarray, np.ndarray]] = []
+        for source in SORGENTI_GRUPPI:
+            ix = snapshot.indici.get(source)
+            if isinstance(ix, MembershipIndex) and len(ix.coppie_m):
+                sorgenti.append((source, ix.vocab_membri, ix.coppie_m, ix.codici.astype(np.int64)))
+        device = snapshot.indici.get("device")
+        if device is not None and len(device):
+            pc = list(device.devices_by_account.values())
+            voci, _ = pd.factorize(pd.Series([d[0] for lista in pc for d in lista], dtype=object))
+            sorgenti.append(("device", np.array(list(device.devices_by_account), dtype=object),
+                             np.repeat(np.arange(len(pc), dtype=np.int64), [len(lista) for lista in pc]),
+                             voci.astype(np.int64)))
+        if not sorgenti:
+            fase["righe"] = 0
+            return pd.DataFrame(columns=COLONNE_RICOGNIZIONE), pd.DataFrame(columns=COLONNE_NON_RISOLTI), list(attivi)
+
+        # un codice intero per account, da tutti i valori distinti di tutti gli export
+        inizi = np.cumsum([0] + [len(vocab) for _, vocab, _, _ in sorgenti])
+        identificativi = np.concatenate([vocab for _, vocab, _, _ in sorgenti])
+        codici, chiavi = pd.factorize(chiavi_account(identificativi, snapshot.identita))
+        chiavi = np.asarray(chiavi, dtype=object)
+
+        membri_mg = np.zeros(len(chiavi), dtype=bool)
+        for (source, vocab, _, _), inizio in zip(sorgenti, inizi):
+            if source == "mg":
+                membri_mg[codici[inizio:inizio + len(vocab)]] = True
+        gruppo_annidato = _gruppi_annidati(snapshot, chiavi, membri_mg)
+        testo = pd.Series(chiavi, dtype="str")
+        non_account = (
+            testo.str.contains("@", regex=False) | testo.str.endswith("$") | testo.str.contains(r"\s")
+        ).to_numpy() | gruppo_annidato
+        elenco = chiavi_account(attivi, snapshot.identita)
+        attivo = pd.Index(chiavi).get_indexer(elenco)
+        non_attivo = np.ones(len(chiavi), dtype=bool)
+        non_attivo[attivo[attivo >= 0]] = False
+        residuo = non_attivo & ~non_account
+
+        # anti-join sulle coppie: voci distinte per chiave (account o no) ed export
+        colonne: Dict[str, np.ndarray] = {}
+        usati: List[np.ndarray] = []
+        for (source, _, coppie_m, voci), inizio in zip(sorgenti, inizi):
+            k = codici[inizio + coppie_m]
+            tenute = non_attivo[k]
+            # coppia (chiave, voce) come un solo intero: stessa voce da più forme conta una volta
+            base = int(voci.max()) + 1
+            coppie = pd.unique(k[tenute] * base + voci[tenute])
+            colonne[source] = np.bincount(coppie // base, minlength=len(chiavi))
+            usati.append(pd.unique(inizio + coppie_m[tenute & residuo[k]]))
+        posizioni = np.concatenate(usati)
+        presenti = sum(colonne.values()) > 0
+        righe = np.flatnonzero(residuo & presenti)
+
+        def _conteggi(indici: np.ndarray) -> Dict[str, np.ndarray]:
+            return {ETICHETTE_RICOGNIZIONE[s]: colonne[s][indici] if s in colonne
+                    else np.zeros(len(indici), dtype=np.int64) for s in SORGENTI}
+
+        nr = np.flatnonzero(non_attivo & non_account & presenti)
+        non_risolti = pd.DataFrame({
+            "Identificativo": chiavi[nr],
+            "Motivo": _motivi_non_risolti(chiavi[nr], gruppo_annidato[nr]),
+            **_conteggi(nr),
+        }, columns=COLONNE_NON_RISOLTI).sort_values(["Motivo", "Identificativo"], kind="stable").reset_index(drop=True)
+        attivi_non_trovati = [a for a, pos in zip(attivi, attivo) if pos < 0]
+        if not len(righe):
+            # tutti gli account sono nell'elenco attivi: nessun accesso residuo
+            fase["righe"] = 0
+            return pd.DataFrame(columns=COLONNE_RICOGNIZIONE), non_risolti, attivi_non_trovati
+
+        # forme trovate e stato (disabilitato se lo è in almeno un export) per account
+        forme = pd.DataFrame({"k": codici[posizioni], "forma": identificativi[posizioni]})
+        forme = forme.drop_duplicates().sort_values(["k", "forma"])
+        k, valori = forme["k"].to_numpy(), forme["forma"].to_numpy(dtype=object)
+        gruppo = np.flatnonzero(np.concatenate([[True], k[1:] != k[:-1]]))
+        per_account = pd.Index(k[gruppo]).get_indexer(righe)
+        testi = np.array([";".join(v) for v in np.split(valori, gruppo[1:])], dtype=object)
+        # 1 abilitato, 0 disabilitato, NaN stato non noto (fmin ignora i NaN)
+        stato = stato_membri(snapshot.dfs)
+        abilitato = np.fmin.reduceat(pd.Series(valori).map(stato).astype(float).to_numpy(), gruppo)[per_account]
+        disabilitato = np.where(np.isnan(abilitato), "", np.where(abilitato == 0, "sì", "no"))
+
+        residui = pd.DataFrame({
+            "Account": chiavi[righe],
+            "Esterno": np.where(pd.Series(chiavi[righe], dtype="str").str.endswith(".ext"), "sì", "no"),
+            "Disabilitato": disabilitato,
+            **_conteggi(righe),
+            "Identificativi": testi[per_account],
+        }, columns=COLONNE_RICOGNIZIONE).sort_values("Account", kind="stable").reset_index(drop=True)
+        fase["righe"] = len(residui)
+    return residui, non_risolti, attivi_non_trovati
+
+
+def nome_report_ricognizione() -> str:
+    """Nome del CSV del report accessi residui."""
+    return f"Deprovisioning_accessi_residui_{datetime.now().strftime('%Y%m%d')}.csv"
+
+
+def nome_report_non_risolti() -> str:
+    """Nome del CSV degli identificativi con accessi residui non ricondotti a un account."""
+    return f"Deprovisioning_identificativi_non_risolti_{datetime.now().strftime('%Y%m%d')}.csv"
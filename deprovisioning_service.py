@@ -0,0 +1,340 @@
+# -*- coding: utf-8 -*-
+# Deprovisioning Consip – servizio HTTP/JSON locale (senza Streamlit)
+#
+# Carica gli export una volta all'avvio e tiene in memoria indici e risultati:
+# le richieste per account rispondono con i soli lookup.
+#
+# Il servizio non ha autenticazione: deve ascoltare solo in locale (--host
+# predefinito 127.0.0.1). /ricarica legge solo i file di avvio o, con
+# --cartella, i file dentro quella cartella.
+#
+# Esempio:
+#   python deprovisioning_service.py --store snapshot.db --porta 8765
+#   python deprovisioning_service.py --mg Estr_MembriGruppi.xlsx --device Estr_Device.csv --annidati
+#
+#   GET  /stato                      impronta, export caricati, errori
+#   GET  /utenti/mario.rossi         risultato di un account (come RisultatoUtente.to_dict)
+#   POST /batch    {"sam": [...]}    risultati di più account
+#   POST /gruppi   {"gruppi": [...]} membri di più gruppi (esterni .ext, disabilitati)
+#   POST /ricognizione {"attivi": [...]}  account non attivi con accessi residui
+#                                     ("dettaglio": true per i loro risultati, fino a MAX_BATCH account)
+#   POST /ricarica {"mg": "nuovo.xlsx"}   rilegge gli export (quelli indicati sostituiscono i precedenti;
+#                                     percorsi relativi a --cartella, senza --cartella solo quelli di avvio;
+#                                     422 e snapshot invariato se un file indicato non si legge)
+
+import argparse
+import ipaddress
+import json
+import os
+import sys
+import threading
+from datetime import datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from typing import Any, Dict, List, Optional
+from urllib.parse import unquote, urlsplit
+
+from deprovisioning_core import (
+    ETICHETTE_SORGENTI,
+    MOTORI,
+    RISULTATI_MAX_BYTES,
+    RISULTATI_MAX_ENTRIES,
+    SORGENTI,
+    ExportCache,
+    Snapshot,
+    SnapshotStore,
+    carica_snapshot,
+    elabora_batch,
+    elabora_utente,
+    gruppi_non_trovati,
+    imposta_motore,
+    motore,
+    parse_elenco_gruppi,
+    parse_elenco_sam,
+    report_membri_gruppi,
+    ricognizione_accessi,
+)
+
+# massimo di account per richiesta /batch (e di gruppi per /gruppi)
+MAX_BATCH = 5000
+
+
+class RicaricaNonRiuscita(Exception):
+    """Un export indicato a /ricarica non è leggibile: lo snapshot in uso resta quello precedente."""
+
+    def __init__(self, errori: Dict[str, str]):
+        super().__init__("; ".join(f"{s}: {e}" for s, e in errori.items()))
+        self.errori = errori
+
+
+class Servizio:
+    """
+    Snapshot caricato una volta e condiviso tra le richieste. ricarica() ne
+    costruisce uno nuovo (riusando cache export e archivio) e lo sostituisce:
+    le richieste in corso finiscono sul precedente.
+    I percorsi ricevuti da /ricarica sono ammessi solo dentro 'cartella' (se
+    indicata) o, senza, solo se sono quelli di avvio (vedi percorsi_ammessi).
+    """
+
+    def __init__(self, files: Dict[str, Optional[str]], store: Optional[SnapshotStore] = None,
+                 annidati: bool = False, processi: bool = True, max_workers: Optional[int] = None,
+                 cartella: Optional[str] = None):
+        self.files = dict(files)
+        self.cartella = Path(cartella).resolve() if cartella else None
+        self._avvio = {s: Path(f).resolve() for s, f in files.items() if f}
+        self.store = store
+        self.annidati = annidati
+        self.processi = processi
+        self.max_workers = max_workers
+        self.cache = ExportCache()
+        self.risultati = ExportCache(RISULTATI_MAX_ENTRIES, RISULTATI_MAX_BYTES)
+        self._lock_ricarica = threading.Lock()
+        self.snapshot: Optional[Snapshot] = None
+        self.caricato: Optional[str] = None
+        self.ricarica()
+
+    def ricarica(self, files: Optional[Dict[str, Optional[str]]] = None) -> Snapshot:
+        """
+        Rilegge gli export; 'files' sostituisce i percorsi delle sorgenti indicate.
+        Se uno di questi non si legge (RicaricaNonRiuscita) restano snapshot e
+        percorsi precedenti: un file mancante non svuota le risposte.
+        """
+        with self._lock_ricarica:
+            nuovi = dict(self.files)
+            nuovi.update(files or {})
+            snapshot = carica_snapshot(nuovi, self.cache, max_workers=self.max_workers, processi=self.processi,
+                                       store=self.store, annidati=self.annidati, risultati=self.risultati)
+            falliti = {s: e for s, e in snapshot.errori.items() if s in (files or {})}
+            if falliti and self.snapshot is not None:
+                raise RicaricaNonRiuscita(falliti)
+            self.files = nuovi
+            self.snapshot, self.caricato = snapshot, datetime.now().isoformat(timespec="seconds")
+            return snapshot
+
+    def percorsi_ammessi(self, richiesti: Dict[str, Any]) -> Dict[str, Optional[str]]:
+        """
+        Percorsi di /ricarica risolti e verificati (None toglie la sorgente);
+        ValueError se un percorso non è una stringa o è fuori dalla cartella
+        ammessa (o non è un file di avvio).
+        """
+        ammessi: Dict[str, Optional[str]] = {}
+        for source, valore in richiesti.items():
+            if valore is None:
+                # nessun file: la sorgente torna all'archivio (o vuota), non si legge nulla
+                ammessi[source] = None
+                continue
+            if not isinstance(valore, str) or not valore:
+                raise ValueError(f"{source}: indicare il percorso del file")
+            if self.cartella is not None:
+                percorso = (self.cartella / valore).resolve()
+                if not percorso.is_relative_to(self.cartella):
+                    raise ValueError(f"{source}: percorso fuori dalla cartella degli export")
+            else:
+                percorso = Path(valore).resolve()
+                if percorso != self._avvio.get(source):
+                    raise ValueError(f"{source}: senza --cartella si possono rileggere solo i file di avvio")
+            ammessi[source] = str(percorso)
+        return ammessi
+
+    def stato(self) -> Dict[str, Any]:
+        snapshot = self.snapshot
+        return {
+            "impronta": snapshot.impronta,
+            "caricato": self.caricato,
+            "export": {s: {"digest": snapshot.digests.get(s), "righe": len(snapshot.dfs[s])} for s in SORGENTI},
+            "annidati": snapshot.grafo is not None,
+            "motore": motore().nome,
+            "errori": snapshot.errori,
+            "risultati_in_cache": len(self.risultati),
+        }
+
+
+def _handler(servizio: Servizio):
+    class Handler(BaseHTTPRequestHandler):
+        server_version = "Deprovisioning/1.0"
+
+        def _rispondi(self, codice: int, corpo: Dict[str, Any]) -> None:
+            dati = json.dumps(corpo, ensure_ascii=False).encode("utf-8")
+            self.send_response(codice)
+            self.send_header("Content-Type", "application/json; charset=utf-8")
+            self.send_header("Content-Length", str(len(dati)))
+            self.end_headers()
+            self.wfile.write(dati)
+
+        def _corpo_json(self) -> Any:
+            lunghezza = int(self.headers.get("Content-Length") or 0)
+            if not lunghezza:
+                return {}
+            return json.loads(self.rfile.read(lunghezza).decode("utf-8"))
+
+        def do_GET(self):
+            self._esegui(self._get)
+
+        def do_POST(self):
+            self._esegui(self._post)
+
+        def _esegui(self, gestore) -> None:
+            try:
+                gestore()
+            except Exception as exc:
+                self._rispondi(500, {"errore": f"{type(exc).__name__}: {exc}"})
+
+        def _get(self) -> None:
+            percorso = urlsplit(self.path).path.rstrip("/")
+            if percorso == "/stato":
+                self._rispondi(200, servizio.stato())
+            elif percorso.startswith("/utenti/") and len(percorso) > len("/utenti/"):
+                sam = unquote(percorso[len("/utenti/"):]).strip()
+                if not sam:
+                    self._rispondi(400, {"errore": "Indicare un sAMAccountName"})
+                    return
+                self._rispondi(200, elabora_utente(sam, servizio.snapshot).to_dict())
+            else:
+                self._rispondi(404, {"errore": f"Percorso sconosciuto: {percorso}"})
+
+        def _post(self) -> None:
+            percorso = urlsplit(self.path).path.rstrip("/")
+            try:
+                corpo = self._corpo_json()
+            except (ValueError, UnicodeDecodeError) as exc:
+                self._rispondi(400, {"errore": f"JSON non valido: {exc}"})
+                return
+            if percorso == "/batch":
+                sams = corpo.get("sam") if isinstance(corpo, dict) else None
+                if isinstance(sams, str):
+                    sams = parse_elenco_sam(sams)
+                if not isinstance(sams, list) or not sams or not all(isinstance(s, str) and s.strip() for s in sams):
+                    self._rispondi(400, {"errore": 'Indicare "sam": elenco di sAMAccountName (non vuoti)'})
+                    return
+                if len(sams) > MAX_BATCH:
+                    self._rispondi(400, {"errore": f"Massimo {MAX_BATCH} account per richiesta"})
+                    return
+                risultati = elabora_batch(sams, servizio.snapshot)
+                self._rispondi(200, {"risultati": [r.to_dict() for r in risultati]})
+            elif percorso == "/gruppi":
+                gruppi = corpo.get("gruppi") if isinstance(corpo, dict) else None
+                if isinstance(gruppi, str):
+                    gruppi = parse_elenco_gruppi(gruppi)
+                if not isinstance(gruppi, list) or not gruppi or not all(isinstance(g, str) for g in gruppi):
+                    self._rispondi(400, {"errore": 'Indicare "gruppi": elenco di nomi o indirizzi di gruppo'})
+                    return
+                if len(gruppi) > MAX_BATCH:
+                    self._rispondi(400, {"errore": f"Massimo {MAX_BATCH} gruppi per richiesta"})
+                    return
+                report = report_membri_gruppi(gruppi, servizio.snapshot)
+                self._rispondi(200, {"membri": report.to_dict(orient="records"),
+                                     "gruppi_non_trovati": gruppi_non_trovati(gruppi, report)})
+            elif percorso == "/ricognizione":
+                attivi = corpo.get("attivi") if isinstance(corpo, dict) else None
+                if isinstance(attivi, str):
+                    attivi = parse_elenco_sam(attivi)
+                if not isinstance(attivi, list) or not attivi or not all(isinstance(a, str) for a in attivi):
+                    self._rispondi(400, {"errore": 'Indicare "attivi": elenco degli account attivi'})
+                    return
+                residui, non_risolti, non_trovati = ricognizione_accessi(parse_elenco_sam("\n".join(attivi)),
+                                                                         servizio.snapshot)
+                risposta = {"residui": residui.to_dict(orient="records"),
+                            "non_risolti": non_risolti.to_dict(orient="records"), "attivi_non_trovati": non_trovati}
+                if corpo.get("dettaglio"):
+                    if len(residui) > MAX_BATCH:
+                        self._rispondi(400, {"errore": f"{len(residui)} account con accessi residui: il dettaglio è "
+                                                       f"disponibile fino a {MAX_BATCH}, usare /batch a blocchi"})
+                        return
+                    risposta["risultati"] = [r.to_dict() for r in elabora_batch(residui["Account"].tolist(),
+                                                                                servizio.snapshot)]
+                self._rispondi(200, risposta)
+            elif percorso == "/ricarica":
+                if not isinstance(corpo, dict) or any(k not in SORGENTI for k in corpo):
+                    self._rispondi(400, {"errore": f"Chiavi ammesse: {', '.join(SORGENTI)}"})
+                    return
+                try:
+                    files = servizio.percorsi_ammessi(corpo)
+                except ValueError as exc:
+                    self._rispondi(403, {"errore": str(exc)})
+                    return
+                try:
+                    servizio.ricarica(files)
+                except RicaricaNonRiuscita as exc:
+                    self._rispondi(422, {"errore": "Export non leggibili: snapshot precedente ancora in uso",
+                                         "errori": exc.errori})
+                    return
+                self._rispondi(200, servizio.stato())
+            else:
+                self._rispondi(404, {"errore": f"Percorso sconosciuto: {percorso}"})
+
+        def log_message(self, format, *args):
+            print(f"[{self.log_date_time_string()}] {format % args}", file=sys.stderr)
+
+    return Handler
+
+
+def _parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(
+        description="Servizio HTTP/JSON locale: carica gli export una volta e risponde alle richieste "
+                    "di deprovisioning per account o per elenco."
+    )
+    for source in SORGENTI:
+        parser.add_argument(f"--{source}", metavar="FILE", help=f"export {ETICHETTE_SORGENTI[source]}")
+    parser.add_argument("--store", metavar="FILE", default=os.environ.get("DEPROVISIONING_STORE"),
+                        help="archivio SQLite degli export: le sorgenti senza file usano la versione corrente; "
+                             "contiene solo dati (array e JSON, niente pickle) ma include account e appartenenze, "
+                             "va protetto come gli export (default: variabile DEPROVISIONING_STORE)")
+    parser.add_argument("--annidati", action="store_true",
+                        help="riporta anche i gruppi AD ereditati tramite gruppi annidati (export MG)")
+    parser.add_argument("--host", default="127.0.0.1",
+                        help="indirizzo di ascolto (default: solo locale); il servizio non ha autenticazione "
+                             "e non va esposto in rete")
+    parser.add_argument("--cartella", metavar="DIR",
+                        help="cartella da cui /ricarica può leggere nuovi export (percorsi relativi a DIR); "
+                             "senza, /ricarica rilegge solo i file indicati all'avvio")
+    parser.add_argument("--porta", type=int, default=8765, help="porta di ascolto")
+    parser.add_argument("--thread", action="store_true",
+                        help="carica i file con thread invece che con processi separati")
+    parser.add_argument("--workers", type=int, default=None, help="numero massimo di worker di caricamento")
+    parser.add_argument("--motore", choices=list(MOTORI), default=os.environ.get("DEPROVISIONING_MOTORE", "pandas"),
+                        help="motore delle operazioni su testo degli indici: stessi risultati, tempi diversi "
+                             "(arrow richiede pyarrow; default: variabile DEPROVISIONING_MOTORE o pandas)")
+    return parser
+
+
+def _locale(host: str) -> bool:
+    """True se 'host' è un indirizzo di loopback (o localhost)."""
+    if host == "localhost":
+        return True
+    try:
+        return ipaddress.ip_address(host).is_loopback
+    except ValueError:
+        return False
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    args = _parser().parse_args(argv)
+    try:
+        imposta_motore(args.motore)
+    except ValueError as exc:
+        print(exc, file=sys.stderr)
+        return 2
+    files = {source: getattr(args, source) for source in SORGENTI}
+    store = SnapshotStore(args.store) if args.store else None
+
+    servizio = Servizio(files, store=store, annidati=args.annidati, processi=not args.thread,
+                        max_workers=args.workers, cartella=args.cartella)
+    for source, errore in servizio.snapshot.errori.items():
+        print(f"Errore nella lettura del file {ETICHETTE_SORGENTI[source]}: {errore}", file=sys.stderr)
+
+    if not _locale(args.host):
+        print(f"Attenzione: {args.host} non è un indirizzo locale e il servizio non ha autenticazione: "
+              "chiunque raggiunga la porta può leggere i dati degli export", file=sys.stderr)
+    server = ThreadingHTTPServer((args.host, args.porta), _handler(servizio))
+    print(f"In ascolto su http://{args.host}:{server.server_port}", file=sys.stderr)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
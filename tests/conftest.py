@@ -0,0 +1,52 @@
+# -*- coding: utf-8 -*-
+# Dati di prova comuni: export piccoli ma "sporchi" come quelli reali
+# (maiuscole, spazi, celle con più membri, vuoti e mancanti).
+
+import sys
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+import pytest
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+ACCOUNT = ["mario.rossi", "m.rossi", "anna.bianchi", "luca.verdi", "sara.neri", "ext.fornitore"]
+GRUPPI = ["GRP_A", "grp_a", "GRP_B", "Gruppo Spazio", "Domain Users", "APP_X", " APP_Y "]
+
+
+def _forma(rng: np.random.Generator, account: str) -> str:
+    """Una forma qualsiasi dell'account, con maiuscole e spazi casuali."""
+    forma = [account, f"{account}@consip.it", f"{account}@consip.onmicrosoft.com"][rng.integers(0, 3)]
+    if rng.random() < 0.3:
+        forma = forma.upper()
+    return f" {forma} " if rng.random() < 0.2 else forma
+
+
+def export_casuali(seed: int, righe: int = 400) -> dict:
+    """Export MG (un membro per riga) e DL (celle multi-membro) con valori ripetuti e vuoti."""
+    rng = np.random.default_rng(seed)
+
+    def gruppo():
+        return GRUPPI[rng.integers(0, len(GRUPPI))] if rng.random() > 0.05 else np.nan
+
+    mg = pd.DataFrame({
+        "Member": [_forma(rng, ACCOUNT[rng.integers(0, len(ACCOUNT))]) if rng.random() > 0.05 else ""
+                   for _ in range(righe)],
+        "Group": [gruppo() for _ in range(righe)],
+    })
+    celle = []
+    for _ in range(righe):
+        n = rng.integers(0, 4)
+        sep = [";", ",", " ; ", "\n"][rng.integers(0, 4)]
+        celle.append(sep.join(_forma(rng, ACCOUNT[rng.integers(0, len(ACCOUNT))]) for _ in range(n)))
+    dl = pd.DataFrame({
+        "Member Alias": celle,
+        "Distribution Group Primary SMTP address": [f"dl{rng.integers(0, 8)}@consip.it" for _ in range(righe)],
+    })
+    return {"mg": mg, "dl": dl}
+
+
+@pytest.fixture(params=[0, 1, 2])
+def export(request) -> dict:
+    return export_casuali(request.param)
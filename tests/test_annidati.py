@@ -0,0 +1,67 @@
+# -*- coding: utf-8 -*-
+# Gruppi annidati: chiusura transitiva con cicli, confrontata con una visita in ampiezza.
+
+from collections import deque
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from deprovisioning_core import GrafoGruppi, indice_mg
+
+
+def grafo(coppie) -> GrafoGruppi:
+    return GrafoGruppi(indice_mg(pd.DataFrame(coppie, columns=["Member", "Group"])))
+
+
+def visita(coppie, gruppo: str) -> set:
+    """Riferimento: gruppi raggiungibili da 'gruppo' (incluso) seguendo membro -> gruppo."""
+    padri = {}
+    for membro, g in coppie:
+        padri.setdefault(membro.strip().lower(), set()).add(g)
+    visti, coda = {gruppo}, deque([gruppo])
+    while coda:
+        for p in padri.get(coda.popleft().lower(), ()):
+            if p not in visti:
+                visti.add(p)
+                coda.append(p)
+    return visti
+
+
+def test_ciclo_e_autoanello():
+    coppie = [
+        ("mario.rossi", "GRP_A"), ("GRP_A", "GRP_B"), ("GRP_B", "GRP_C"), ("GRP_C", "GRP_A"),
+        ("grp_c", "GRP_D"), ("GRP_E", "GRP_D"), ("mario.rossi", "GRP_F"), ("GRP_F", "GRP_F"),
+        ("GRP_D", "Domain Users"),
+    ]
+    diretti, ereditati = grafo(coppie).diretti_ed_ereditati("mario.rossi")
+    assert diretti == ["GRP_A", "GRP_F"]
+    assert ereditati == ["GRP_B", "GRP_C", "GRP_D"]
+
+
+def test_senza_gruppi_annidati():
+    diretti, ereditati = grafo([("mario.rossi", "GRP_A"), ("anna.bianchi", "GRP_B")]).diretti_ed_ereditati(
+        "mario.rossi")
+    assert (diretti, ereditati) == (["GRP_A"], [])
+    assert grafo([("x", "GRP_A")]).diretti_ed_ereditati("nessuno") == ([], [])
+
+
+@pytest.mark.parametrize("seed", range(5))
+def test_chiusure_casuali_come_visita(seed):
+    rng = np.random.default_rng(seed)
+    nomi = [f"G{i}" for i in range(40)]
+    coppie = [(nomi[a], nomi[b]) for a, b in rng.integers(0, len(nomi), (60, 2))]
+    # l'ordine delle richieste cambia quali chiusure sono già memorizzate
+    g = grafo(coppie)
+    gruppi = g.mg_index.gruppi.tolist()
+    for codice in rng.permutation(len(gruppi)).tolist():
+        attese = visita(coppie, gruppi[codice])
+        assert {gruppi[c] for c in g.chiusura([codice])} == attese, gruppi[codice]
+
+
+def test_catena_profonda_senza_ricorsione():
+    n = 5000
+    coppie = [(f"G{i}", f"G{i + 1}") for i in range(n)] + [("u", "G0"), (f"G{n}", "G0")]
+    diretti, ereditati = grafo(coppie).diretti_ed_ereditati("u")
+    assert diretti == ["G0"]
+    assert len(ereditati) == n
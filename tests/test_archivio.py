@@ -0,0 +1,111 @@
+# -*- coding: utf-8 -*-
+# Archivio snapshot: DF e indici salvati e riletti senza pickle, formato, versione corrente.
+
+import io
+import sqlite3
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from conftest import export_casuali
+from deprovisioning_core import (
+    _BUILDER_INDICI,
+    FORMATO_ARCHIVIO,
+    SnapshotStore,
+    _compatta,
+    _df_in_blob,
+    carica_snapshot,
+)
+
+
+@pytest.fixture
+def store(tmp_path) -> SnapshotStore:
+    return SnapshotStore(tmp_path / "snapshot.db")
+
+
+def _export(source: str, seed: int) -> pd.DataFrame:
+    """Export come li producono i loader: testo categorico o str, 0..n-1, colonne originali negli attrs."""
+    df = _compatta(export_casuali(seed)[source].astype("str"))
+    df.attrs["colonne_originali"] = df.columns.tolist() + ["Note"]
+    return df
+
+
+@pytest.mark.parametrize("source", ["mg", "dl"])
+def test_df_e_indice_come_salvati(store, source):
+    df = _export(source, 0)
+    # colonne che solo la lettura Excel completa produce: numeri, date, testo misto
+    df["Numero"] = np.arange(len(df), dtype=np.int64)
+    df["Data"] = pd.Timestamp("2024-01-02") + pd.to_timedelta(df["Numero"], unit="D")
+    df["Misto"] = pd.Series([1, "a", None, 2.5] * (len(df) // 4), dtype=object)
+    indice = _BUILDER_INDICI[source](df)
+    store.salva(source, "v1", df, indice)
+
+    df2, indice2 = store.carica(source, "v1")
+    # nel testo misto i valori non testuali tornano come stringhe, i mancanti come NaN
+    misto = pd.Series([np.nan if v is None else str(v) for v in df["Misto"]], dtype=object)
+    pd.testing.assert_frame_equal(df2, df.assign(Misto=misto))
+    assert df2.attrs == df.attrs
+    for membro in indice.vocab_membri:
+        assert indice2.lookup(membro) == indice.lookup(membro), membro
+    for gruppo in set(indice.gruppi):
+        assert indice2.membri_di(gruppo) == indice.membri_di(gruppo), gruppo
+    assert store.carica(source, "altra") is None
+
+
+def test_blob_senza_oggetti_python(store):
+    df = _export("mg", 1)
+    # ogni array del blob si legge con allow_pickle=False
+    with np.load(io.BytesIO(_df_in_blob(df)), allow_pickle=False) as npz:
+        assert all(npz[k].dtype != object for k in npz.files)
+    # un blob manomesso con un array di oggetti (pickle) viene rifiutato
+    store.salva("mg", "v1", df)
+    buf = io.BytesIO()
+    np.savez(buf, _meta=np.array("{}"), c0=np.array([object()], dtype=object))
+    with sqlite3.connect(store.path) as conn:
+        conn.execute("UPDATE export SET tabella = ? WHERE digest = 'v1'", (buf.getvalue(),))
+    with pytest.raises(ValueError):
+        store.carica("mg", "v1")
+
+
+def test_formato_diverso_svuota_archivio(store):
+    store.salva("mg", "v1", _export("mg", 0))
+    with sqlite3.connect(store.path) as conn:
+        conn.execute(f"PRAGMA user_version = {FORMATO_ARCHIVIO - 1}")
+    riaperto = SnapshotStore(store.path)
+    assert riaperto.versioni_registrate() == [] and riaperto.corrente() == {}
+    riaperto.salva("mg", "v2", _export("mg", 0))
+    assert SnapshotStore(store.path).corrente() == {"mg": "v2"}
+
+
+def test_versioni_conservate(tmp_path):
+    store = SnapshotStore(tmp_path / "snapshot.db", versioni=1)
+    for digest in ["v1", "v2", "v3"]:
+        store.salva("mg", digest, _export("mg", 0))
+    assert [v["digest"] for v in store.versioni_registrate()] == ["v3", "v2"]
+    # la versione corrente non viene mai eliminata
+    store.imposta_corrente("mg", "v2")
+    store.salva("mg", "v4", _export("mg", 0), corrente=False)
+    store.salva("mg", "v5", _export("mg", 0), corrente=False)
+    assert {v["digest"]: v["corrente"] for v in store.versioni_registrate()} == {"v5": False, "v4": False,
+                                                                                 "v2": True}
+
+
+def test_sorgente_senza_file_usa_la_corrente(store, tmp_path):
+    versioni = {}
+    for seed in [0, 1]:
+        path = tmp_path / f"mg{seed}.csv"
+        export_casuali(seed)["mg"].to_csv(path, index=False)
+        snapshot = carica_snapshot({"mg": str(path)}, store=store)
+        versioni[seed] = (snapshot.digests["mg"], snapshot.dfs["mg"], snapshot.indici["mg"])
+    assert store.corrente() == {"mg": versioni[1][0]}
+
+    for seed in [1, 0]:
+        digest, df, indice = versioni[seed]
+        store.imposta_corrente("mg", digest)
+        # nessun file e nessuna cache in memoria: tutto dall'archivio
+        snapshot = carica_snapshot({}, store=store)
+        assert snapshot.digests["mg"] == digest and not snapshot.errori
+        pd.testing.assert_frame_equal(snapshot.dfs["mg"], df)
+        for membro in indice.vocab_membri:
+            assert snapshot.indici["mg"].lookup(membro) == indice.lookup(membro), membro
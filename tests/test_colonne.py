@@ -0,0 +1,96 @@
+# -*- coding: utf-8 -*-
+# Schema colonne e controllo preliminare: solo intestazioni, colonne mancanti o ambigue, cache per intestazione.
+
+import gzip
+import io
+
+import pandas as pd
+import pytest
+
+from deprovisioning_core import (
+    ExportCache,
+    _chiave_colonne,
+    _schema,
+    preflight_export,
+    schema_colonne,
+)
+
+
+def _xlsx(intestazione) -> bytes:
+    from openpyxl import Workbook
+
+    wb = Workbook()
+    wb.active.append(intestazione)
+    stream = io.BytesIO()
+    wb.save(stream)
+    return stream.getvalue()
+
+
+def _file(tmp_path, nome: str, contenuto: bytes) -> str:
+    path = tmp_path / nome
+    path.write_bytes(contenuto)
+    return str(path)
+
+
+def test_preflight_solo_intestazioni(tmp_path):
+    files = {
+        # intestazioni italiane, nessuna riga
+        "mg": _file(tmp_path, "mg.xlsx", _xlsx(["Membro", "Gruppo", "Abilitato"])),
+        # manca la colonna dei membri; le righe dopo l'intestazione non vengono lette
+        "dl": _file(tmp_path, "dl.csv", b"Distribution Group Primary SMTP address;Note\n\xff\xfe rotto \"\n"),
+        # due colonne corrispondono a 'membro' solo per somiglianza
+        "entra": _file(tmp_path, "entra.csv.gz", gzip.compress(b"Gruppo,UPN utente,UPN responsabile\n")),
+        "device": _file(tmp_path, "device.csv", b""),
+    }
+    schemi, errori = preflight_export(files)
+    assert set(schemi) == {"mg", "dl", "entra"} and set(errori) == {"device"}
+
+    assert schemi["mg"].ruoli["membro"] == "Membro" and schemi["mg"].ruoli["gruppo"] == "Gruppo"
+    assert not schemi["mg"].mancanti and not schemi["mg"].ambigue
+
+    assert schemi["dl"].mancanti == ("membro",)
+    assert schemi["dl"].ruoli["gruppo"] == "Distribution Group Primary SMTP address"
+    assert "DL: colonna 'membro' non trovata" in schemi["dl"].avvisi()
+
+    assert schemi["entra"].ruoli["membro"] == "UPN utente"
+    assert schemi["entra"].ambigue == {"membro": ("UPN responsabile",)}
+    assert any("ambigua" in a for a in schemi["entra"].avvisi())
+
+
+@pytest.mark.parametrize("source, en, it", [
+    ("mg", ["Member", "Group"], ["Membro", "Gruppo"]),
+    ("dl", ["Member Alias", "Distribution Group"], ["Alias Membro", "Gruppo di distribuzione"]),
+    ("entra", ["MemberUserPrincipalName", "GroupName"], ["UserPrincipalNameMembro", "NomeGruppo"]),
+    ("device", ["Enabled", "Description", "Name", "Mail"], ["Abilitato", "Descrizione", "Nome", "Posta"]),
+])
+def test_intestazioni_en_it(source, en, it):
+    schema_en, schema_it = schema_colonne(source, en), schema_colonne(source, it)
+    assert not schema_en.mancanti and not schema_it.mancanti
+    ruoli_en = {r: en.index(c) for r, c in schema_en.ruoli.items() if c}
+    assert ruoli_en == {r: it.index(c) for r, c in schema_it.ruoli.items() if c}
+
+
+def test_preflight_cache_per_contenuto(tmp_path):
+    cache = ExportCache()
+    mg = _xlsx(["Member", "Group"])
+    schemi, _ = preflight_export({"mg": _file(tmp_path, "a.xlsx", mg)}, cache)
+    # stesso contenuto con un altro nome: intestazioni dalla cache, stesso schema
+    di_nuovo, _ = preflight_export({"mg": _file(tmp_path, "b.xlsx", mg)}, cache)
+    assert len(cache) == 1 and di_nuovo["mg"] is schemi["mg"]
+
+
+def test_index_diversi_stesse_etichette():
+    uno, due = pd.Index(["Member", "Group"]), pd.Index(["Member", "Group"])
+    assert uno is not due
+    assert _chiave_colonne(uno) == _chiave_colonne(due) == ("Member", "Group")
+    _schema.cache_clear()
+    assert schema_colonne("mg", uno) is schema_colonne("mg", due) is schema_colonne("mg", ["Member", "Group"])
+    assert _schema.cache_info().hits == 2
+
+
+def test_index_con_id_riusato():
+    # Index creati e rilasciati in sequenza riusano spesso lo stesso id: mai la tupla di un altro
+    for i in range(1000):
+        colonne = pd.Index([f"Member{i}", "Group"])
+        assert _chiave_colonne(colonne) == (f"Member{i}", "Group")
+        assert schema_colonne("mg", colonne).ruoli["membro"] == f"Member{i}"
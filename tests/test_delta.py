@@ -0,0 +1,79 @@
+# -*- coding: utf-8 -*-
+# Aggiornamento per differenza: stesso indice e stessi conteggi della ricostruzione completa.
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from conftest import export_casuali
+from deprovisioning_core import _BUILDER_INDICI, aggiorna_per_differenza, conteggio_nomi_gruppo, delta_righe
+
+
+def modifica(df: pd.DataFrame, seed: int, nuovi_gruppi: bool) -> pd.DataFrame:
+    """Nuova versione: righe tolte, duplicate, cambiate e aggiunte (anche con gruppi mai visti)."""
+    rng = np.random.default_rng(seed)
+    tenute = df[rng.random(len(df)) > 0.08]
+    doppie = df.sample(10, random_state=seed)
+    cambiate = df.sample(10, random_state=seed + 1).copy()
+    cambiate.iloc[:, 0] = cambiate.iloc[:, 0].astype(object).radd("nuovo.")
+    nuove = df.sample(5, random_state=seed + 2).copy()
+    if nuovi_gruppi:
+        nuove.iloc[:, 1] = [f"GRP_NUOVO_{i}" for i in range(len(nuove))]
+    return pd.concat([tenute, doppie, cambiate, nuove], ignore_index=True)
+
+
+def confronta(aggiornato, ricostruito) -> None:
+    membri = set(aggiornato.vocab_membri) | set(ricostruito.vocab_membri)
+    assert len(aggiornato) == len(ricostruito)
+    for m in membri:
+        assert aggiornato.lookup(m) == ricostruito.lookup(m), m
+    for g in set(ricostruito.gruppi):
+        assert aggiornato.membri_di(g) == ricostruito.membri_di(g), g
+
+
+@pytest.mark.parametrize("source", ["mg", "dl"])
+@pytest.mark.parametrize("nuovi_gruppi", [False, True])
+def test_delta_come_ricostruzione(source, nuovi_gruppi, export):
+    build = _BUILDER_INDICI[source]
+    vecchio = export[source]
+    nuovo = modifica(vecchio, 7, nuovi_gruppi)
+    esito = aggiorna_per_differenza(source, vecchio, build(vecchio), conteggio_nomi_gruppo(vecchio, source), nuovo)
+    assert esito is not None
+    indice, conteggio, cambiate = esito
+    assert cambiate > 0
+    confronta(indice, build(nuovo))
+    assert conteggio == conteggio_nomi_gruppo(nuovo, source)
+
+
+def test_delta_successivi():
+    vecchio = export_casuali(3)["mg"]
+    indice, conteggio = _BUILDER_INDICI["mg"](vecchio), conteggio_nomi_gruppo(vecchio, "mg")
+    for passo in range(3):
+        nuovo = modifica(vecchio, passo, nuovi_gruppi=passo == 1)
+        indice, conteggio, _ = aggiorna_per_differenza("mg", vecchio, indice, conteggio, nuovo)
+        vecchio = nuovo
+    confronta(indice, _BUILDER_INDICI["mg"](vecchio))
+    assert conteggio == conteggio_nomi_gruppo(vecchio, "mg")
+
+
+def test_gruppo_svuotato_sparisce():
+    vecchio = pd.DataFrame({"Member": ["a", "b", "a", "c"] * 2, "Group": ["G1", "G1", "G2", "G1"] * 2})
+    nuovo = vecchio[vecchio["Group"] != "G2"].reset_index(drop=True)
+    indice, _, _ = aggiorna_per_differenza("mg", vecchio, _BUILDER_INDICI["mg"](vecchio), None, nuovo)
+    assert indice.lookup("a") == ["G1"]
+    assert indice.membri_di("G2") == []
+
+
+def test_molteplicita_delle_righe():
+    vecchio = pd.DataFrame({"Member": ["a", "a", "b"], "Group": ["G", "G", "H"]})
+    nuovo = pd.DataFrame({"Member": ["a", "b", "c"], "Group": ["G", "H", "H"]})
+    aggiunte, pesi_agg, rimosse, pesi_rim = delta_righe(vecchio, nuovo)
+    assert aggiunte.to_dict("list") == {"Member": ["c"], "Group": ["H"]} and pesi_agg.tolist() == [1]
+    assert rimosse.to_dict("list") == {"Member": ["a"], "Group": ["G"]} and pesi_rim.tolist() == [1]
+
+
+def test_ricostruzione_se_colonne_diverse_o_troppi_cambi(export):
+    vecchio = export["mg"]
+    indice = _BUILDER_INDICI["mg"](vecchio)
+    assert aggiorna_per_differenza("mg", vecchio, indice, None, vecchio.rename(columns={"Group": "Gruppo"})) is None
+    assert aggiorna_per_differenza("mg", vecchio, indice, None, export_casuali(99)["mg"]) is None
@@ -0,0 +1,83 @@
+# -*- coding: utf-8 -*-
+# Tabella identità: un riferimento dei PC non deve mai spostare i gruppi su un altro account.
+
+import pandas as pd
+
+from deprovisioning_core import HEADER_MODIFICA, Snapshot, elabora_utente, report_membri_gruppi
+
+RIMOZIONE = HEADER_MODIFICA.index("RimozioneGruppo")
+
+
+def device(*righe) -> pd.DataFrame:
+    return pd.DataFrame(
+        [(f"PC{i}", "True", desc, mail, "", "") for i, (desc, mail) in enumerate(righe)],
+        columns=["Name", "Enabled", "Description", "Mail", "Mobile", "userPrincipalName"],
+    )
+
+
+def snapshot(mg, dev=None, entra=None) -> Snapshot:
+    return Snapshot.da_dataframe(
+        mg=pd.DataFrame(mg, columns=["Member", "Group"]),
+        device=dev,
+        entra=pd.DataFrame(entra, columns=["MemberUserPrincipalName", "GroupName"]) if entra else None,
+    )
+
+
+def test_mail_del_pc_non_sposta_un_altro_sam():
+    # m.rossi e mario.rossi sono due persone; il PC di m.rossi ha la mail di mario.rossi
+    snap = snapshot([("m.rossi", "GRP_A"), ("mario.rossi", "GRP_B")],
+                    device(("NB - m.rossi - Roma", "mario.rossi@consip.it")))
+    assert snap.identita.chiave("mario.rossi") == "mario.rossi"
+    assert snap.identita.chiave("mario.rossi@consip.it") != "m.rossi"
+    assert "mario.rossi@consip.it" in snap.identita.forme("mario.rossi")
+    assert "mario.rossi@consip.it" not in snap.identita.forme("m.rossi")
+
+    mario = elabora_utente("mario.rossi", snap)
+    assert mario.sam == "mario.rossi"
+    assert mario.riga[RIMOZIONE] == "GRP_B"
+    m = elabora_utente("m.rossi", snap)
+    assert m.riga[RIMOZIONE] == "GRP_A"
+    assert "PC0" in (m.device_csv or "")
+
+    report = report_membri_gruppi(["GRP_B"], snap)
+    assert report["Account"].tolist() == ["mario.rossi"]
+
+
+def test_mail_del_pc_in_conflitto_con_il_dominio():
+    # l'indirizzo compare anche in Entra: vale la parte locale, che è un account noto
+    snap = snapshot([("m.rossi", "GRP_A"), ("mario.rossi", "GRP_B")],
+                    device(("NB - m.rossi - Roma", "mario.rossi@consip.it")),
+                    entra=[("mario.rossi@consip.it", "AZ_B")])
+    assert snap.identita.chiave("mario.rossi@consip.it") == "mario.rossi"
+    assert "AZ_B" in "\n".join(elabora_utente("mario.rossi", snap).istruzioni)
+    assert "AZ_B" not in "\n".join(elabora_utente("m.rossi", snap).istruzioni)
+
+
+def test_mail_del_pc_collega_un_indirizzo_senza_account():
+    # la parte locale non è un account negli export: vale il riferimento del PC
+    snap = snapshot([("mrossi", "GRP_A")], device(("NB - mrossi - Roma", "mario.rossi@consip.it")),
+                    entra=[("mario.rossi@consip.it", "AZ_1")])
+    assert snap.identita.chiave("mario.rossi@consip.it") == "mrossi"
+    assert "mario.rossi@consip.it" in snap.identita.forme("mrossi")
+    # nessun alias sulla parte locale
+    assert snap.identita.chiave("mario.rossi") == "mario.rossi"
+    assert "AZ_1" in "\n".join(elabora_utente("mrossi", snap).istruzioni)
+
+
+def test_riferimento_ambiguo_scartato():
+    # stessa mail su PC di due account diversi: resta la regola del dominio
+    snap = snapshot([("a.b", "GRP_A"), ("c.d", "GRP_C")],
+                    device(("NB - a.b - Roma", "x.y@consip.it"), ("NB - c.d - Roma", "x.y@consip.it")),
+                    entra=[("x.y@consip.it", "AZ_1")])
+    assert snap.identita.chiave("x.y@consip.it") == "x.y"
+
+
+def test_domini_del_tenant_e_identificativi_semplici():
+    snap = snapshot([("mario.rossi", "GRP_A"), ("Mario.Rossi@Consip.onmicrosoft.com", "GRP_B"),
+                     ("mario.rossi@gmail.com", "GRP_C"), ("anna", "GRP_D")])
+    identita = snap.identita
+    assert identita.chiave("mario.rossi@consip.onmicrosoft.com") == "mario.rossi"
+    assert identita.chiave("mario.rossi@gmail.com") == "mario.rossi@gmail.com"
+    # un identificativo senza "@" non viene mai ricondotto a un altro
+    assert all(identita.chiave(v) == v for v in snap.indici["mg"].vocab_membri if "@" not in v)
+    assert elabora_utente("mario.rossi", snap).riga[RIMOZIONE] == "GRP_A;GRP_B"
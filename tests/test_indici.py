@@ -0,0 +1,55 @@
+# -*- coding: utf-8 -*-
+# Indice membro -> gruppi: stesso risultato della scansione riga per riga del file.
+
+import re
+
+import pandas as pd
+
+from deprovisioning_core import MembershipIndex, indice_dl, indice_mg
+
+
+def scansione(df: pd.DataFrame, member_col: str, group_col: str, explode: bool) -> dict:
+    """Riferimento ingenuo: membro normalizzato -> gruppi, nell'ordine di lookup."""
+    gruppi = {}
+    for membro, gruppo in zip(df[member_col], df[group_col]):
+        if not isinstance(membro, str) or not isinstance(gruppo, str) or not gruppo.strip():
+            continue
+        membro = membro.strip().lower()
+        for parte in (re.split(r"[;,\s]+", membro) if explode else [membro]):
+            if parte:
+                gruppi.setdefault(parte, set()).add(gruppo.strip())
+    return {m: sorted(g, key=lambda x: (x.lower(), x)) for m, g in gruppi.items()}
+
+
+def test_mg_come_scansione(export):
+    mg = export["mg"]
+    index = indice_mg(mg)
+    attesi = scansione(mg, "Member", "Group", explode=False)
+    assert len(index) == len(attesi)
+    for membro, gruppi in attesi.items():
+        assert index.lookup(membro) == gruppi
+        assert index.lookup(f"  {membro.upper()} ") == gruppi
+
+
+def test_dl_celle_multiple_come_scansione(export):
+    dl = export["dl"]
+    index = indice_dl(dl)
+    attesi = scansione(dl, "Member Alias", "Distribution Group Primary SMTP address", explode=True)
+    assert len(index) == len(attesi)
+    for membro, gruppi in attesi.items():
+        assert index.lookup(membro) == gruppi
+
+
+def test_unione_di_piu_identificativi(export):
+    mg = export["mg"]
+    index = indice_mg(mg)
+    attesi = scansione(mg, "Member", "Group", explode=False)
+    forme = ["mario.rossi", "mario.rossi@consip.it", "mario.rossi@consip.onmicrosoft.com"]
+    unione = set().union(*(attesi.get(f, []) for f in forme))
+    assert index.lookup(*forme) == sorted(unione, key=lambda x: (x.lower(), x))
+
+
+def test_membro_assente_e_file_vuoto():
+    index = MembershipIndex.from_df(pd.DataFrame({"Member": ["a"], "Group": ["G"]}), "Member", "Group")
+    assert index.lookup("nessuno") == []
+    assert indice_mg(pd.DataFrame()) is None
@@ -0,0 +1,125 @@
+# -*- coding: utf-8 -*-
+# Lettura export: dialetti CSV (BOM, #TYPE, separatori, gzip), colonne usate e lettura a blocchi;
+# Excel per colonne (openpyxl read-only) come pd.read_excel, con rilettura completa se serve.
+
+import codecs
+import gzip
+import io
+from datetime import datetime
+
+import pandas as pd
+import pytest
+
+import deprovisioning_core
+from conftest import export_casuali
+from deprovisioning_core import _compatta, _read_csv_columns, _read_excel
+
+MG = "Member,Group,Note\nmario.rossi,GRP_A,x\nanna.bianchi,GRP_B,\n"
+
+
+def _csv(testo: str, sep: str = ",", encoding: str = "utf-8", bom: bytes = b"") -> bytes:
+    return bom + testo.replace(",", sep).encode(encoding)
+
+
+ATTESO = pd.DataFrame({"Member": ["mario.rossi", "anna.bianchi"], "Group": ["GRP_A", "GRP_B"],
+                       "Note": ["x", None]}, dtype="str")
+
+
+@pytest.mark.parametrize("raw", [
+    _csv(MG),
+    _csv(MG, bom=codecs.BOM_UTF8),
+    _csv('#TYPE Selected.System.Management.Automation.PSCustomObject\n' + MG, bom=codecs.BOM_UTF8),
+    _csv(MG, sep=";"),
+    _csv(MG, sep="\t", encoding="utf-16-le", bom=codecs.BOM_UTF16_LE),
+    gzip.compress(_csv(MG, sep="\t")),
+], ids=["utf8", "bom", "type", "puntoevirgola", "utf16-tab", "gzip"])
+def test_dialetti_csv(raw):
+    df = _read_csv_columns(raw)
+    pd.testing.assert_frame_equal(df, ATTESO)
+    assert df.attrs["colonne_originali"] == ["Member", "Group", "Note"]
+
+
+def test_solo_colonne_usate():
+    df = _read_csv_columns(_csv(MG, sep=";"), "mg")
+    assert df.columns.tolist() == ["Member", "Group"]
+    assert df.attrs["colonne_originali"] == ["Member", "Group", "Note"]
+    # nessuna colonna riconosciuta: si legge tutto
+    assert _read_csv_columns(_csv("A,B\n1,2\n"), "mg").columns.tolist() == ["A", "B"]
+
+
+def test_solo_intestazione():
+    df = _read_csv_columns(_csv("Member,Group\n"), "mg")
+    assert df.empty and df.columns.tolist() == ["Member", "Group"]
+
+
+@pytest.mark.parametrize("righe_blocco", [1, 7, 150, 10_000])
+@pytest.mark.parametrize("seed", [0, 1])
+def test_blocchi_come_lettura_unica(monkeypatch, righe_blocco, seed):
+    mg = export_casuali(seed)["mg"].assign(Unico=lambda d: [f"riga{i}" for i in range(len(d))])
+    raw = gzip.compress(mg.to_csv(index=False).encode("utf-8"))
+    unica = _compatta(_read_csv_columns(raw))
+    monkeypatch.setattr(deprovisioning_core, "CSV_CHUNK_ROWS", righe_blocco)
+    a_blocchi = _compatta(_read_csv_columns(raw))
+    pd.testing.assert_frame_equal(a_blocchi, unica)
+    assert a_blocchi["Member"].dtype == "category" and a_blocchi["Unico"].dtype == "str"
+
+
+def _xlsx(righe) -> io.BytesIO:
+    from openpyxl import Workbook
+
+    wb = Workbook()
+    for riga in righe:
+        wb.active.append(riga)
+    stream = io.BytesIO()
+    wb.save(stream)
+    stream.seek(0)
+    return stream
+
+
+# intestazioni vuote e duplicate, numeri, date, booleani, righe vuote e righe senza colonne usate
+FOGLIO = [
+    ["Member", "Group", None, "Member", " ", "Enabled", "Note"],
+    ["mario.rossi", "GRP_A", 1, "x", None, True, "n"],
+    [None, None, None, None, None, None, None],
+    [12345, "GRP_B", 2.5, None, None, False, "solo nota"],
+    [None, None, None, None, None, None, "riga con sola nota"],
+    [" anna.bianchi ", 1.5, datetime(2024, 1, 2), True, "y", None, None],
+    [0.1, datetime(2024, 1, 2, 8, 30), None, None, None, "False", None],
+]
+
+
+def test_excel_per_colonne_come_read_excel():
+    df = _read_excel(_xlsx(FOGLIO), "mg")
+    completo = pd.read_excel(_xlsx(FOGLIO), engine="openpyxl", dtype=str)
+    assert df.attrs["colonne_originali"] == completo.columns.tolist()
+    assert "lettura_completa" not in df.attrs
+    # le righe senza valori nelle colonne usate non servono a nessun indice
+    atteso = completo[df.columns.tolist()].dropna(how="all").reset_index(drop=True)
+    assert df.columns.tolist() == ["Member", "Group", "Enabled"]
+    pd.testing.assert_frame_equal(df.astype("str"), atteso)
+
+
+def test_excel_solo_intestazione():
+    df = _read_excel(_xlsx([["Member", "Group"]]), "mg")
+    assert df.empty and df.columns.tolist() == ["Member", "Group"]
+
+
+def test_excel_senza_colonne_note_legge_tutto():
+    df = _read_excel(_xlsx([["A", "B"], [1, "x"]]), "mg")
+    assert df.columns.tolist() == ["A", "B"] and df.attrs["lettura_completa"]
+
+
+def test_excel_rilettura_se_sola_lettura_fallisce(monkeypatch):
+    def fallisce(*_):
+        raise KeyError("xl/sharedStrings.xml")
+
+    monkeypatch.setattr(deprovisioning_core, "_read_excel_columns", fallisce)
+    df = _read_excel(_xlsx(FOGLIO), "mg")
+    pd.testing.assert_frame_equal(df, pd.read_excel(_xlsx(FOGLIO), engine="openpyxl"))
+    assert "KeyError" in df.attrs["lettura_completa"]
+
+
+def test_excel_corrotto_non_si_rilegge():
+    with pytest.raises(Exception) as exc:
+        _read_excel(io.BytesIO(b"PK\x03\x04 non un xlsx"), "mg")
+    assert not isinstance(exc.value, deprovisioning_core._ERRORI_SOLA_LETTURA)
@@ -0,0 +1,75 @@
+# -*- coding: utf-8 -*-
+# Motori delle operazioni su testo: stessi risultati e scelta per lavoro, non per processo.
+
+import io
+import threading
+
+import pytest
+
+from deprovisioning_core import (
+    _BUILDER_INDICI,
+    ExportCache,
+    MotoreArrow,
+    carica_export,
+    motore,
+    usa_motore,
+)
+
+pytest.importorskip("pyarrow")
+
+
+@pytest.mark.parametrize("source", ["mg", "dl"])
+def test_stessi_indici_con_i_due_motori(source, export):
+    with usa_motore("pandas"):
+        a = _BUILDER_INDICI[source](export[source])
+    with usa_motore("arrow"):
+        b = _BUILDER_INDICI[source](export[source])
+    assert a.vocab_membri.tolist() == b.vocab_membri.tolist()
+    for m in a.vocab_membri:
+        assert a.lookup(m) == b.lookup(m)
+
+
+def test_motore_per_thread_senza_cambiare_il_predefinito():
+    predefinito = motore().nome
+    insieme = threading.Barrier(2)
+    visti = {}
+
+    def lavoro(nome):
+        with usa_motore(nome):
+            insieme.wait(timeout=5)
+            visti[nome] = motore().nome
+            insieme.wait(timeout=5)
+
+    lavori = [threading.Thread(target=lavoro, args=(n,)) for n in ("pandas", "arrow")]
+    for t in lavori:
+        t.start()
+    for t in lavori:
+        t.join()
+    assert visti == {"pandas": "pandas", "arrow": "arrow"}
+    assert motore().nome == predefinito
+
+
+def test_caricamento_nei_worker_usa_il_motore_del_lavoro(export, monkeypatch):
+    chiamate = []
+    originale = MotoreArrow.testo
+
+    def spia(self, *args, **kwargs):
+        chiamate.append(threading.current_thread().name)
+        return originale(self, *args, **kwargs)
+
+    predefinito = motore().nome
+    monkeypatch.setattr(MotoreArrow, "testo", spia)
+    buf = io.BytesIO(export["mg"].to_csv(index=False).encode("utf-8"))
+    with usa_motore("arrow"):
+        _, _, errori = carica_export({"mg": buf}, ExportCache(), processi=False)
+    assert not errori
+    # la lettura avviene in un thread del pool, che non eredita il contesto del chiamante
+    assert any(nome != threading.current_thread().name for nome in chiamate)
+    # e il motore predefinito del processo non cambia
+    assert motore().nome == predefinito
+
+
+def test_motore_sconosciuto():
+    with pytest.raises(ValueError):
+        with usa_motore("nessuno"):
+            pass
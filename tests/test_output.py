@@ -0,0 +1,81 @@
+# -*- coding: utf-8 -*-
+# ZIP e CSV consolidato in streaming: stessi file di file_utente per ogni account, nomi unici, allegati.
+
+import csv
+import io
+import zipfile
+
+import pandas as pd
+import pytest
+
+from deprovisioning_core import (
+    HEADER_MODIFICA,
+    Snapshot,
+    elabora_batch,
+    file_utente,
+    itera_batch,
+    nome_batch,
+    scrivi_csv_consolidato,
+    scrivi_risultati,
+    scrivi_zip,
+)
+
+# mario.rossi e m.rossi hanno lo stesso nome file (Deprovisioning_Rossi_M.csv)
+SAMS = ["mario.rossi", "m.rossi", "anna.bianchi", "non.esiste"]
+
+
+@pytest.fixture
+def snap() -> Snapshot:
+    return Snapshot.da_dataframe(
+        annidati=True,
+        mg=pd.DataFrame({"Member": ["mario.rossi", "m.rossi", "anna.bianchi", "GRP_A"],
+                         "Group": ["GRP_A", "GRP_A", "GRP_B", "GRP_C"]}),
+        device=pd.DataFrame({"Name": ["PC1"], "Enabled": ["True"], "Description": ["NB - mario.rossi - Roma"],
+                             "Mail": ["mario.rossi@consip.it"]}),
+    )
+
+
+def _attesi(risultati) -> dict:
+    """Contenuti per nome come li scrive file_utente, con il suffisso _<sam> sui nomi già usati."""
+    attesi = {}
+    for r in risultati:
+        for nome, contenuto in file_utente(r):
+            if nome in attesi:
+                stem, _, ext = nome.rpartition(".")
+                nome = f"{stem}_{r.sam}.{ext}"
+            attesi[nome] = contenuto
+    return attesi
+
+
+def test_zip_come_file_utente(snap):
+    risultati = elabora_batch(SAMS, snap)
+    assert risultati[0].device_csv and risultati[0].csv_gruppi_ad()
+    buf = io.BytesIO()
+    scritti = scrivi_zip(itera_batch(SAMS, snap), buf, allegati=[("report.csv", "a,b\n")])
+    with zipfile.ZipFile(buf) as zf:
+        contenuti = {nome: zf.read(nome).decode("utf-8") for nome in zf.namelist()}
+    assert scritti == list(contenuti) and scritti[0] == "report.csv"
+    assert contenuti.pop("report.csv") == "a,b\n"
+    consolidato = contenuti.pop(nome_batch())
+    assert contenuti == _attesi(risultati)
+    assert list(csv.reader(io.StringIO(consolidato))) == [HEADER_MODIFICA] + [r.riga for r in risultati]
+
+
+def test_zip_un_account_senza_consolidato(snap):
+    buf = io.BytesIO()
+    scrivi_zip(itera_batch(["mario.rossi"], snap), buf)
+    with zipfile.ZipFile(buf) as zf:
+        assert nome_batch() not in zf.namelist()
+
+
+def test_csv_consolidato_come_righe(snap, tmp_path):
+    risultati = elabora_batch(SAMS, snap)
+    stream = io.StringIO()
+    assert scrivi_csv_consolidato(itera_batch(SAMS, snap), stream) == len(SAMS)
+    assert stream.getvalue() == "".join([risultati[0].csv_utente()] +
+                                        [r.csv_utente().split("\r\n", 1)[1] for r in risultati[1:]])
+    # su percorso e nella cartella di scrivi_risultati: stesso contenuto
+    scrivi_csv_consolidato(risultati, tmp_path / "batch.csv")
+    assert (tmp_path / "batch.csv").read_bytes().decode("utf-8") == stream.getvalue()
+    scrivi_risultati(risultati, tmp_path / "out")
+    assert (tmp_path / "out" / nome_batch()).read_bytes().decode("utf-8") == stream.getvalue()
@@ -0,0 +1,81 @@
+# -*- coding: utf-8 -*-
+# Ricognizione accessi residui: anti-join sull'elenco attivi, confrontata con i lookup per account.
+
+import pandas as pd
+import pytest
+
+from deprovisioning_core import (
+    COLONNE_NON_RISOLTI,
+    COLONNE_RICOGNIZIONE,
+    Snapshot,
+    elabora_batch,
+    ricognizione_accessi,
+)
+
+
+@pytest.fixture
+def snap() -> Snapshot:
+    return Snapshot.da_dataframe(
+        # GRP_FIGLIO è un gruppo annidato in GRP_1, PC01$ un computer: non sono account
+        mg=pd.DataFrame({"Member": ["a.b", "c.d", "e.f", "GRP_FIGLIO", "a.b", "PC01$"],
+                         "Group": ["GRP_1", "GRP_1", "GRP_2", "GRP_1", "GRP_FIGLIO", "GRP_2"]}),
+        dl=pd.DataFrame({"Member Alias": ["a.b; g.h", "c.d; x.y@gmail.com"],
+                         "Distribution Group Primary SMTP address": ["dl1@consip.it", "dl2@consip.it"]}),
+        entra=pd.DataFrame({"MemberUserPrincipalName": ["e.f@consip.onmicrosoft.com", "C.D@consip.it"],
+                            "GroupName": ["AZ_1", "AZ_2"]}),
+        device=pd.DataFrame({"Name": ["PC1"], "Enabled": ["True"], "Description": ["NB - g.h - Roma"]}),
+    )
+
+
+def test_tutti_attivi_nessun_residuo(snap):
+    residui, _, non_trovati = ricognizione_accessi(["a.b", "c.d", "e.f", "g.h"], snap)
+    assert residui.empty and list(residui.columns) == COLONNE_RICOGNIZIONE
+    assert non_trovati == []
+
+
+def test_snapshot_vuoto():
+    residui, non_risolti, non_trovati = ricognizione_accessi(["a.b"], Snapshot.da_dataframe())
+    assert residui.empty and list(residui.columns) == COLONNE_RICOGNIZIONE
+    assert non_risolti.empty and list(non_risolti.columns) == COLONNE_NON_RISOLTI
+    assert non_trovati == ["a.b"]
+
+
+def test_residui_con_forme_diverse(snap):
+    residui, _, non_trovati = ricognizione_accessi(["A.B", "e.f@consip.it", "zz.zz"], snap)
+    assert non_trovati == ["zz.zz"]
+    righe = residui.set_index("Account")
+    assert righe.index.tolist() == ["c.d", "g.h"]
+    assert righe.loc["c.d", ["DL", "MG", "Entra", "PC"]].tolist() == [1, 1, 1, 0]
+    assert righe.loc["c.d", "Identificativi"] == "c.d;c.d@consip.it"
+    assert righe.loc["g.h", ["DL", "PC"]].tolist() == [1, 1]
+
+
+def test_non_account_riportati_a_parte(snap):
+    residui, non_risolti, _ = ricognizione_accessi(["a.b", "c.d", "e.f", "g.h"], snap)
+    assert residui.empty
+    righe = non_risolti.set_index("Identificativo")
+    assert righe["Motivo"].to_dict() == {"pc01$": "computer", "grp_figlio": "gruppo annidato",
+                                         "x.y@gmail.com": "indirizzo esterno o non risolto"}
+    assert righe.loc["x.y@gmail.com", ["DL", "MG"]].tolist() == [1, 0]
+    assert righe.loc["grp_figlio", ["DL", "MG"]].tolist() == [0, 1]
+    # un identificativo nell'elenco attivi non è segnalato
+    _, non_risolti, _ = ricognizione_accessi(["a.b", "c.d", "e.f", "g.h", "X.Y@gmail.com"], snap)
+    assert "x.y@gmail.com" not in non_risolti["Identificativo"].tolist()
+
+
+def test_come_i_lookup_per_account(snap):
+    residui, _, _ = ricognizione_accessi(["a.b"], snap)
+    for r, riga in zip(elabora_batch(residui["Account"].tolist(), snap), residui.itertuples()):
+        assert r.sam == riga.Account
+
+
+def test_casella_personale_resta_account():
+    # mario.rossi@consip.it è una casella con delegati nell'export SM: non è un gruppo annidato
+    snap = Snapshot.da_dataframe(
+        mg=pd.DataFrame({"Member": ["mario.rossi"], "Group": ["GRP_A"]}),
+        sm=pd.DataFrame({"Member": ["luca.bianchi"], "EmailAddress": ["mario.rossi@consip.it"]}),
+    )
+    residui, non_risolti, _ = ricognizione_accessi(["luca.bianchi"], snap)
+    assert residui["Account"].tolist() == ["mario.rossi"]
+    assert residui.loc[0, "MG"] == 1
+    assert non_risolti.empty
@@ -0,0 +1,66 @@
+# -*- coding: utf-8 -*-
+# Cache dei risultati per account: stessa impronta -> stesso risultato, export cambiato -> ricalcolo.
+
+import pandas as pd
+import pytest
+
+from deprovisioning_core import ExportCache, Strumentazione, carica_snapshot, elabora_batch, elabora_utente
+
+
+@pytest.fixture
+def export(tmp_path) -> dict:
+    mg = tmp_path / "mg.csv"
+    pd.DataFrame({"Member": ["mario.rossi", "anna.bianchi"], "Group": ["GRP_A", "GRP_B"]}).to_csv(mg, index=False)
+    entra = tmp_path / "entra.csv"
+    pd.DataFrame({"MemberUserPrincipalName": ["Mario.Rossi@consip.it"], "GroupName": ["AZ_1"]}).to_csv(
+        entra, index=False)
+    return {"mg": str(mg), "entra": str(entra)}
+
+
+def _in_cache(snapshot, sam: str) -> bool:
+    strumentazione = Strumentazione()
+    elabora_utente(sam, snapshot, strumentazione)
+    return any(f["fase"] == "utente (cache)" for f in strumentazione.records())
+
+
+def test_stessa_impronta_stesso_risultato(export):
+    risultati = ExportCache()
+    snapshot = carica_snapshot(export, risultati=risultati)
+    primo = elabora_utente("mario.rossi", snapshot)
+    assert elabora_utente("mario.rossi", snapshot) is primo
+    # export riletti ma invariati: stessa impronta, anche da un altro snapshot
+    ricaricato = carica_snapshot(export, risultati=risultati)
+    assert ricaricato.impronta == snapshot.impronta
+    assert elabora_utente("mario.rossi", ricaricato) is primo
+    assert len(risultati) == 1
+
+
+def test_sam_e_upn_una_sola_voce(export):
+    risultati = ExportCache()
+    snapshot = carica_snapshot(export, risultati=risultati)
+    primo = elabora_utente("mario.rossi", snapshot)
+    for forma in [" Mario.Rossi ", "mario.rossi@consip.it", "MARIO.ROSSI@CONSIP.IT"]:
+        assert elabora_utente(forma, snapshot) is primo, forma
+    assert len(risultati) == 1
+    assert [r.sam for r in elabora_batch(["mario.rossi", "Mario.Rossi@consip.it"], snapshot)] == ["mario.rossi"]
+
+
+def test_export_cambiato_ricalcola(export):
+    risultati = ExportCache()
+    snapshot = carica_snapshot(export, risultati=risultati)
+    primo = elabora_utente("mario.rossi", snapshot)
+    assert _in_cache(snapshot, "mario.rossi") and not _in_cache(snapshot, "anna.bianchi")
+
+    pd.DataFrame({"Member": ["mario.rossi"], "Group": ["GRP_NUOVO"]}).to_csv(export["mg"], index=False)
+    cambiato = carica_snapshot(export, risultati=risultati)
+    assert cambiato.impronta != snapshot.impronta
+    assert not _in_cache(cambiato, "mario.rossi")
+    nuovo = elabora_utente("mario.rossi", cambiato)
+    assert nuovo is not primo and "GRP_NUOVO" in nuovo.riga and "GRP_A" not in nuovo.riga
+    # il risultato del vecchio snapshot resta valido per chi lo usa ancora
+    assert elabora_utente("mario.rossi", snapshot) is primo
+
+
+def test_senza_cache_nessuna_voce(export):
+    snapshot = carica_snapshot(export)
+    assert elabora_utente("mario.rossi", snapshot) is not elabora_utente("mario.rossi", snapshot)
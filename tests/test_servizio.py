@@ -0,0 +1,108 @@
+# -*- coding: utf-8 -*-
+# Servizio HTTP: percorsi ammessi da /ricarica, ricariche fallite, identificativi vuoti e gruppi non trovati.
+
+import json
+import threading
+import urllib.error
+import urllib.request
+from http.server import ThreadingHTTPServer
+
+import pandas as pd
+import pytest
+
+from deprovisioning_core import gruppi_non_trovati, report_membri_gruppi
+from deprovisioning_service import RicaricaNonRiuscita, Servizio, _handler, _locale
+
+
+@pytest.fixture
+def export_mg(tmp_path):
+    cartella = tmp_path / "export"
+    cartella.mkdir()
+    pd.DataFrame({"Member": ["mario.rossi", "anna.bianchi"], "Group": ["GRP_A", "GRP_B"]}).to_csv(
+        cartella / "mg.csv", index=False)
+    (tmp_path / "segreto.txt").write_text("non leggere", encoding="utf-8")
+    return cartella
+
+
+def test_ricarica_solo_file_di_avvio(export_mg):
+    servizio = Servizio({"mg": str(export_mg / "mg.csv")}, processi=False)
+    assert servizio.percorsi_ammessi({"mg": str(export_mg / "mg.csv")}) == {"mg": str(export_mg / "mg.csv")}
+    assert servizio.percorsi_ammessi({"device": None}) == {"device": None}
+    with pytest.raises(ValueError):
+        servizio.percorsi_ammessi({"mg": str(export_mg.parent / "segreto.txt")})
+    with pytest.raises(ValueError):
+        servizio.percorsi_ammessi({"dl": str(export_mg / "mg.csv")})
+
+
+def test_ricarica_dentro_la_cartella(export_mg):
+    servizio = Servizio({"mg": str(export_mg / "mg.csv")}, processi=False, cartella=str(export_mg))
+    assert servizio.percorsi_ammessi({"dl": "mg.csv"}) == {"dl": str(export_mg / "mg.csv")}
+    for fuori in ["../segreto.txt", str(export_mg.parent / "segreto.txt"), "/etc/passwd"]:
+        with pytest.raises(ValueError):
+            servizio.percorsi_ammessi({"mg": fuori})
+    with pytest.raises(ValueError):
+        servizio.percorsi_ammessi({"mg": 1})
+
+
+@pytest.fixture
+def http(export_mg):
+    servizio = Servizio({"mg": str(export_mg / "mg.csv")}, processi=False, cartella=str(export_mg))
+    server = ThreadingHTTPServer(("127.0.0.1", 0), _handler(servizio))
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    def richiesta(percorso, corpo=None):
+        req = urllib.request.Request(f"http://127.0.0.1:{server.server_port}{percorso}",
+                                     data=None if corpo is None else json.dumps(corpo).encode("utf-8"),
+                                     method="GET" if corpo is None else "POST")
+        try:
+            with urllib.request.urlopen(req) as risposta:
+                return risposta.status, json.loads(risposta.read())
+        except urllib.error.HTTPError as exc:
+            return exc.code, json.loads(exc.read())
+
+    yield servizio, richiesta
+    server.shutdown()
+    server.server_close()
+
+
+def test_ricarica_fallita_tiene_lo_snapshot(export_mg):
+    servizio = Servizio({"mg": str(export_mg / "mg.csv")}, processi=False, cartella=str(export_mg))
+    prima, files = servizio.snapshot, dict(servizio.files)
+    with pytest.raises(RicaricaNonRiuscita) as exc:
+        servizio.ricarica(servizio.percorsi_ammessi({"mg": "manca.csv"}))
+    assert set(exc.value.errori) == {"mg"}
+    assert servizio.snapshot is prima and servizio.files == files
+    assert servizio.stato()["export"]["mg"]["righe"] == 2
+
+
+def test_ricarica_fallita_http(http):
+    servizio, richiesta = http
+    codice, corpo = richiesta("/ricarica", {"mg": "manca.csv"})
+    assert codice == 422 and set(corpo["errori"]) == {"mg"}
+    # le risposte usano ancora i gruppi MG del file precedente
+    codice, risultato = richiesta("/utenti/mario.rossi")
+    assert codice == 200 and "GRP_A" in risultato["riga"]
+    assert servizio.files["mg"] == str(servizio.cartella / "mg.csv")
+    assert richiesta("/stato")[1]["export"]["mg"]["righe"] == 2
+
+
+def test_identificativi_vuoti(http):
+    _, richiesta = http
+    assert richiesta("/utenti/%20")[0] == 400
+    assert richiesta("/batch", {"sam": ["", " "]})[0] == 400
+    assert richiesta("/batch", {"sam": ["mario.rossi", " "]})[0] == 400
+    assert richiesta("/utenti/%20mario.rossi%20")[0] == 200
+
+
+def test_gruppi_non_trovati_senza_distinzione_di_maiuscole(export_mg):
+    snapshot = Servizio({"mg": str(export_mg / "mg.csv")}, processi=False).snapshot
+    richiesti = [" grp_a ", "GRP_B", "GRP_X"]
+    report = report_membri_gruppi(richiesti, snapshot)
+    assert gruppi_non_trovati(richiesti, report) == ["GRP_X"]
+    # anche se il report riportasse i nomi canonici
+    assert gruppi_non_trovati(richiesti, report.assign(Gruppo=report["Gruppo"].str.strip().str.upper())) == ["GRP_X"]
+
+
+def test_host_locale():
+    assert _locale("127.0.0.1") and _locale("::1") and _locale("localhost")
+    assert not _locale("0.0.0.0") and not _locale("192.168.1.10")